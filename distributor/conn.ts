@@ -6,7 +6,12 @@ import path from "path";
 export const APP_DIR = process.env.Z_APP_DIR ?? '/home/tri/zapdos_data';
 export const FILES_DIR = path.join(APP_DIR, 'files');
 export const DATABASE_PATH = path.join(APP_DIR, 'database');
-export const DATABASE_EMBEDDING_DIMENSION = 2048;
+// Embedding workers truncate (Matryoshka) to this width, it must match the existing table
+export const DATABASE_EMBEDDING_DIMENSION = Number(process.env.Z_EMBEDDING_DIMENSION ?? 2048);
+// Candidates fetched from the vector index per search; with a reranker a smaller set is usually enough
+export const SEARCH_CANDIDATES = Number(process.env.Z_SEARCH_CANDIDATES ?? 200);
+// Send frames to workers inside the job message instead of as a path on shared storage
+export const INLINE_IMAGES = process.env.Z_INLINE_IMAGES === '1';
 
 // Make sure these directories exist
 import fs from 'fs/promises';
@@ -19,7 +24,7 @@ export type MediaUnit = {
     id: string;
     tenant_id: string;
     description?: string | null;
-    embedding?: number[] | null;
+    embedding?: number[] | Float32Array | null;
     at_time: string | Date;
     media_id: string;
     path: string;
@@ -153,9 +158,9 @@ export async function updateMediaUnitBatch(mediaUnits: (Partial<MediaUnit> & { i
 /**
  * Searches for media units by embedding similarity.
  */
-export async function searchMediaUnitsByEmbedding(queryEmbedding: number[], tenant_id: string): Promise<(MediaUnit & { _distance: number })[] | null> {
+export async function searchMediaUnitsByEmbedding(queryEmbedding: number[] | Float32Array, tenant_id: string): Promise<(MediaUnit & { _distance: number })[] | null> {
     try {
-        const results = table_media_units.search(queryEmbedding).where(`description IS NOT NULL AND tenant_id = '${tenant_id}'`).limit(200);
+        const results = table_media_units.search(queryEmbedding).where(`description IS NOT NULL AND tenant_id = '${tenant_id}'`).limit(SEARCH_CANDIDATES);
         const resultArray = await results.toArray();
         return resultArray;
     } catch (error) {
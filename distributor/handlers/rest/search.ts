@@ -1,7 +1,8 @@
 import { sendJob } from "../..";
 import type { TokenPayload } from "../../auth";
-import { searchMediaUnitsByEmbedding, type MediaUnit } from "../../conn";
+import { DATABASE_EMBEDDING_DIMENSION, searchMediaUnitsByEmbedding, type MediaUnit } from "../../conn";
 import { buildClusters } from "../../utils/cluster";
+import { RERANK_CANDIDATES, rerankResults } from "../../utils/rerank";
 import { maskedMediaUnit } from "./utils";
 import fs from "fs/promises";
 export default async function handleSearchRequest(req: Request, payload: TokenPayload): Promise<Response> {
@@ -24,14 +25,20 @@ export default async function handleSearchRequest(req: Request, payload: TokenPa
                 // --- Part 1: Fetch and send search results ---
                 const job = {
                     text: json.query,
-                    prompt_name: "query"
+                    prompt_name: "query",
+                    dimension: DATABASE_EMBEDDING_DIMENSION,
                 };
 
                 console.log('Sending job to worker for embedding', job);
                 const embd_output = await new Promise((resolve) => {
-                    sendJob(job, "fast_embedding", { cont: resolve });
+                    // Dropped unsent if the client disconnects first
+                    sendJob(job, "fast_embedding", { cont: resolve, signal: req.signal });
                 });
                 console.log('Embedding output', embd_output);
+                if ((embd_output as any).status === 'expired') {
+                    controller.close();
+                    return;
+                }
 
                 const search_result = await searchMediaUnitsByEmbedding((embd_output as any).embedding, payload.tenant_id);
                 console.log('Search result', search_result?.length, payload);
@@ -41,14 +48,20 @@ export default async function handleSearchRequest(req: Request, payload: TokenPa
                     return;
                 }
 
+                // Rerank the best candidates with the cross-encoder, the rest keep their vector-search order
+                const reranked = await rerankResults(json.query, search_result.slice(0, RERANK_CANDIDATES));
+                const ranked_result: (MediaUnit & { _distance: number, _score?: number })[] = reranked
+                    ? [...reranked, ...search_result.slice(RERANK_CANDIDATES)]
+                    : search_result;
+
                 // group by media_id
-                const groups = search_result.reduce((acc, item) => {
+                const groups = ranked_result.reduce((acc, item) => {
                     if (!acc[item.media_id]) acc[item.media_id] = [];
                     acc[item.media_id]!.push(item);
                     return acc;
-                }, {} as Record<string, (MediaUnit & { _distance: number })[]>);
+                }, {} as Record<string, (MediaUnit & { _distance: number, _score?: number })[]>);
 
-                type Island = (MediaUnit & { _distance: number })[]
+                type Island = (MediaUnit & { _distance: number, _score?: number })[]
                 // For each group, order by at_time, then scan for islands for consecutive frames within X seconds
                 const X_SECONDS = 5 * 60;
                 const islands: Island[] = [];
@@ -77,23 +90,22 @@ export default async function handleSearchRequest(req: Request, payload: TokenPa
                     }
                 }
 
-                // Sort islands by average distance of items in the island
-                islands.sort((a, b) => {
-                    const avgA = a.reduce((sum, item) => sum + item._distance, 0) / a.length;
-                    const avgB = b.reduce((sum, item) => sum + item._distance, 0) / b.length;
-                    return avgA - avgB;
-                });
+                // Sort islands by their best reranker score, or without reranking by average distance of items in the island
+                const islandRank = (island: Island) => reranked
+                    ? -Math.max(...island.map(item => item._score ?? -Infinity))
+                    : island.reduce((sum, item) => sum + item._distance, 0) / island.length;
+                islands.sort((a, b) => islandRank(a) - islandRank(b));
 
                 // mask out, only get id, at_time, media_id of each item in each island
                 const masked_islands = islands.map(island => island.map(maskedMediaUnit));
 
                 sendJsonChunk({ type: "islands", islands: masked_islands });
 
-                // // TODO: reranker https://huggingface.co/jinaai/jina-reranker-m0
                 // --- Part 2: Fetch and send the summary ---
-                // Use these for summary also
-                const imageContentList = search_result?.slice(0, 5).map(item => ({ type: "image", image: item.path })) ?? [];
+                // Use these for summary also, in reranked order when available
+                const imageContentList = ranked_result.slice(0, 5).map(item => ({ type: "image", image: item.path }));
                 const summary_job = {
+                    stream: true,
                     messages: [
                         {
                             role: 'system',
@@ -128,7 +140,14 @@ export default async function handleSearchRequest(req: Request, payload: TokenPa
 
                 console.log('Sending job to worker for summary', summary_job);
                 const summary_output = await new Promise((resolve) => {
-                    sendJob(summary_job, "qa_vlm", { cont: resolve });
+                    sendJob(summary_job, "qa_vlm", {
+                        cont: resolve,
+                        signal: req.signal,
+                        // Forward generated text as it arrives, the final summary follows
+                        partial(message) {
+                            sendJsonChunk({ type: "summary_delta", delta: message.delta });
+                        }
+                    });
                 });
 
                 // --- THIS IS THE FIX ---
@@ -1,5 +1,5 @@
 import { sendJob, type Client } from "..";
-import { addMediaUnit, FILES_DIR, updateMediaUnit } from "../conn";
+import { addMediaUnit, DATABASE_EMBEDDING_DIMENSION, FILES_DIR, INLINE_IMAGES, updateMediaUnit } from "../conn";
 import { createMessage } from "../message";
 import { s3Client } from "../utils/s3_service";
 import { PutObjectCommand } from "@aws-sdk/client-s3";
@@ -7,7 +7,7 @@ import { PutObjectCommand } from "@aws-sdk/client-s3";
 let logging = {
     num: 0,
 }
-async function upload(path: string, buffer: ArrayBuffer) {
+async function upload(path: string, buffer: Uint8Array) {
     logging.num += 1;
     if (logging.num % 100 === 0) {
         console.log(`Uploading to S3 object ${path}. Num uploaded: ${logging.num}`);
@@ -26,67 +26,109 @@ async function upload(path: string, buffer: ArrayBuffer) {
 
 }
 
+type FrameRow = { at_time: string | Date, media_id: string };
+
+/**
+ * Stores one frame (an uploaded image or a video keyframe) as a media unit and
+ * sends it to the description and embedding workers.
+ */
+// priority 1 queues the frame's jobs behind live uploads (priority 0)
+async function indexFrame(client: Client, id: string, buffer: Uint8Array, row: FrameRow, priority = 0) {
+    // Save buffer to file
+    const filepath = `${FILES_DIR}/${id}.jpg`;
+    await Bun.write(filepath, buffer);
+
+    // Save to S3 to serve
+    upload(`scope_0/${client.authenticated!.tenant_id}/${id}`, buffer);
+
+    addMediaUnit({
+        id,
+        tenant_id: client.authenticated!.tenant_id,
+        path: filepath,
+        at_time: row.at_time,
+        media_id: row.media_id,
+    });
+
+    // Frames of one media_id come from the same camera, workers reuse results of near-duplicates
+    const source = row.media_id;
+    const image_description_job = {
+        source,
+        messages: [
+            {
+                role: 'system',
+                content: [
+                    { type: 'text', text: `Describe the image in detailed. Focus on the object and less on the context.` }
+                ]
+            },
+            {
+                "role": "user",
+                "content": [
+                    { "type": "image", "image": INLINE_IMAGES ? buffer : filepath },
+                ]
+            }
+        ]
+    };
+    sendJob(image_description_job, 'vlm', {
+        priority,
+        async cont(output) {
+            const message = createMessage({
+                type: 'update',
+                data: {
+                    id,
+                    media_id: row.media_id,
+                    at_time: row.at_time,
+                    description: (output as any).description,
+                }
+            });
+            client.ws.send(message);
+            const update = { id, description: (output as any).description }
+            await updateMediaUnit(update);
+        }
+    });
+
+    const embedding_job = INLINE_IMAGES
+        ? { image: buffer, source, dimension: DATABASE_EMBEDDING_DIMENSION }
+        : { filepath, source, dimension: DATABASE_EMBEDDING_DIMENSION };
+    sendJob(embedding_job, 'embedding', {
+        priority,
+        async cont(output) {
+            const update = { id, embedding: (output as any).embedding }
+            await updateMediaUnit(update);
+        }
+    });
+}
+
 export async function onTenantConnection(parsed: any, client: Client) {
     if (!client.authenticated) return;
 
     if (parsed.header.type === "index") {
         if (!parsed.buffer || !parsed.header.id || !parsed.header.row) return;
+        await indexFrame(client, parsed.header.id, parsed.buffer, parsed.header.row);
+    }
 
-        // Save buffer to file
-        const filepath = `${FILES_DIR}/${parsed.header.id}.jpg`;
+    // A whole video: the keyframes worker picks frames at scene changes, each is indexed like an uploaded frame
+    if (parsed.header.type === "index_video") {
+        if (!parsed.buffer || !parsed.header.id || !parsed.header.row) return;
+        const row = parsed.header.row as FrameRow;
+        const extension = parsed.header.extension ?? 'mp4';
+        const filepath = `${FILES_DIR}/${parsed.header.id}.${extension}`;
         await Bun.write(filepath, parsed.buffer);
 
-        // Save to S3 to serve
-        upload(`scope_0/${client.authenticated!.tenant_id}/${parsed.header.id}`, parsed.buffer);
-
-        addMediaUnit({
-            id: parsed.header.id,
-            tenant_id: client.authenticated.tenant_id,
-            path: filepath,
-            at_time: parsed.header.row.at_time,
-            media_id: parsed.header.row.media_id,
-        });
-
-        const image_description_job = {
-            messages: [
-                {
-                    role: 'system',
-                    content: [
-                        { type: 'text', text: `Describe the image in detailed. Focus on the object and less on the context.` }
-                    ]
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        { "type": "image", "image": filepath },
-                    ]
-                }
-            ]
-        };
-        sendJob(image_description_job, 'vlm', {
-            async cont(output) {
-                const message = createMessage({
-                    type: 'update',
-                    data: {
-                        id: parsed.header.id,
-                        media_id: parsed.header.row.media_id,
-                        at_time: parsed.header.row.at_time,
-                        description: (output as any).description,
-                    }
-                });
-                client.ws.send(message);
-                const update = { id: parsed.header.id, description: (output as any).description }
-                await updateMediaUnit(update);
-            }
-        });
-
-        const embedding_job = { filepath };
-        sendJob(embedding_job, 'embedding', {
-            async cont(output) {
-                const update = { id: parsed.header.id, embedding: (output as any).embedding }
-                await updateMediaUnit(update);
+        const keyframes_job = INLINE_IMAGES
+            ? { video: parsed.buffer, suffix: `.${extension}`, start_time: new Date(row.at_time).toISOString() }
+            : { filepath, start_time: new Date(row.at_time).toISOString() };
+        const indexKeyframes = async (message: Record<string, any>) => {
+            const keyframes = (message.keyframes ?? []) as { at_time: string, image: Uint8Array }[];
+            console.log(`Video ${parsed.header.id}: indexing ${keyframes.length} keyframes.`);
+            for (const keyframe of keyframes) {
+                await indexFrame(client, crypto.randomUUID(), keyframe.image, { at_time: keyframe.at_time, media_id: row.media_id }, 1);
             }
+        };
+        sendJob(keyframes_job, 'keyframes', {
+            // Long videos send keyframes ahead in partial messages, the output holds the rest
+            partial: indexKeyframes,
+            cont: indexKeyframes,
         });
     }
 
-}
\ No newline at end of file
+}
@@ -4,7 +4,7 @@ import * as jose from 'jose';
 import verifyToken from "./auth";
 import { onTenantConnection } from "./handlers/tenant";
 import handleTenantREST from "./handlers/tenant_rest";
-import { createMessage, parseMessage } from "./message";
+import { createMessage, decodeEmbeddings, extractSegments, parseMessage, pickCodec, resolveSegments, type Codec } from "./message";
 
 export type Client = {
     id: string;
@@ -16,12 +16,25 @@ export type Client = {
         worker_type: string;
         max_batch_size: number;
         max_latency_ms: number;
+        // Capacity advertised by the worker, see indexer/flow_control.py
+        max_batch_tokens?: number;
+        max_batch_pixels?: number;
+        slots?: number;
         gathered: any[];
         send_timeout?: NodeJS.Timeout;
+        // Batches the worker can start right away, undefined for workers without flow control
+        credits?: number;
+        // The gathered jobs are due but wait for a credit
+        flush_due?: boolean;
+        // Negotiated at registration, used for every message to the worker
+        codec?: Codec;
     },
 }
 
-export type JobMap = Map<string, { cont: (result: Record<string, any>) => void }>;
+export type JobMap = Map<string, {
+    cont: (result: Record<string, any>) => void;
+    partial?: (message: Record<string, any>) => void;
+}>;
 const job_map = new Map() as JobMap;
 const clients = new Map<ServerWebSocket<unknown>, Client>();
 
@@ -29,39 +42,141 @@ const PORT = 8040;
 
 export function sendJob(job: Record<string, any>, worker_type: string, opts?: {
     cont: (result: Record<string, any>) => void;
+    // Receives {type: 'partial', id, delta} messages of jobs sent with stream: true
+    partial?: (message: Record<string, any>) => void;
+    // Nobody waits for the result after this many milliseconds; later the job
+    // is dropped and cont receives {id, status: 'expired'}
+    deadline_ms?: number;
+    // Lower is more urgent, gathered jobs are batched in priority order (default 0)
+    priority?: number;
+    // E.g. the HTTP request's signal: a job still gathered when it aborts is dropped
+    signal?: AbortSignal;
 }) {
     job.id = crypto.randomUUID();
     if (opts?.cont) {
         job_map.set(job.id, {
-            cont: opts.cont
+            cont: opts.cont,
+            partial: opts.partial,
         });
     }
+    // Absolute (epoch ms), so the worker can check it after queueing too
+    if (opts?.deadline_ms !== undefined) job.deadline = Date.now() + opts.deadline_ms;
+    if (opts?.priority !== undefined) job.priority = opts.priority;
+    opts?.signal?.addEventListener('abort', () => { job.deadline = 0; }, { once: true });
 
-    // TODO: distribute work for all workers of that worker_type, not just the first one
-    const worker = clients.values().find(c => c.worker_config?.worker_type === worker_type);
+    const worker = pickWorker(worker_type);
     if (!worker) return;
-    worker.worker_config!.gathered.push(job);
-    if (worker.worker_config!.send_timeout) clearTimeout(worker.worker_config!.send_timeout);
+    const config = worker.worker_config!;
+    config.gathered.push(job);
+    if (config.send_timeout) clearTimeout(config.send_timeout);
 
-    if (worker.worker_config!.gathered.length >= (worker.worker_config!.max_batch_size)) {
+    if (config.gathered.length >= config.max_batch_size || estimatedTokens(config.gathered) >= (config.max_batch_tokens ?? Infinity)) {
         workerFlush(worker);
         return;
     }
 
-    worker.worker_config!.send_timeout = setTimeout(async () => {
+    config.send_timeout = setTimeout(async () => {
         workerFlush(worker);
-    }, worker.worker_config!.max_latency_ms);
+    }, config.max_latency_ms);
+}
+
+// Rough token count of a job, only used against the worker's advertised max_batch_tokens
+function estimatedTokens(jobs: Record<string, any>[]) {
+    let tokens = 0;
+    for (const job of jobs) {
+        const text = job.text ?? job.prompt;
+        if (typeof text === 'string') tokens += Math.ceil(text.length / 4);
+    }
+    return tokens;
+}
+
+/**
+ * Picks the worker of that worker_type to gather a job for. Among workers with
+ * free credits the one with the most gathered jobs wins, so batches fill up;
+ * if all are busy, the one with the shortest backlog.
+ */
+function pickWorker(worker_type: string) {
+    let best: Client | undefined;
+    for (const c of clients.values()) {
+        const config = c.worker_config;
+        if (config?.worker_type !== worker_type) continue;
+        if (!best) {
+            best = c;
+            continue;
+        }
+        const bestConfig = best.worker_config!;
+        const free = (config.credits ?? 1) > 0;
+        const bestFree = (bestConfig.credits ?? 1) > 0;
+        if (free !== bestFree) {
+            if (free) best = c;
+        } else if (free ? config.gathered.length > bestConfig.gathered.length : config.gathered.length < bestConfig.gathered.length) {
+            best = c;
+        }
+    }
+    return best;
+}
+
+// Answers gathered jobs whose deadline passed with an 'expired' status instead of sending them
+function dropExpiredJobs(config: NonNullable<Client['worker_config']>) {
+    const now = Date.now();
+    config.gathered = config.gathered.filter(job => {
+        if (job.deadline === undefined || job.deadline > now) return true;
+        const entry = job_map.get(job.id);
+        job_map.delete(job.id);
+        entry?.cont({ id: job.id, status: 'expired' });
+        return false;
+    });
+}
+
+// Takes up to max_batch_size gathered jobs, most urgent first, fewer if they exceed max_batch_tokens
+function takeBatch(config: NonNullable<Client['worker_config']>) {
+    // Stable sort: arrival order within a priority
+    config.gathered.sort((a, b) => (a.priority ?? 0) - (b.priority ?? 0));
+    let count = 0;
+    let tokens = 0;
+    while (count < config.gathered.length && count < config.max_batch_size) {
+        tokens += estimatedTokens([config.gathered[count]]);
+        if (count > 0 && tokens > (config.max_batch_tokens ?? Infinity)) break;
+        count++;
+    }
+    return config.gathered.splice(0, count);
 }
 
 export function workerFlush(c: Client) {
     // This function might be called from timeout, so check everything
     if (!c.ws || c.ws.readyState !== WebSocket.OPEN) return;
     if (!c.worker_config) return;
-    const inputs = structuredClone(c.worker_config.gathered);
-    c.worker_config.gathered = []
-    c.ws.send(createMessage({
-        inputs
-    }));
+    const config = c.worker_config;
+    dropExpiredJobs(config);
+    while (config.gathered.length > 0) {
+        if (config.credits !== undefined && config.credits <= 0) {
+            // Sent as soon as the worker grants a credit
+            config.flush_due = true;
+            return;
+        }
+        // Inline payloads (Uint8Array job fields, e.g. frames) travel as binary segments
+        const segments: Record<string, Uint8Array> = {};
+        const inputs = extractSegments(takeBatch(config), segments);
+        if (config.credits !== undefined) config.credits--;
+        c.ws.send(createMessage({
+            inputs
+        }, undefined, Object.keys(segments).length > 0 ? segments : undefined, config.codec));
+    }
+    config.flush_due = false;
+}
+
+// A worker with a free credit and nothing gathered takes over the due jobs of a busy one
+function takeOverDueJobs(c: Client) {
+    for (const other of clients.values()) {
+        const config = other.worker_config;
+        if (other === c || config?.worker_type !== c.worker_config!.worker_type) continue;
+        if (config.flush_due && config.gathered.length > 0) {
+            c.worker_config!.gathered.push(...config.gathered.splice(0));
+            config.flush_due = false;
+            c.worker_config!.flush_due = true;
+            return;
+        }
+    }
 }
 
 console.log("Starting distributor...");
@@ -86,6 +201,8 @@ Bun.serve({
         return handleTenantREST(req);
     },
     websocket: {
+        // Videos and keyframe results are larger than the 16 MB default
+        maxPayloadLength: 64 * 1024 * 1024,
         open(ws) {
             const id = crypto.randomUUID();
             clients.set(ws, { id, ws, });
@@ -114,6 +231,9 @@ Bun.serve({
                 }
 
                 console.log('Registered worker', client.id, parsed.header.worker_config);
+                if (parsed.header.startup_timings) {
+                    console.log('Worker startup timings', client.id, parsed.header.startup_timings);
+                }
                 client.worker_config = {
                     max_batch_size: 32,
                     max_latency_ms: 30000,
@@ -122,6 +242,13 @@ Bun.serve({
                 };
 
                 client.worker_config = { ...client.worker_config, ...parsed.header.worker_config };
+                // Workers that advertise slots get credit-based flow control
+                client.worker_config!.credits = parsed.header.worker_config.slots;
+                // Workers that offer codecs are told which one to use, always in JSON
+                if (parsed.header.codecs) {
+                    client.worker_config!.codec = pickCodec(parsed.header.codecs);
+                    ws.send(createMessage({ type: 'codec', codec: client.worker_config!.codec }));
+                }
                 return;
             }
 
@@ -178,10 +305,34 @@ Bun.serve({
             }
 
             if (client.worker_config) {
+                // Streaming workers send partial results before the batch output
+                if (parsed.header.type === 'partial') {
+                    // Binary fields (e.g. keyframe images sent ahead) arrive as segments
+                    if (parsed.segments) Object.assign(parsed.header, resolveSegments(parsed.header, parsed.segments));
+                    job_map.get(parsed.header.id)?.partial?.(parsed.header);
+                    return;
+                }
+
+                // Granted after each result, optionally with an autotuned max_batch_size
+                if (parsed.header.type === 'credit') {
+                    const config = client.worker_config;
+                    config.credits = (config.credits ?? 0) + (parsed.header.credits ?? 1);
+                    if (parsed.header.max_batch_size) config.max_batch_size = parsed.header.max_batch_size;
+                    if (config.gathered.length === 0) takeOverDueJobs(client);
+                    if (config.flush_due || config.gathered.length >= config.max_batch_size) workerFlush(client);
+                    return;
+                }
+
                 // TODO: Here we assume all workers are BATCH workers
+                // Binary fields of outputs (e.g. keyframe images) arrive as segments
+                if (parsed.segments) parsed.header.output = resolveSegments(parsed.header.output, parsed.segments);
                 const outputs = parsed.header.output as any[];
                 // Sanity check
                 if (!outputs || !Array.isArray(outputs)) return;
+                // Packed or quantized embeddings are decoded to Float32Arrays for LanceDB
+                if (parsed.header.packed_embedding || outputs.some(output => output.dtype)) {
+                    decodeEmbeddings(parsed.header, parsed.buffer);
+                }
                 for (const output of outputs) {
                     const job = job_map.get(output.id);
                     job?.cont(output);
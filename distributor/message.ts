@@ -1,7 +1,31 @@
 
+// msgpack is optional, without the package workers are asked to use JSON
+const msgpack = await import('@msgpack/msgpack').catch(() => undefined);
+
+/**
+ * Wire codecs, see indexer/message.py. The top byte of the 4-byte length
+ * prefix of a binary message is the codec tag of its header.
+ */
+export type Codec = 'json' | 'msgpack';
+const CODEC_TAGS: Record<Codec, number> = { json: 0, msgpack: 1 };
+export const SUPPORTED_CODECS: Codec[] = msgpack ? ['msgpack', 'json'] : ['json'];
+
+// The first codec the worker offers that we speak, JSON if none
+export function pickCodec(offered: unknown): Codec {
+    if (!Array.isArray(offered)) return 'json';
+    return (offered.find(codec => SUPPORTED_CODECS.includes(codec)) as Codec | undefined) ?? 'json';
+}
+
+/**
+ * Parses a worker or tenant message.
+ * Binary messages are [1-byte codec tag][3-byte big-endian header length][header][buffer].
+ * The buffer and the named segments described in header.segments
+ * ({name: {offset, length}}, offsets from the start of the buffer) are views, not copies.
+ */
 export function parseMessage(message: Buffer<ArrayBufferLike> | string): {
     header: Record<string, any>;
     buffer?: Uint8Array;
+    segments?: Record<string, Uint8Array>;
     error?: unknown;
 } {
     try {
@@ -22,19 +46,28 @@ export function parseMessage(message: Buffer<ArrayBufferLike> | string): {
         // Use a DataView to safely read numbers from the buffer
         const view = new DataView(message.buffer, message.byteOffset, message.byteLength);
 
-        // 1. Read the header length from the first 4 bytes (at offset 0)
+        // 1. Read the codec tag and header length from the first 4 bytes (at offset 0)
         // The 'false' argument specifies Big-Endian, matching our server.
-        const headerLength = view.getUint32(0, false);
+        const prefix = view.getUint32(0, false);
+        const tag = prefix >>> 24;
+        const headerLength = prefix & 0xffffff;
 
         // 2. Define the byte offsets for the different parts
         const headerStart = 4; // Header starts after the 4-byte length prefix
         const imageStart = headerStart + headerLength;
 
-        // 3. Decode the header string (from bytes to a string)
-        // Use TextDecoder for proper UTF-8 handling.
+        // 3. Decode the header
         const headerSlice = new Uint8Array(message.buffer, message.byteOffset + headerStart, headerLength);
-        const headerString = new TextDecoder().decode(headerSlice);
-        const header = JSON.parse(headerString);
+        let header: Record<string, any>;
+        if (tag === CODEC_TAGS.msgpack) {
+            if (!msgpack) throw new Error("Received a msgpack message but @msgpack/msgpack is not installed");
+            header = msgpack.decode(headerSlice) as Record<string, any>;
+        } else if (tag === CODEC_TAGS.json) {
+            // Use TextDecoder for proper UTF-8 handling.
+            header = JSON.parse(new TextDecoder().decode(headerSlice));
+        } else {
+            throw new Error(`Unknown codec tag ${tag}`);
+        }
 
         // 4. Extract the image data
         // The image is the rest of the buffer after the header.
@@ -42,8 +75,15 @@ export function parseMessage(message: Buffer<ArrayBufferLike> | string): {
             return { header };
         }
 
-        const buffer = Uint8Array.prototype.slice.call(message, imageStart);
-        return { header, buffer };
+        const buffer = new Uint8Array(message.buffer, message.byteOffset + imageStart, message.byteLength - imageStart);
+        if (!header.segments) {
+            return { header, buffer };
+        }
+        const segments: Record<string, Uint8Array> = {};
+        for (const [name, { offset, length }] of Object.entries(header.segments as Record<string, { offset: number, length: number }>)) {
+            segments[name] = buffer.subarray(offset, offset + length);
+        }
+        return { header, buffer, segments };
     } catch (error) {
         console.error("Failed to parse WebSocket message:", error);
         return { header: {}, error };
@@ -58,16 +98,112 @@ export function jsonBigIntReplacer(key: string, value: any) {
 }
 
 
-export function createMessage(header: Record<string, any>, buffer?: ArrayBufferLike) {
-    if (buffer) {
-        const headerString = JSON.stringify(header, jsonBigIntReplacer);
-        const headerBuffer = Buffer.from(headerString, "utf-8");
+export function createMessage(header: Record<string, any>, buffer?: ArrayBufferLike, segments?: Record<string, Uint8Array>, codec: Codec = 'json') {
+    if (buffer || segments || codec !== 'json') {
+        const parts: Uint8Array[] = buffer ? [Buffer.from(buffer as ArrayBuffer)] : [];
+        if (segments) {
+            let offset = buffer ? buffer.byteLength : 0;
+            const described: Record<string, { offset: number, length: number }> = {};
+            for (const [name, segment] of Object.entries(segments)) {
+                described[name] = { offset, length: segment.byteLength };
+                parts.push(segment);
+                offset += segment.byteLength;
+            }
+            header = { ...header, segments: described };
+        }
+        const headerBuffer = codec === 'msgpack'
+            ? msgpack!.encode(header)
+            : Buffer.from(JSON.stringify(header, jsonBigIntReplacer), "utf-8");
         const headerLength = headerBuffer.length;
+        if (headerLength > 0xffffff) throw new Error(`Message header of ${headerLength} bytes is too large`);
         const lengthBuffer = Buffer.alloc(4);
-        lengthBuffer.writeUInt32BE(headerLength, 0);
-        const imageBuffer = Buffer.from(buffer as ArrayBuffer);
-        return Buffer.concat([lengthBuffer, headerBuffer, imageBuffer]);
+        lengthBuffer.writeUInt32BE(((CODEC_TAGS[codec] << 24) >>> 0) + headerLength, 0);
+        return Buffer.concat([lengthBuffer, headerBuffer, ...parts]);
     }
 
     return JSON.stringify(header, jsonBigIntReplacer);
-}
\ No newline at end of file
+}
+
+/**
+ * Moves every Uint8Array in the jobs into a named segment and replaces it
+ * with a {segment: name} reference, which the worker resolves back to the bytes.
+ */
+export function extractSegments(value: any, segments: Record<string, Uint8Array>): any {
+    if (value instanceof Uint8Array) {
+        const name = `s${Object.keys(segments).length}`;
+        segments[name] = value;
+        return { segment: name };
+    }
+    if (Array.isArray(value)) return value.map(item => extractSegments(item, segments));
+    if (value && typeof value === 'object') {
+        return Object.fromEntries(Object.entries(value).map(([key, item]) => [key, extractSegments(item, segments)]));
+    }
+    return value;
+}
+
+/**
+ * The inverse of extractSegments: replaces every {segment: name} reference in
+ * a worker result with the bytes of that segment, e.g. keyframe images.
+ */
+export function resolveSegments(value: any, segments: Record<string, Uint8Array>): any {
+    if (Array.isArray(value)) return value.map(item => resolveSegments(item, segments));
+    if (value && typeof value === 'object') {
+        const keys = Object.keys(value);
+        if (keys.length === 1 && typeof value.segment === 'string' && value.segment in segments) return segments[value.segment];
+        return Object.fromEntries(keys.map(key => [key, resolveSegments(value[key], segments)]));
+    }
+    return value;
+}
+
+function float16ToFloat32(bits: number): number {
+    const sign = bits & 0x8000 ? -1 : 1;
+    const exponent = (bits >> 10) & 0x1f;
+    const fraction = bits & 0x03ff;
+    if (exponent === 0) return sign * Math.pow(2, -14) * (fraction / 1024);
+    if (exponent === 0x1f) return fraction ? NaN : sign * Infinity;
+    return sign * Math.pow(2, exponent - 15) * (1 + fraction / 1024);
+}
+
+type EmbeddingDtype = 'float32' | 'float16' | 'int8' | 'binary';
+
+function decodeEmbedding(read: (i: number, dtype: EmbeddingDtype) => number, dtype: EmbeddingDtype, dimension: number, scale = 1): Float32Array {
+    const embedding = new Float32Array(dimension);
+    for (let i = 0; i < dimension; i++) {
+        if (dtype === 'binary') {
+            // Sign bits, most significant bit first (np.packbits order)
+            const bit = (read(i >> 3, dtype) >> (7 - (i & 7))) & 1;
+            embedding[i] = (bit ? 1 : -1) / Math.sqrt(dimension);
+        } else {
+            embedding[i] = read(i, dtype) * scale;
+        }
+    }
+    return embedding;
+}
+
+/**
+ * Decodes the embeddings of a worker result into Float32Arrays on each output.
+ * Packed results hold their vectors in the buffer, each output carries the byte offset of its vector.
+ * JSON results only need decoding when an output carries a non-float32 dtype.
+ */
+export function decodeEmbeddings(header: Record<string, any>, buffer?: Uint8Array) {
+    const defaults = header.packed_embedding as { dtype: EmbeddingDtype, dimension: number } | undefined;
+    const view = buffer ? new DataView(buffer.buffer, buffer.byteOffset, buffer.byteLength) : undefined;
+    for (const output of header.output as Record<string, any>[]) {
+        const dtype: EmbeddingDtype = output.dtype ?? defaults?.dtype ?? 'float32';
+        const dimension: number = output.dimension ?? defaults?.dimension ?? output.embedding?.length;
+        if (view && defaults) {
+            // Outputs without a vector, e.g. expired inputs
+            if (output.offset === undefined) continue;
+            const offset = output.offset as number;
+            output.embedding = decodeEmbedding((i, dtype) => {
+                if (dtype === 'float32') return view.getFloat32(offset + i * 4, true);
+                if (dtype === 'float16') return float16ToFloat32(view.getUint16(offset + i * 2, true));
+                if (dtype === 'int8') return view.getInt8(offset + i);
+                return view.getUint8(offset + i);
+            }, dtype, dimension, output.scale);
+        } else if (dtype !== 'float32' && Array.isArray(output.embedding)) {
+            const values = output.embedding as number[];
+            output.embedding = decodeEmbedding((i) => values[i]!, dtype, dimension, output.scale);
+        }
+    }
+}
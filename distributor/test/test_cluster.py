@@ -1,37 +1,81 @@
-from sklearn.cluster import AffinityPropagation
+import os
+import sys
+import time
 import numpy as np
 
-# Assuming your embeddings are in a NumPy array called 'embeddings'
-embeddings = np.random.rand(1000, 2048)  # Example random data
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "indexer"))
+from worker_clustering import knn_graph_labels, minibatch_kmeans_labels, normalize_rows
 
-# Create an AffinityPropagation object
-# - damping: Damping factor between 0.5 and 1.
-# - preference: Controls how many exemplars are used.
-clustering = AffinityPropagation(damping=0.9)
+"""
+Compares the clustering worker's algorithms with the AffinityPropagation that
+distributor/utils/cluster.ts used to run, on synthetic 2048-d embeddings
+drawn around a known set of centers.
 
-# Fit the model
-clustering.fit(embeddings)
+Usage:
+  python test/test_cluster.py [sizes...]      default 250 500 1000 2000
 
-# The cluster labels are in clustering.labels_
-labels = clustering.labels_
+Agreement is the adjusted Rand index against the true centers and against
+AffinityPropagation (1.0 = identical partitions). AffinityPropagation is
+skipped above AP_MAX_N (default 2000) and when sklearn is not installed.
+"""
 
-# The number of clusters is the number of unique labels
-n_clusters = len(set(labels))
+DIMENSION = 2048
+THRESHOLD = 0.85
+AP_MAX_N = int(os.environ.get("AP_MAX_N", "2000"))
 
-print(f"Number of clusters found: {n_clusters}")
+def synthetic_embeddings(n: int, n_centers: int, noise: float = 0.15, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_centers, DIMENSION))
+    truth = rng.integers(0, n_centers, n)
+    embeddings = centers[truth] + noise * rng.standard_normal((n, DIMENSION))
+    return normalize_rows(embeddings.astype(np.float32)), truth
 
-# Create a dictionary to hold the embeddings for each cluster
-grouped_embeddings = {}
-for label in set(labels):
-    # Use boolean indexing to get the embeddings for the current label
-    grouped_embeddings[label] = embeddings[labels == label]
+def adjusted_rand_index(a: np.ndarray, b: np.ndarray) -> float:
+    _, a = np.unique(a, return_inverse=True)
+    _, b = np.unique(b, return_inverse=True)
+    table = np.zeros((a.max() + 1, b.max() + 1))
+    np.add.at(table, (a, b), 1)
 
-# Now you can access the embeddings for each group
-# For example, to get the embeddings for cluster 0:
-# print("\nEmbeddings in cluster 0:")
-# print(grouped_embeddings[0])
+    def pairs(x):
+        return (x * (x - 1) / 2).sum()
 
-# To print the number of embeddings in each cluster:
-print("\nNumber of embeddings in each cluster:")
-for cluster_id, group in grouped_embeddings.items():
-    print(f"Cluster {cluster_id}: {len(group)} embeddings")
\ No newline at end of file
+    index = pairs(table)
+    rows, cols = pairs(table.sum(axis=1)), pairs(table.sum(axis=0))
+    expected = rows * cols / pairs(np.array([len(a)]))
+    maximum = (rows + cols) / 2
+    return 1.0 if maximum == expected else (index - expected) / (maximum - expected)
+
+def timed(fn):
+    started = time.perf_counter()
+    labels = fn()
+    return labels, (time.perf_counter() - started) * 1000
+
+def affinity_propagation():
+    try:
+        from sklearn.cluster import AffinityPropagation
+    except ImportError:
+        return None
+    return lambda x: AffinityPropagation(damping=0.9, random_state=0).fit(x).labels_
+
+if __name__ == "__main__":
+    sizes = [int(s) for s in sys.argv[1:]] or [250, 500, 1000, 2000]
+    ap = affinity_propagation()
+    if ap is None:
+        print("sklearn is not installed, skipping AffinityPropagation.")
+
+    print(f"{'n':>6} {'method':<18} {'ms':>9} {'clusters':>9} {'ARI truth':>10} {'ARI AP':>8}")
+    for n in sizes:
+        embeddings, truth = synthetic_embeddings(n, n_centers=max(2, n // 50))
+        methods = {
+            "knn_graph": lambda: knn_graph_labels(embeddings, 10, THRESHOLD),
+            "minibatch_kmeans": lambda: minibatch_kmeans_labels(embeddings, THRESHOLD, time.monotonic() + 1.0),
+        }
+        results = {name: timed(fn) for name, fn in methods.items()}
+        if ap is not None and n <= AP_MAX_N:
+            results["affinity_propagation"] = timed(lambda: ap(embeddings))
+
+        reference = results.get("affinity_propagation", (None, 0))[0]
+        for name, (labels, ms) in results.items():
+            versus_ap = f"{adjusted_rand_index(labels, reference):.3f}" if reference is not None else "-"
+            print(f"{n:>6} {name:<18} {ms:>9.1f} {len(set(labels.tolist())):>9} "
+                  f"{adjusted_rand_index(labels, truth):>10.3f} {versus_ap:>8}")
@@ -1,48 +1,43 @@
-
-import { python } from "bun_python";
 import type { Vector } from "apache-arrow";
+import { sendJob } from "..";
 import type { MediaUnit } from "../conn";
 
-// 1. Import Python libraries using the bun_python bridge
-const np = python.import("numpy");
-const { AffinityPropagation } = python.import("sklearn.cluster");
+// Clustering runs in the indexer's "clustering" worker (indexer/worker_clustering.py),
+// so the event loop only packs the vectors and waits for the labels.
+const CLUSTERING_TIMEOUT_MS = Number(process.env.CLUSTERING_TIMEOUT_MS ?? 2000);
 
 export async function buildClusters(search_result: (MediaUnit & { embedding: Vector })[]): Promise<number[] | undefined> {
+    if (search_result.length === 0) return [];
     try {
-        // 2. Prepare the data for Python
-        // Extract just the embeddings from your search results
-        console.log('call here')
-        const embeddings_list = search_result.map(item => item.embedding.toJSON());
-
-        // Convert the JavaScript array of arrays into a NumPy array
-        console.log('embeddings_list', embeddings_list.length, embeddings_list[0]);
-        const embeddings_np = np.array(embeddings_list);
-        console.log("Created NumPy array with shape:", embeddings_np.shape.toString());
-
-        // 3. Initialize and run the AffinityPropagation model
-        // We use python.kw for named arguments.
-        // `preference` can be adjusted. A smaller value (more negative) leads to fewer clusters.
-        // `damping` helps with convergence.
-        const clustering_model = AffinityPropagation(
-            python.kw`damping=${0.9}`,
-            python.kw`random_state=${0}`
-        );
-
-        console.log("Fitting the clustering model...");
-        clustering_model.fit(embeddings_np);
-
-        // 4. Retrieve cluster labels from the model
-        // .labels_ is a NumPy array of cluster assignments for each embedding.
-        const labels_py = clustering_model.labels_.tolist();
-
-        // ---- CRITICAL STEP: Move data from Python back to JavaScript ----
-        // Use .valueOf() to get a native JavaScript array of numbers
-        const labels_js = labels_py.valueOf() as number[];
-        console.log(`Clustering complete. Found ${new Set(labels_js).size} clusters.`);
-        return labels_js
+        // Pack all embeddings into one float32 buffer, sent as a binary segment of the job
+        const dimension = search_result[0]!.embedding.length;
+        const packed = new Float32Array(search_result.length * dimension);
+        search_result.forEach((item, i) => packed.set(item.embedding.toArray() as Float32Array, i * dimension));
+
+        const job = {
+            embeddings: new Uint8Array(packed.buffer),
+            dimension,
+            dtype: 'float32',
+        };
+        const result = await new Promise<Record<string, any> | undefined>((resolve) => {
+            const timeout = setTimeout(() => resolve(undefined), CLUSTERING_TIMEOUT_MS);
+            sendJob(job, "clustering", {
+                cont: (result) => {
+                    clearTimeout(timeout);
+                    resolve(result);
+                },
+                // Not worth running once the caller stopped waiting
+                deadline_ms: CLUSTERING_TIMEOUT_MS,
+            });
+        });
+
+        if (!result?.labels) {
+            console.error("Clustering failed:", result?.error ?? `no result within ${CLUSTERING_TIMEOUT_MS}ms`);
+            return;
+        }
+        console.log(`Clustering complete. Found ${result.n_clusters} clusters (${result.method}).`);
+        return result.labels as number[];
     } catch (error) {
         console.error("Clustering failed:", error);
-        // You could send an error chunk to the client if this is a critical failure
-        // sendJsonChunk({ error: "Failed to process clusters." });
     }
 }
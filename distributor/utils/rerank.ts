@@ -0,0 +1,45 @@
+import { sendJob } from "..";
+import type { MediaUnit } from "../conn";
+
+// Second search stage: the indexer's "rerank" worker (indexer/worker_rerank.py)
+// scores (query, candidate) pairs with a cross-encoder.
+export const RERANK = process.env.Z_RERANK === '1';
+// Only the best vector-search candidates are reranked, the rest keep their order behind them
+export const RERANK_CANDIDATES = Number(process.env.Z_RERANK_CANDIDATES ?? 50);
+// Score the frames instead of their descriptions (slower, but independent of description quality)
+const RERANK_IMAGES = process.env.Z_RERANK_IMAGES === '1';
+const RERANK_TIMEOUT_MS = Number(process.env.RERANK_TIMEOUT_MS ?? 2000);
+
+/**
+ * Returns the candidates ordered by reranker score (best first) with a _score
+ * each, or undefined when reranking is off or the worker did not answer in time.
+ */
+export async function rerankResults<T extends MediaUnit>(query: string, candidates: T[]): Promise<(T & { _score: number })[] | undefined> {
+    if (!RERANK || candidates.length === 0) return;
+    const job = {
+        query,
+        candidates: candidates.map(item => RERANK_IMAGES
+            ? { id: item.id, filepath: item.path }
+            : { id: item.id, text: item.description ?? '' }),
+    };
+    const result = await new Promise<Record<string, any> | undefined>((resolve) => {
+        const timeout = setTimeout(() => resolve(undefined), RERANK_TIMEOUT_MS);
+        sendJob(job, "rerank", {
+            cont: (result) => {
+                clearTimeout(timeout);
+                resolve(result);
+            },
+            // Not worth running once the caller stopped waiting
+            deadline_ms: RERANK_TIMEOUT_MS,
+        });
+    });
+
+    const scores = result?.scores as number[] | undefined;
+    if (!scores || scores.length !== candidates.length) {
+        console.error("Reranking failed:", result?.error ?? `no result within ${RERANK_TIMEOUT_MS}ms`);
+        return;
+    }
+    return candidates
+        .map((item, i) => ({ ...item, _score: scores[i]! }))
+        .sort((a, b) => b._score - a._score);
+}
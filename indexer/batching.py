@@ -0,0 +1,67 @@
+import os
+
+def token_budget_buckets(lengths: list[int], max_batch_tokens: int) -> list[list[int]]:
+    """
+    Groups input indices into buckets of similar token length.
+
+    Inputs are sorted by length and a bucket is cut as soon as its padded size
+    (items * longest item) would exceed max_batch_tokens. An input longer than
+    the budget gets a bucket of its own.
+
+    Args:
+        lengths: The token length of each input.
+        max_batch_tokens: The padded token budget of a single model call,
+            0 or less disables bucketing (one bucket in input order).
+
+    Returns:
+        A list of buckets, each a list of indices into lengths.
+    """
+    if max_batch_tokens <= 0:
+        return [list(range(len(lengths)))] if lengths else []
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets = []
+    current = []
+    for i in order:
+        # Sorted ascending, so the new item is the longest in the bucket
+        if current and (len(current) + 1) * lengths[i] > max_batch_tokens:
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current:
+        buckets.append(current)
+    return buckets
+
+def padding_efficiency(lengths: list[int], buckets: list[list[int]]) -> float:
+    """Real tokens divided by padded tokens over all buckets."""
+    real_tokens = sum(lengths)
+    padded_tokens = sum(len(bucket) * max(lengths[i] for i in bucket) for bucket in buckets if bucket)
+    return real_tokens / padded_tokens if padded_tokens else 1.0
+
+def run_in_buckets(lengths: list[int], max_batch_tokens: int, run_bucket, label: str) -> list:
+    """
+    Runs run_bucket(indices) once per length bucket and restores the original order.
+
+    run_bucket must return one result per index, in the order of the indices it
+    was given.
+    """
+    buckets = token_budget_buckets(lengths, max_batch_tokens)
+    results = [None] * len(lengths)
+    for bucket in buckets:
+        for i, result in zip(bucket, run_bucket(bucket)):
+            results[i] = result
+
+    if lengths:
+        unbucketed = padding_efficiency(lengths, [list(range(len(lengths)))])
+        print(f"[{label}] {len(lengths)} inputs in {len(buckets)} bucket(s), "
+              f"padding efficiency {padding_efficiency(lengths, buckets):.0%} (single batch: {unbucketed:.0%})")
+    return results
+
+def max_batch_tokens_from_env(env_name: str, default: int) -> int:
+    value = os.environ.get(env_name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        print(f"Warning: Could not parse {env_name} from environment variable. Value: '{value}'")
+        return default
@@ -0,0 +1,287 @@
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import random
+import time
+
+import websockets
+
+from message import create_message, parse_ws_message, supported_codecs
+from metrics import stage
+from ws_client_handler import client_handler
+
+"""
+Offline load-generation benchmark for the indexer workers.
+
+A local stand-in distributor speaks the message.py protocol and batches jobs
+like distributor/index.ts (sendJob/workerFlush): a batch is flushed when it
+reaches max_batch_size, or max_latency_ms after the last job arrived, and
+only while the worker has credits (see flow_control.py). The
+worker side is the real ws_client_handler.client_handler, driving either a
+deterministic stub model or a real worker module.
+
+Per job it records:
+  queueing delay   arrival -> batch flushed to the worker
+  latency          arrival -> output received from the worker
+
+Usage:
+  # Stub model, 2 ms per item + 10 ms per batch, Poisson arrivals at 300 jobs/s
+  python -m benchmark --rate 300 --jobs 3000 --per-item-ms 2 --batch-ms 10
+  # Bursts of 50 jobs, sweep the batching parameters
+  python -m benchmark --arrivals bursty --burst-size 50 --batch-sizes 8,32,64 --latencies-ms 50,200,1000
+  # Real embedding model on text inputs, pipelined client_handler
+  PIPELINE_DEPTH=4 python -m benchmark --worker worker_embedding --input '{"text": "person near entrance"}'
+  # Replay recorded arrival offsets (seconds, one per line)
+  python -m benchmark --trace arrivals.txt
+"""
+
+def poisson_arrivals(rate: float, jobs: int, seed: int) -> list[float]:
+    """Arrival offsets in seconds with exponential inter-arrival times."""
+    rng = random.Random(seed)
+    offsets = []
+    now = 0.0
+    for _ in range(jobs):
+        now += rng.expovariate(rate)
+        offsets.append(now)
+    return offsets
+
+def bursty_arrivals(rate: float, jobs: int, burst_size: int, seed: int) -> list[float]:
+    """Bursts of burst_size simultaneous jobs, the bursts themselves arriving as a Poisson process."""
+    rng = random.Random(seed)
+    offsets = []
+    now = 0.0
+    while len(offsets) < jobs:
+        now += rng.expovariate(rate / burst_size)
+        offsets.extend([now] * min(burst_size, jobs - len(offsets)))
+    return offsets
+
+def trace_arrivals(path: str) -> list[float]:
+    """Arrival offsets in seconds from a file, one per line."""
+    with open(path) as f:
+        return sorted(float(line) for line in f if line.strip())
+
+def stub_workload(per_item_ms: float, batch_ms: float, dimension: int = 8):
+    """
+    A deterministic stand-in model: each batch takes batch_ms + per_item_ms per
+    input and every input gets an embedding derived from its id.
+    """
+    def worker_function(data):
+        inputs = data.get('inputs', [])
+        with stage("model"):
+            time.sleep((batch_ms + per_item_ms * len(inputs)) / 1000)
+        outputs = []
+        for inp in inputs:
+            digest = hashlib.sha256(str(inp.get('id')).encode('utf-8')).digest()
+            outputs.append({"id": inp.get('id'), "embedding": [b / 255 for b in digest[:dimension]]})
+        return create_message({"output": outputs})
+
+    return worker_function
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+class StandInDistributor:
+    """
+    Accepts one worker connection and gathers jobs for it the way the
+    distributor does, recording the timings of every job.
+    """
+
+    def __init__(self, max_batch_size: int, max_latency_ms: int, codec: str = "json"):
+        self.max_batch_size = max_batch_size
+        self.max_latency_ms = max_latency_ms
+        self.codec = codec
+        self.worker = None
+        self.registered = asyncio.Event()
+        self.gathered = []
+        self.send_timeout = None
+        self.credits = None
+        self.flush_due = False
+        self.arrived = {}
+        self.flushed = {}
+        self.finished = {}
+        self.batch_sizes = []
+        self.all_done = asyncio.Event()
+        self.expected = 0
+
+    async def handler(self, websocket):
+        # The worker is cancelled at the end of a run, which closes its socket abruptly
+        with contextlib.suppress(websockets.exceptions.ConnectionClosed):
+            await self.receive(websocket)
+
+    async def receive(self, websocket):
+        async for message in websocket:
+            header = parse_ws_message(message).get("header", {})
+            if header.get("type") == "i_am_worker":
+                # Registered with the sweep's batching parameters
+                self.worker = websocket
+                self.credits = header.get("worker_config", {}).get("slots")
+                if "codecs" in header:
+                    self.codec = self.codec if self.codec in header["codecs"] else "json"
+                    await websocket.send(create_message({"type": "codec", "codec": self.codec}, codec="json"))
+                self.registered.set()
+                continue
+            if header.get("type") == "partial":
+                continue
+            if header.get("type") == "credit":
+                self.credits = (self.credits or 0) + header.get("credits", 1)
+                if header.get("max_batch_size"):
+                    self.max_batch_size = header["max_batch_size"]
+                if self.flush_due or len(self.gathered) >= self.max_batch_size:
+                    self.flush()
+                continue
+            now = time.monotonic()
+            for output in header.get("output", []):
+                self.finished.setdefault(output.get("id"), now)
+            if len(self.finished) >= self.expected:
+                self.all_done.set()
+
+    def send_job(self, job: dict):
+        self.arrived[job["id"]] = time.monotonic()
+        self.gathered.append(job)
+        if self.send_timeout is not None:
+            self.send_timeout.cancel()
+            self.send_timeout = None
+        if len(self.gathered) >= self.max_batch_size:
+            self.flush()
+            return
+        self.send_timeout = asyncio.get_running_loop().call_later(self.max_latency_ms / 1000, self.flush)
+
+    def flush(self):
+        self.send_timeout = None
+        while self.gathered:
+            if self.credits is not None and self.credits <= 0:
+                self.flush_due = True
+                return
+            inputs = self.gathered[:self.max_batch_size]
+            del self.gathered[:self.max_batch_size]
+            if self.credits is not None:
+                self.credits -= 1
+            now = time.monotonic()
+            for job in inputs:
+                self.flushed[job["id"]] = now
+            self.batch_sizes.append(len(inputs))
+            asyncio.ensure_future(self.worker.send(create_message({"inputs": inputs}, codec=self.codec)))
+        self.flush_due = False
+
+    def report(self) -> dict:
+        ids = [job_id for job_id in self.arrived if job_id in self.finished]
+        latencies = [(self.finished[i] - self.arrived[i]) * 1000 for i in ids]
+        queueing = [(self.flushed[i] - self.arrived[i]) * 1000 for i in ids]
+        elapsed = max(self.finished.values(), default=0) - min(self.arrived.values(), default=0)
+        histogram = {}
+        for size in self.batch_sizes:
+            histogram[size] = histogram.get(size, 0) + 1
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_latency_ms": self.max_latency_ms,
+            "completed": len(ids),
+            "dropped": len(self.arrived) - len(ids),
+            "items_per_s": len(ids) / elapsed if elapsed > 0 else 0.0,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "queueing_p50_ms": percentile(queueing, 50),
+            "queueing_p99_ms": percentile(queueing, 99),
+            "mean_batch_size": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else 0.0,
+            "batch_size_histogram": dict(sorted(histogram.items())),
+        }
+
+async def run_once(workload, arrivals: list[float], make_input, max_batch_size: int,
+                   max_latency_ms: int, timeout_s: float, codec: str = "json") -> dict:
+    """Serves one worker on a free local port, replays the arrivals and returns the report."""
+    distributor = StandInDistributor(max_batch_size, max_latency_ms, codec)
+    distributor.expected = len(arrivals)
+    async with websockets.serve(distributor.handler, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        os.environ["BACKEND_WS_URL"] = f"ws://127.0.0.1:{port}"
+        os.environ.setdefault("WORKER_SECRET", "benchmark")
+        worker = asyncio.create_task(client_handler(
+            workload, {"worker_type": "benchmark", "max_batch_size": max_batch_size, "max_latency_ms": max_latency_ms}
+        ))
+        try:
+            await asyncio.wait_for(distributor.registered.wait(), timeout_s)
+            start = time.monotonic()
+            for index, offset in enumerate(arrivals):
+                delay = start + offset - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                distributor.send_job({"id": f"job_{index}", **make_input(index)})
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(distributor.all_done.wait(), timeout_s)
+        finally:
+            worker.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await worker
+    return distributor.report()
+
+def load_workload(args):
+    if args.worker:
+        import importlib
+        return importlib.import_module(args.worker).load_ai_model()
+    return stub_workload(args.per_item_ms, args.batch_ms)
+
+def print_table(reports: list[dict]):
+    columns = ("max_batch_size", "max_latency_ms", "items_per_s", "p50_ms", "p95_ms", "p99_ms",
+               "queueing_p50_ms", "queueing_p99_ms", "mean_batch_size", "dropped")
+    print(" ".join(f"{column:>15}" for column in columns))
+    for report in reports:
+        print(" ".join(
+            f"{report[column]:>15.1f}" if isinstance(report[column], float) else f"{report[column]:>15}"
+            for column in columns
+        ))
+    for report in reports:
+        print(f"Batch sizes (bs={report['max_batch_size']}, latency={report['max_latency_ms']}ms): {report['batch_size_histogram']}")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Throughput and latency of a worker behind a stand-in distributor.")
+    parser.add_argument("--worker", help="Worker module to benchmark (e.g. worker_embedding), default is the stub model")
+    parser.add_argument("--input", default='{"text": "person near entrance"}', help="JSON fields of every job")
+    parser.add_argument("--per-item-ms", type=float, default=2.0, help="Stub model cost per input")
+    parser.add_argument("--batch-ms", type=float, default=10.0, help="Stub model fixed cost per batch")
+    parser.add_argument("--arrivals", choices=("poisson", "bursty"), default="poisson")
+    parser.add_argument("--trace", help="File of arrival offsets in seconds, overrides --arrivals")
+    parser.add_argument("--rate", type=float, default=200.0, help="Mean jobs per second")
+    parser.add_argument("--burst-size", type=int, default=32)
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-sizes", default="32", help="Comma-separated max_batch_size values to sweep")
+    parser.add_argument("--latencies-ms", default="200", help="Comma-separated max_latency_ms values to sweep")
+    parser.add_argument("--timeout-s", type=float, default=300.0, help="Per-run wait for registration and completion")
+    parser.add_argument("--codec", choices=supported_codecs(), default="json", help="Codec to select if the worker offers it")
+    parser.add_argument("--json", help="Also write the reports to this file")
+    parser.add_argument("--verbose", action="store_true", help="Keep the worker's per-batch logging")
+    args = parser.parse_args()
+
+    if args.trace:
+        arrivals = trace_arrivals(args.trace)
+    elif args.arrivals == "bursty":
+        arrivals = bursty_arrivals(args.rate, args.jobs, args.burst_size, args.seed)
+    else:
+        arrivals = poisson_arrivals(args.rate, args.jobs, args.seed)
+    fields = json.loads(args.input)
+    workload = load_workload(args)
+
+    reports = []
+    for max_batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+        for max_latency_ms in [int(l) for l in args.latencies_ms.split(",")]:
+            print(f"[Benchmark] {len(arrivals)} jobs, max_batch_size={max_batch_size}, max_latency_ms={max_latency_ms}...")
+            with open(os.devnull, "w") as devnull, contextlib.ExitStack() as stack:
+                if not args.verbose:
+                    stack.enter_context(contextlib.redirect_stdout(devnull))
+                report = await run_once(workload, arrivals, lambda _: dict(fields), max_batch_size,
+                                        max_latency_ms, args.timeout_s, args.codec)
+            reports.append(report)
+
+    print_table(reports)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, indent=2)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,94 @@
+import argparse
+import contextlib
+import random
+import statistics
+import time
+
+import numpy as np
+
+import message
+from embedding_encoding import json_output
+
+"""
+Micro-benchmark of the wire codecs on realistic worker results.
+
+Encodes each result with create_message and decodes it with parse_ws_message,
+like a worker and the distributor's parser would, and reports the median time
+and the message size per codec. 'json (stdlib)' is the fallback, 'json
+(orjson)' the same wire format through orjson, 'msgpack' the binary codec.
+
+Usage:
+  python -m benchmark_codecs --batch-size 64 --dimension 2048
+"""
+
+WORDS = ("person", "walks", "past", "a", "parked", "car", "near", "the", "entrance", "wearing",
+         "dark", "jacket", "while", "holding", "phone", "and", "looking", "toward", "street", "light")
+
+def embedding_batch(batch_size: int, dimension: int) -> dict:
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((batch_size, dimension)).astype(np.float32)
+    return {"output": [json_output(f"frame_{i}", vector, None, "float32") for i, vector in enumerate(vectors)]}
+
+def description_batch(batch_size: int, words: int) -> dict:
+    rng = random.Random(0)
+    return {"output": [
+        {"id": f"frame_{i}", "description": " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."}
+        for i in range(batch_size)
+    ]}
+
+@contextlib.contextmanager
+def json_implementation(use_orjson: bool):
+    """Temporarily hides orjson from message.py to measure the stdlib fallback."""
+    saved = message.orjson
+    if not use_orjson:
+        message.orjson = None
+    try:
+        yield
+    finally:
+        message.orjson = saved
+
+def codec_variants() -> list:
+    variants = [("json (stdlib)", "json", False)]
+    if message.orjson is not None:
+        variants.append(("json (orjson)", "json", True))
+    if message.msgpack is not None:
+        variants.append(("msgpack", "msgpack", True))
+    return variants
+
+def measure(result: dict, codec: str, repeats: int) -> dict:
+    encode_times = []
+    decode_times = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        encoded = message.create_message(result, codec=codec)
+        encode_times.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        message.parse_ws_message(encoded)
+        decode_times.append(time.perf_counter() - started)
+    return {
+        "encode_ms": statistics.median(encode_times) * 1000,
+        "decode_ms": statistics.median(decode_times) * 1000,
+        "bytes": len(encoded),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode/decode time and size of worker results per codec.")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--dimension", type=int, default=2048, help="Embedding dimension")
+    parser.add_argument("--words", type=int, default=120, help="Words per description")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    workloads = [
+        (f"embeddings {args.batch_size}x{args.dimension}", embedding_batch(args.batch_size, args.dimension)),
+        (f"descriptions {args.batch_size}x{args.words} words", description_batch(args.batch_size, args.words)),
+    ]
+    print(f"{'workload':>30} {'codec':>14} {'encode_ms':>10} {'decode_ms':>10} {'bytes':>10}")
+    for workload_name, result in workloads:
+        for codec_name, codec, use_orjson in codec_variants():
+            with json_implementation(use_orjson):
+                stats = measure(result, codec, args.repeats)
+            print(f"{workload_name:>30} {codec_name:>14} {stats['encode_ms']:>10.2f} {stats['decode_ms']:>10.2f} {stats['bytes']:>10}")
+
+if __name__ == "__main__":
+    main()
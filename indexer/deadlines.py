@@ -0,0 +1,43 @@
+import time
+
+"""
+Per-job deadlines.
+
+The distributor may stamp a job with "deadline", the Unix time in
+milliseconds after which nobody will read its result (the HTTP caller timed
+out or disconnected), and a "priority" it batches by. Inputs found past their
+deadline are not preprocessed or run; their output is only
+{"id": ..., "status": "expired"}.
+
+Inputs are checked where they wait: when client_handler hands a batch to the
+model (after the socket and the local pipeline queue), and in worker_host
+when a batch gets its turn on the shared model thread.
+"""
+
+EXPIRED = "expired"
+
+def split_expired(data: dict, now_ms: float | None = None) -> tuple[dict, list]:
+    """Returns the batch without its expired inputs, and the expired inputs."""
+    now_ms = time.time() * 1000 if now_ms is None else now_ms
+    live = []
+    expired = []
+    for inp in data.get('inputs', []):
+        deadline = inp.get('deadline')
+        if isinstance(deadline, (int, float)) and deadline <= now_ms:
+            expired.append(inp)
+        else:
+            live.append(inp)
+    if not expired:
+        return data, []
+    return {**data, "inputs": live}, expired
+
+def drop_expired(workload, expired: list) -> list:
+    """
+    Returns an expired output for each expired input. A workload with a
+    discard(data) attribute is told about them, so it can free what it
+    prefetched for them on arrival.
+    """
+    discard = getattr(workload, "discard", None)
+    if discard is not None:
+        discard({"inputs": expired})
+    return [{"id": inp.get('id'), "status": EXPIRED} for inp in expired]
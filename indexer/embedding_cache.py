@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+"""
+Content-keyed embedding cache with an in-memory LRU and an optional
+memory-mapped on-disk tier.
+
+DISK LAYOUT (EMBEDDING_CACHE_DIR):
+  meta.json     {"dimension": 2048, "capacity": 100000, "producer": {...}}
+  vectors.f32   float32 memmap of shape (capacity, dimension), used as a ring buffer
+  index.log     append-only "<key> <slot>" lines, replayed on startup
+
+"producer" names what computed the vectors (model, backend, dtype). Vectors of
+an int8 or half precision backend are close to the float32 ones, not equal, so
+a disk tier written by a different producer is started empty.
+"""
+
+def normalize_text(text: str) -> str:
+    """Normalizes unicode and whitespace so trivially different queries share a key."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def text_cache_key(model_id: str, task: str, prompt_name: str, text: str) -> str:
+    raw = json.dumps([model_id, task, prompt_name, normalize_text(text)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def image_cache_key(model_id: str, task: str, image_bytes: bytes) -> str:
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    raw = json.dumps([model_id, task, "image", digest])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class DiskTier:
+    """Fixed-capacity ring buffer of vectors in a memory-mapped file."""
+
+    def __init__(self, directory: str, capacity: int, producer: dict | None = None):
+        self.directory = directory
+        self.capacity = capacity
+        self.producer = producer
+        self.vectors = None
+        self.slot_keys = [None] * capacity
+        self.index = {}
+        self.next_slot = 0
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, "meta.json")
+        if not os.path.exists(meta_path):
+            return
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if not os.path.exists(os.path.join(directory, "vectors.f32")):
+            print("[Embedding Cache] Disk tier vectors.f32 is missing, starting empty.")
+            self._reset()
+        elif meta.get("capacity") != capacity:
+            print(f"[Embedding Cache] Disk tier capacity changed ({meta.get('capacity')} -> {capacity}), starting empty.")
+            self._reset()
+        elif meta.get("producer") != producer:
+            print(f"[Embedding Cache] Disk tier was written by {meta.get('producer')}, not {producer}, starting empty.")
+            self._reset()
+        else:
+            self._open(meta["dimension"], "r+")
+            self._replay()
+
+    def _reset(self):
+        # The old index would point into the vectors file that put_many recreates
+        for name in ("meta.json", "index.log"):
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _open(self, dimension: int, mode: str):
+        self.vectors = np.memmap(
+            os.path.join(self.directory, "vectors.f32"),
+            dtype=np.float32, mode=mode, shape=(self.capacity, dimension)
+        )
+
+    def _assign(self, key: str, slot: int):
+        evicted = self.slot_keys[slot]
+        if evicted is not None and self.index.get(evicted) == slot:
+            del self.index[evicted]
+        self.slot_keys[slot] = key
+        self.index[key] = slot
+
+    def _replay(self):
+        log_path = os.path.join(self.directory, "index.log")
+        if not os.path.exists(log_path):
+            return
+        lines = 0
+        with open(log_path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) != 2:
+                    # Torn write from a crash, ignore the line
+                    continue
+                slot = int(parts[1])
+                self._assign(parts[0], slot)
+                self.next_slot = (slot + 1) % self.capacity
+                lines += 1
+        if lines > 2 * self.capacity:
+            self._compact()
+        print(f"[Embedding Cache] Loaded {len(self.index)} vectors from disk tier at {self.directory}.")
+
+    def _compact(self):
+        # Rewrite live entries oldest first so the ring position survives the next replay
+        order = sorted(self.index.items(), key=lambda item: (item[1] - self.next_slot) % self.capacity)
+        log_path = os.path.join(self.directory, "index.log")
+        with open(log_path + ".tmp", "w") as f:
+            for key, slot in order:
+                f.write(f"{key} {slot}\n")
+        os.replace(log_path + ".tmp", log_path)
+
+    def get(self, key: str):
+        slot = self.index.get(key)
+        if slot is None or self.vectors is None:
+            return None
+        return np.array(self.vectors[slot])
+
+    def put_many(self, keys: list, vectors: list):
+        if self.vectors is None:
+            dimension = int(vectors[0].shape[-1])
+            self._open(dimension, "w+")
+            with open(os.path.join(self.directory, "meta.json"), "w") as f:
+                json.dump({"dimension": dimension, "capacity": self.capacity, "producer": self.producer}, f)
+        lines = []
+        for key, vector in zip(keys, vectors):
+            if key in self.index or vector.shape[-1] != self.vectors.shape[1]:
+                continue
+            slot = self.next_slot
+            self.vectors[slot] = vector
+            self._assign(key, slot)
+            self.next_slot = (slot + 1) % self.capacity
+            lines.append(f"{key} {slot}\n")
+        if lines:
+            self.vectors.flush()
+            # Vectors are flushed before the index points at them
+            with open(os.path.join(self.directory, "index.log"), "a") as f:
+                f.writelines(lines)
+
+class EmbeddingCache:
+    """
+    Thread-safe LRU of embedding vectors keyed by content.
+
+    Lookups check memory first, then the optional disk tier. Disk hits are
+    promoted back into memory.
+    """
+
+    def __init__(self, max_entries: int, disk_dir: str | None = None, disk_entries: int = 100000, producer: dict | None = None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk = DiskTier(disk_dir, disk_entries, producer) if disk_dir else None
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+    def _remember(self, key: str, vector: np.ndarray):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def lookup(self, keys: list) -> list:
+        """Returns the cached vector for each key, or None on a miss."""
+        found = []
+        with self.lock:
+            for key in keys:
+                vector = self.entries.get(key)
+                if vector is not None:
+                    self.entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                elif self.disk is not None and (vector := self.disk.get(key)) is not None:
+                    self._remember(key, vector)
+                    self.stats["disk_hits"] += 1
+                else:
+                    self.stats["misses"] += 1
+                found.append(vector)
+        return found
+
+    def store(self, keys: list, vectors: list):
+        if not keys:
+            return
+        with self.lock:
+            for key, vector in zip(keys, vectors):
+                self._remember(key, vector)
+            if self.disk is not None:
+                self.disk.put_many(keys, vectors)
+
+    def get_or_compute(self, keys: list, compute) -> list:
+        """
+        Returns one vector per key, calling compute(indices) only for the misses.
+
+        Duplicate keys inside one call are computed once. compute receives the
+        indices (into keys) to encode and must return vectors in the same order.
+        """
+        vectors = self.lookup(keys)
+        first_index = {}
+        for i, (key, vector) in enumerate(zip(keys, vectors)):
+            if vector is None and key not in first_index:
+                first_index[key] = i
+        if first_index:
+            miss_indices = list(first_index.values())
+            computed = compute(miss_indices)
+            self.store([keys[i] for i in miss_indices], computed)
+            by_key = {keys[i]: vector for i, vector in zip(miss_indices, computed)}
+            vectors = [vector if vector is not None else by_key[key] for key, vector in zip(keys, vectors)]
+        return vectors
+
+def cache_from_env(producer: dict | None = None) -> EmbeddingCache | None:
+    """
+    Builds the cache from EMBEDDING_CACHE_SIZE (entries in memory, 0 disables),
+    EMBEDDING_CACHE_DIR (optional disk tier) and EMBEDDING_CACHE_DISK_SIZE.
+    producer describes the model computing the vectors, see DISK LAYOUT.
+    """
+    try:
+        max_entries = int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000"))
+        disk_entries = int(os.environ.get("EMBEDDING_CACHE_DISK_SIZE", "100000"))
+    except ValueError:
+        print("Warning: Could not parse EMBEDDING_CACHE_SIZE / EMBEDDING_CACHE_DISK_SIZE, cache disabled.")
+        return None
+    if max_entries <= 0:
+        return None
+    disk_dir = os.environ.get("EMBEDDING_CACHE_DIR") or None
+    print(f"[Embedding Cache] {max_entries} entries in memory, disk tier: {disk_dir or 'disabled'}")
+    return EmbeddingCache(max_entries, disk_dir, disk_entries, producer)
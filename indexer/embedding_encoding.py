@@ -0,0 +1,99 @@
+import numpy as np
+
+from message import create_message
+
+"""
+Output dimension and encoding of embedding vectors.
+
+jina-embeddings-v4 is trained Matryoshka-style, so a prefix of the vector is
+itself a usable embedding once renormalized.
+
+ENCODINGS:
+  float32   4 bytes per value
+  float16   2 bytes per value
+  int8      1 byte per value, value ~= int8 * scale (one scale per vector)
+  binary    1 bit per value (sign), packed big-endian bit order like np.packbits
+"""
+
+ENCODINGS = ("float32", "float16", "int8", "binary")
+
+def truncate(vector: np.ndarray, dimension: int | None) -> np.ndarray:
+    """Keeps the first dimension values and renormalizes to unit length."""
+    vector = np.asarray(vector, dtype=np.float32)
+    if dimension is not None and dimension < vector.shape[-1]:
+        vector = vector[:dimension]
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+def quantize_int8(vector: np.ndarray) -> tuple[np.ndarray, float]:
+    """Symmetric per-vector int8 quantization, returns the values and their scale."""
+    max_abs = float(np.max(np.abs(vector))) if vector.size else 0.0
+    scale = max_abs / 127 if max_abs > 0 else 1.0
+    return np.clip(np.round(vector / scale), -127, 127).astype(np.int8), scale
+
+def encode(vector: np.ndarray, dtype: str) -> tuple[np.ndarray, dict]:
+    """
+    Encodes a (truncated) float vector.
+
+    Returns the encoded array and the extra output fields needed to decode it.
+    """
+    if dtype == "float32":
+        return vector.astype('<f4'), {}
+    if dtype == "float16":
+        return vector.astype('<f2'), {}
+    if dtype == "int8":
+        values, scale = quantize_int8(vector)
+        return values, {"scale": scale}
+    if dtype == "binary":
+        return np.packbits(vector > 0), {}
+    raise ValueError(f"Unsupported embedding dtype '{dtype}', expected one of {ENCODINGS}")
+
+def decode(values: np.ndarray, dtype: str, dimension: int, scale: float = 1.0) -> np.ndarray:
+    """Inverse of encode, back to a float32 vector (binary decodes to +-1/sqrt(dimension))."""
+    if dtype in ("float32", "float16"):
+        return values.astype(np.float32)
+    if dtype == "int8":
+        return values.astype(np.float32) * scale
+    if dtype == "binary":
+        signs = np.unpackbits(values)[:dimension].astype(np.float32) * 2 - 1
+        return signs / np.sqrt(dimension)
+    raise ValueError(f"Unsupported embedding dtype '{dtype}', expected one of {ENCODINGS}")
+
+def json_output(result_id, vector: np.ndarray, dimension: int | None, dtype: str) -> dict:
+    """Builds a JSON output entry; non-float32 encodings carry their dtype and dimension."""
+    vector = truncate(vector, dimension)
+    if dtype == "float32":
+        return {"id": result_id, "embedding": vector.tolist()}
+    values, extra = encode(vector, dtype)
+    return {"id": result_id, "embedding": values.tolist(), "dtype": dtype, "dimension": int(vector.shape[-1]), **extra}
+
+def pack_embeddings(ids: list, embeddings: list, dimensions: list, dtypes: list, annotations: dict | None = None) -> bytes | str:
+    """
+    Packs embeddings into a single binary message.
+
+    The header's packed_embedding holds the dtype and dimension of the first
+    output; outputs that differ carry their own 'dtype' / 'dimension'. int8
+    outputs carry their 'scale'. 'offset' is the byte offset into the buffer.
+    annotations maps an id to extra fields of its output (e.g. 'reused_from').
+    """
+    if not embeddings:
+        return create_message({"output": []})
+
+    outputs = []
+    chunks = []
+    offset = 0
+    default = None
+    for result_id, vector, dimension, dtype in zip(ids, embeddings, dimensions, dtypes):
+        vector = truncate(vector, dimension)
+        values, extra = encode(vector, dtype)
+        packing = {"dtype": dtype, "dimension": int(vector.shape[-1])}
+        if default is None:
+            default = packing
+        output = {"id": result_id, "offset": offset, **extra, **(annotations or {}).get(result_id, {})}
+        if packing != default:
+            output.update(packing)
+        outputs.append(output)
+        chunks.append(values.tobytes())
+        offset += values.nbytes
+
+    return create_message({"output": outputs, "packed_embedding": default}, b"".join(chunks))
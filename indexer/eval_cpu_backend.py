@@ -0,0 +1,147 @@
+"""
+Parity and latency of inference backends (see inference_backend.py) against a
+reference backend, on the host that will run them.
+
+Each backend loads the model exactly like its worker does:
+  embedding        cosine similarity of every query and passage vector to the
+                   reference backend's; latency of single-query encodes (the
+                   search path) and of one passage batch
+  text_generation  exact-match rate of the generated JSON arrays against the
+                   reference (decoding is greedy, so a faithful backend repeats
+                   them), the share that parse at all, and latency per prompt
+                   (one keystroke of autocomplete)
+
+Usage:
+  # The first backend is the reference
+  python -m eval_cpu_backend --worker embedding --backends cpu,cpu_int8
+  python -m eval_cpu_backend --worker text_generation --backends cpu,cpu_int8 --prompts keywords.txt
+"""
+
+import argparse
+import gc
+import os
+import time
+
+import numpy as np
+
+DEFAULT_QUERIES = [
+    "person near entrance",
+    "red car in the parking lot",
+    "person carrying a ladder",
+    "delivery truck at the loading dock",
+]
+DEFAULT_PASSAGES = [
+    "A person in a dark jacket walks past a parked car near the main entrance.",
+    "Two workers unload boxes from a white delivery truck at the loading dock.",
+    "An empty hallway with fluorescent lights and a closed fire door at the end.",
+    "A cyclist waits at a crosswalk while a bus passes in the rain.",
+]
+DEFAULT_PROMPTS = ["person", "car", "backpack", "door", "bicycle"]
+
+def read_lines(path: str | None, default: list) -> list:
+    if not path:
+        return default
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def timed(fn, repeats: int) -> tuple:
+    """Returns the last result of fn and its durations in seconds."""
+    result = None
+    durations = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = fn()
+        durations.append(time.perf_counter() - started)
+    return result, durations
+
+def percentiles_ms(durations: list) -> str:
+    p50, p95 = np.percentile(durations, [50, 95]) * 1000
+    return f"p50 {p50:.1f}ms p95 {p95:.1f}ms"
+
+def normalized(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def run_embedding(backend: str, queries: list, passages: list, repeats: int) -> dict:
+    import worker_embedding
+
+    os.environ["EMBEDDING_BACKEND"] = backend
+    model = worker_embedding.load_model()
+
+    def encode(texts: list, prompt_name: str) -> np.ndarray:
+        embeddings = model.encode_text(texts=texts, task="retrieval", prompt_name=prompt_name, return_numpy=True)
+        return np.asarray(embeddings, dtype=np.float32)
+
+    # Once untimed, lazy initialization is not what we measure
+    encode(queries[:1], "query")
+    query_durations = []
+    query_vectors = []
+    for query in queries:
+        vector, durations = timed(lambda: encode([query], "query"), repeats)
+        query_vectors.append(vector[0])
+        query_durations.extend(durations)
+    passage_vectors, passage_durations = timed(lambda: encode(passages, "passage"), repeats)
+
+    del model
+    gc.collect()
+    return {
+        "vectors": normalized(np.concatenate([np.stack(query_vectors), passage_vectors])),
+        "latency": f"query {percentiles_ms(query_durations)}, "
+                   f"{len(passages)} passages {np.median(passage_durations) * 1000:.1f}ms",
+    }
+
+def run_text_generation(backend: str, prompts: list, repeats: int) -> dict:
+    import worker_text_generation
+    from message import parse_ws_message
+
+    os.environ["TEXT_GENERATION_BACKEND"] = backend
+    # Every repeat must reach the model
+    os.environ["TEXT_GENERATION_CACHE_SIZE"] = "0"
+    worker_function = worker_text_generation.make_worker_function(worker_text_generation.load_model())
+
+    def generate(prompt: str) -> list:
+        result = worker_function({"inputs": [{"id": "eval", "prompt": prompt}]})
+        return parse_ws_message(result)["header"]["output"][0]["generated_texts"]
+
+    generate(prompts[0])
+    generated = []
+    all_durations = []
+    for prompt in prompts:
+        texts, durations = timed(lambda: generate(prompt), repeats)
+        generated.append(texts)
+        all_durations.extend(durations)
+
+    del worker_function
+    gc.collect()
+    return {"generated": generated, "latency": f"prompt {percentiles_ms(all_durations)}"}
+
+def main():
+    parser = argparse.ArgumentParser(description="Parity and latency of inference backends.")
+    parser.add_argument("--worker", choices=("embedding", "text_generation"), required=True)
+    parser.add_argument("--backends", default="cpu,cpu_int8", help="comma-separated, the first is the reference")
+    parser.add_argument("--queries", help="file of query texts, one per line")
+    parser.add_argument("--passages", help="file of passage texts, one per line")
+    parser.add_argument("--prompts", help="file of text generation keywords, one per line")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    backends = args.backends.split(",")
+    reference = None
+    for backend in backends:
+        print(f"--- {backend} ---")
+        if args.worker == "embedding":
+            result = run_embedding(
+                backend, read_lines(args.queries, DEFAULT_QUERIES), read_lines(args.passages, DEFAULT_PASSAGES), args.repeats
+            )
+            reference = reference or result
+            similarities = np.sum(result["vectors"] * reference["vectors"], axis=1)
+            parity = f"cosine to {backends[0]}: mean {similarities.mean():.4f} min {similarities.min():.4f}"
+        else:
+            result = run_text_generation(backend, read_lines(args.prompts, DEFAULT_PROMPTS), args.repeats)
+            reference = reference or result
+            exact = np.mean([texts == ref for texts, ref in zip(result["generated"], reference["generated"])])
+            parsed = np.mean([bool(texts) for texts in result["generated"]])
+            parity = f"exact match with {backends[0]}: {exact:.0%}, valid JSON: {parsed:.0%}"
+        print(f"{backend:>10}  {parity}  |  {result['latency']}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Offline evaluation of reduced-dimension and quantized embedding outputs.
+
+For every (dimension, dtype) pair the corpus vectors are truncated, renormalized,
+encoded and decoded exactly like worker_embedding does. Queries stay float32 at
+the same dimension (asymmetric search). Recall@k is the overlap of the top-k
+results with the top-k of the full float32 vectors.
+
+Usage:
+  # Precomputed vectors, queries sampled from the corpus
+  python -m eval_embedding_compression --embeddings corpus.npy
+  # Encode texts with jina-embeddings-v4 first
+  python -m eval_embedding_compression --texts passages.txt --query-texts queries.txt
+"""
+
+import argparse
+
+import numpy as np
+
+from embedding_encoding import ENCODINGS, decode, encode, truncate
+
+def compress(vectors: np.ndarray, dimension: int, dtype: str) -> np.ndarray:
+    """Returns the vectors as the distributor would see them after decoding."""
+    decoded = []
+    for vector in vectors:
+        truncated = truncate(vector, dimension)
+        values, extra = encode(truncated, dtype)
+        decoded.append(decode(values, dtype, truncated.shape[-1], extra.get("scale", 1.0)))
+    return np.stack(decoded)
+
+def top_k(queries: np.ndarray, corpus: np.ndarray, k: int, exclude: np.ndarray | None) -> np.ndarray:
+    scores = queries @ corpus.T
+    if exclude is not None:
+        # Queries sampled from the corpus must not find themselves
+        scores[np.arange(len(queries)), exclude] = -np.inf
+    return np.argsort(-scores, axis=1)[:, :k]
+
+def recall_at_k(reference: np.ndarray, candidate: np.ndarray) -> float:
+    k = reference.shape[1]
+    return float(np.mean([len(set(r) & set(c)) / k for r, c in zip(reference, candidate)]))
+
+def encode_texts(paths: list, prompt_names: list) -> list:
+    from transformers import AutoModel
+    import torch
+    from worker_embedding import MODEL_ID
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = AutoModel.from_pretrained(MODEL_ID, trust_remote_code=True, torch_dtype=torch.float16).to(device)
+    encoded = []
+    for path, prompt_name in zip(paths, prompt_names):
+        with open(path) as f:
+            texts = [line.strip() for line in f if line.strip()]
+        embeddings = model.encode_text(texts=texts, task="retrieval", prompt_name=prompt_name, return_numpy=True)
+        encoded.append(np.asarray(embeddings, dtype=np.float32))
+    return encoded
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k loss of truncated / quantized embeddings.")
+    parser.add_argument("--embeddings", help=".npy file of corpus vectors (N x D)")
+    parser.add_argument("--query-embeddings", help=".npy file of query vectors (Q x D)")
+    parser.add_argument("--texts", help="Text file with one passage per line, encoded with the model")
+    parser.add_argument("--query-texts", help="Text file with one query per line, encoded with the model")
+    parser.add_argument("--num-queries", type=int, default=200, help="Queries sampled from the corpus if none are given")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dimensions", default="128,256,512,1024,2048")
+    parser.add_argument("--dtypes", default=",".join(ENCODINGS))
+    args = parser.parse_args()
+
+    if args.texts:
+        paths = [args.texts] + ([args.query_texts] if args.query_texts else [])
+        encoded = encode_texts(paths, ["passage", "query"][:len(paths)])
+        corpus = encoded[0]
+        queries = encoded[1] if len(encoded) > 1 else None
+    elif args.embeddings:
+        corpus = np.load(args.embeddings).astype(np.float32)
+        queries = np.load(args.query_embeddings).astype(np.float32) if args.query_embeddings else None
+    else:
+        parser.error("Provide --embeddings or --texts")
+
+    exclude = None
+    if queries is None:
+        rng = np.random.default_rng(0)
+        exclude = rng.choice(len(corpus), size=min(args.num_queries, len(corpus)), replace=False)
+        queries = corpus[exclude]
+
+    full_corpus = np.stack([truncate(vector, None) for vector in corpus])
+    full_queries = np.stack([truncate(vector, None) for vector in queries])
+    reference = top_k(full_queries, full_corpus, args.k, exclude)
+
+    print(f"Corpus: {corpus.shape}, queries: {queries.shape[0]}, k={args.k}")
+    print(f"{'dimension':>9} {'dtype':>8} {'bytes/vec':>9} {f'recall@{args.k}':>9}")
+    for dimension in [int(d) for d in args.dimensions.split(",") if int(d) <= corpus.shape[1]]:
+        truncated_queries = np.stack([truncate(vector, dimension) for vector in queries])
+        for dtype in args.dtypes.split(","):
+            candidate = top_k(truncated_queries, compress(corpus, dimension, dtype), args.k, exclude)
+            item_bytes = encode(truncate(corpus[0], dimension), dtype)[0].nbytes
+            print(f"{dimension:>9} {dtype:>8} {item_bytes:>9} {recall_at_k(reference, candidate):>9.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import os
+import sys
+
+"""
+Worker capacity and credit-based flow control.
+
+A worker advertises its capacity in 'i_am_worker':
+  max_batch_size     inputs per batch (MAX_BATCH_SIZE)
+  max_batch_tokens   token budget of a batch (MAX_BATCH_TOKENS, or the worker's own bucketing budget)
+  max_batch_pixels   pixel budget of a batch (MAX_BATCH_PIXELS)
+  slots              batches it can hold at once (BATCH_SLOTS, default PIPELINE_DEPTH + 1)
+
+The distributor starts with 'slots' credits, spends one per batch it sends
+and only sends while it has credits. After the results of a model call the
+worker grants the credits back with {"type": "credit", "credits": n}, so
+batches wait in the distributor (where an idle replica can take them) rather
+than in the socket of a busy worker.
+
+With AUTOTUNE_BATCH_SIZE=1 the credit message also carries an updated
+max_batch_size, adjusted from the observed model-call latency
+(TARGET_BATCH_MS) and GPU memory headroom (MIN_MEMORY_HEADROOM).
+"""
+
+CAPACITY_ENV = (
+    ("max_batch_size", "MAX_BATCH_SIZE"),
+    ("max_batch_tokens", "MAX_BATCH_TOKENS"),
+    ("max_batch_pixels", "MAX_BATCH_PIXELS"),
+    ("slots", "BATCH_SLOTS"),
+)
+
+def _parse_number(env_name: str, cast):
+    value = os.environ.get(env_name)
+    if not value:
+        return None
+    try:
+        return cast(value)
+    except (ValueError, TypeError):
+        print(f"Warning: Could not parse {env_name} from environment variable. Value: '{value}'")
+        return None
+
+def capacity_from_env(heavy_ai_workload, pipeline_depth: int) -> dict:
+    """
+    Builds the advertised capacity: defaults, then the workload's own 'capacity'
+    attribute (e.g. its token budget), then environment overrides.
+    """
+    capacity = {"slots": pipeline_depth + 1}
+    capacity.update(getattr(heavy_ai_workload, "capacity", {}))
+    for key, env_name in CAPACITY_ENV:
+        value = _parse_number(env_name, int)
+        if value is not None:
+            capacity[key] = value
+    return capacity
+
+def memory_headroom() -> float | None:
+    """Free fraction of GPU memory, or None without a loaded CUDA torch."""
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return None
+    free, total = torch.cuda.mem_get_info()
+    return free / total
+
+class BatchSizeTuner:
+    """
+    Additive-increase / multiplicative-decrease of the advertised max_batch_size.
+
+    Shrinks by a quarter when a model call exceeds target_ms or GPU memory
+    headroom drops below min_headroom. Grows by an eighth (at least one) when
+    a nearly full batch finished well under target_ms, since latency of small
+    batches says little about larger ones.
+    """
+
+    def __init__(self, initial: int, target_ms: float, max_size: int, min_headroom: float):
+        self.size = initial
+        self.target_ms = target_ms
+        self.max_size = max_size
+        self.min_headroom = min_headroom
+
+    def observe(self, batch_size: int, model_ms: float, headroom: float | None = None) -> int | None:
+        """Returns the new max_batch_size, or None if it stays the same."""
+        low_memory = headroom is not None and headroom < self.min_headroom
+        if model_ms > self.target_ms or low_memory:
+            size = max(1, int(self.size * 0.75))
+        elif batch_size >= 0.8 * self.size and model_ms < 0.8 * self.target_ms:
+            size = min(self.max_size, self.size + max(1, self.size // 8))
+        else:
+            return None
+        if size == self.size:
+            return None
+        self.size = size
+        return size
+
+def tuner_from_env(config: dict) -> BatchSizeTuner | None:
+    """AUTOTUNE_BATCH_SIZE=1 enables the tuner, starting from the advertised max_batch_size."""
+    if os.environ.get("AUTOTUNE_BATCH_SIZE", "0") not in ("1", "true"):
+        return None
+    # 32 is the distributor's default when a worker does not advertise one
+    initial = config.get("max_batch_size", 32)
+    target_ms = _parse_number("TARGET_BATCH_MS", float) or 1000.0
+    max_size = _parse_number("AUTOTUNE_MAX_BATCH_SIZE", int) or 256
+    min_headroom = _parse_number("MIN_MEMORY_HEADROOM", float) or 0.1
+    print(f"[Main] Autotuning max_batch_size from {initial}, target {target_ms}ms per model call.")
+    config["max_batch_size"] = initial
+    return BatchSizeTuner(initial, target_ms, max_size, min_headroom)
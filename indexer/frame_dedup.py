@@ -0,0 +1,156 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from metrics import count, stage
+
+"""
+Near-duplicate frame suppression for mostly static cameras.
+
+Image inputs that carry a "source" (the distributor sends the frame's
+media_id) are reduced to a 64-bit difference hash: the frame shrunk to a 9x8
+grayscale thumbnail, one bit per left/right brightness step. When the hash is
+within FRAME_DEDUP_MAX_DISTANCE bits of one of the last FRAME_DEDUP_HISTORY
+computed frames of the same source, the model is skipped and that frame's
+result is returned, marked with "reused_from": <id of the reference input>.
+
+Reused frames never become references themselves, so a slowly drifting scene
+is compared against a frame that actually went through the model.
+
+Dedup is off unless FRAME_DEDUP_HISTORY is set. It trades recall for model
+time: 64 bits describe the whole frame, so a person or vehicle entering a
+small part of an otherwise static view can stay within the distance, and that
+frame then gets the previous frame's embedding or description and is missing
+from searches for it. Enable it only where that loss is acceptable, and prefer
+a small FRAME_DEDUP_MAX_DISTANCE (0-2) for cameras whose events are small.
+
+  FRAME_DEDUP_HISTORY       computed frames kept per source (default 0, disabled; 8 is a reasonable value)
+  FRAME_DEDUP_MAX_DISTANCE  Hamming distance in bits that counts as the same frame (default 4)
+  FRAME_DEDUP_MAX_SOURCES   sources kept, least recently seen are dropped (default 1024)
+
+Counts go to the batch metrics as frames_hashed / frames_reused.
+"""
+
+HASH_WIDTH = 9
+HASH_HEIGHT = 8
+
+def frame_hash(image) -> int:
+    """Difference hash of a file path, encoded bytes (e.g. a message segment) or PIL image."""
+    if not isinstance(image, Image.Image):
+        with Image.open(image if isinstance(image, str) else io.BytesIO(image)) as opened:
+            # JPEG decodes at 1/8 scale, far more than the thumbnail needs
+            opened.draft("L", (HASH_WIDTH * 8, HASH_HEIGHT * 8))
+            return frame_hash(opened.convert("L"))
+    pixels = list(image.convert("L").resize((HASH_WIDTH, HASH_HEIGHT), Image.Resampling.BILINEAR).getdata())
+    bits = 0
+    for row in range(HASH_HEIGHT):
+        for column in range(HASH_WIDTH - 1):
+            left = pixels[row * HASH_WIDTH + column]
+            bits = (bits << 1) | (left > pixels[row * HASH_WIDTH + column + 1])
+    return bits
+
+class FrameDeduplicator:
+    """Thread-safe bounded history of recent frame hashes and their results, per source."""
+
+    def __init__(self, history: int, max_distance: int, max_sources: int):
+        self.history = history
+        self.max_distance = max_distance
+        self.max_sources = max_sources
+        # source -> list of [hash, id, result], most recently used last
+        self.sources = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"frames": 0, "reused": 0}
+
+    def _nearest(self, entries: list, frame_hash: int):
+        best = None
+        for entry in entries:
+            distance = (entry[0] ^ frame_hash).bit_count()
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, entry)
+        return best[1] if best is not None else None
+
+    def _remember(self, source, frame_hash: int, result_id, result):
+        entries = self.sources.setdefault(source, [])
+        self.sources.move_to_end(source)
+        entries.append([frame_hash, result_id, result])
+        del entries[:-self.history]
+        while len(self.sources) > self.max_sources:
+            self.sources.popitem(last=False)
+
+    def get_or_compute(self, ids: list, sources: list, images: list, compute) -> tuple[list, list]:
+        """
+        Returns (results, reused_from), calling compute(indices) only for frames
+        that match no recent frame of their source.
+
+        sources holds a hashable source key per input, or None for inputs that
+        are never deduplicated. Near-duplicates inside one batch are computed
+        once. compute receives indices into images and returns results in the
+        same order. reused_from holds the reference id of reused results, None
+        for computed ones.
+        """
+        hashes = [None] * len(images)
+        with stage("preprocess"):
+            for i, (source, image) in enumerate(zip(sources, images)):
+                if source is not None:
+                    hashes[i] = frame_hash(image)
+
+        results = [None] * len(images)
+        reused_from = [None] * len(images)
+        # Index of the computed frame in this batch that a near-duplicate waits for
+        waiting = {}
+        compute_indices = []
+        pending = {}
+        with self.lock:
+            for i, (source, hashed) in enumerate(zip(sources, hashes)):
+                if source is None:
+                    compute_indices.append(i)
+                    continue
+                entries = self.sources.get(source, [])
+                match = self._nearest(entries, hashed)
+                if match is not None:
+                    # Keep the reference at the recent end so it is not evicted
+                    entries.remove(match)
+                    entries.append(match)
+                    self.sources.move_to_end(source)
+                    results[i], reused_from[i] = match[2], match[1]
+                    continue
+                match = self._nearest(pending.get(source, []), hashed)
+                if match is not None:
+                    waiting[i] = match[1]
+                    continue
+                pending.setdefault(source, []).append([hashed, i])
+                compute_indices.append(i)
+
+        computed = compute(compute_indices) if compute_indices else []
+        with self.lock:
+            for i, result in zip(compute_indices, computed):
+                results[i] = result
+                if sources[i] is not None:
+                    self._remember(sources[i], hashes[i], ids[i], result)
+            for i, reference in waiting.items():
+                results[i], reused_from[i] = results[reference], ids[reference]
+
+            hashed_count = sum(source is not None for source in sources)
+            reused_count = sum(reference is not None for reference in reused_from)
+            self.stats["frames"] += hashed_count
+            self.stats["reused"] += reused_count
+        count("frames_hashed", hashed_count)
+        count("frames_reused", reused_count)
+        return results, reused_from
+
+def dedup_from_env() -> FrameDeduplicator | None:
+    """Builds the deduplicator from FRAME_DEDUP_HISTORY (0 disables), FRAME_DEDUP_MAX_DISTANCE and FRAME_DEDUP_MAX_SOURCES."""
+    try:
+        history = int(os.environ.get("FRAME_DEDUP_HISTORY", "0"))
+        max_distance = int(os.environ.get("FRAME_DEDUP_MAX_DISTANCE", "4"))
+        max_sources = int(os.environ.get("FRAME_DEDUP_MAX_SOURCES", "1024"))
+    except ValueError:
+        print("Warning: Could not parse FRAME_DEDUP_HISTORY / FRAME_DEDUP_MAX_DISTANCE / FRAME_DEDUP_MAX_SOURCES, frame dedup disabled.")
+        return None
+    if history <= 0:
+        return None
+    print(f"[Frame Dedup] {history} frames per source, max distance {max_distance} bits, {max_sources} sources")
+    return FrameDeduplicator(history, max_distance, max_sources)
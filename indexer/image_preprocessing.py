@@ -0,0 +1,91 @@
+import concurrent.futures
+import io
+import multiprocessing
+import os
+import threading
+
+from PIL import Image
+
+def load_image(path, longest_edge: int | None = None) -> Image.Image:
+    """
+    Decodes an image to RGB and optionally shrinks it so its longest edge fits.
+
+    path is a file path, or the encoded bytes of an inline image (e.g. a
+    message segment). Runs in a pool process, so it must stay a picklable
+    top-level function.
+    """
+    with Image.open(path if isinstance(path, str) else io.BytesIO(path)) as image:
+        if longest_edge:
+            # Lets the JPEG decoder skip detail we are about to throw away
+            image.draft("RGB", (longest_edge, longest_edge))
+        image = image.convert("RGB")
+    if longest_edge:
+        image.thumbnail((longest_edge, longest_edge), Image.Resampling.LANCZOS)
+    return image
+
+class ImagePreloader:
+    """
+    Decodes and resizes images in a process pool, off the inference thread.
+
+    prefetch() starts work for a batch as soon as it is received, get() waits
+    for the decoded images when the batch reaches the model. With the pipelined
+    client_handler the next batch is decoded while the current one runs.
+    """
+
+    def __init__(self, longest_edge: int | None, max_workers: int):
+        self.longest_edge = longest_edge
+        # spawn: the parent has already initialized CUDA, forking it is unsafe
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def prefetch(self, paths: list):
+        with self.lock:
+            for path in paths:
+                if path not in self.pending:
+                    self.pending[path] = self.pool.submit(load_image, path, self.longest_edge)
+
+    def get(self, paths: list) -> list:
+        """Returns the decoded image for each path, in order."""
+        self.prefetch(paths)
+        with self.lock:
+            futures = {path: self.pending.pop(path) for path in dict.fromkeys(paths)}
+        return [futures[path].result() for path in paths]
+
+    def discard(self, paths: list):
+        """Drops prefetched images that turned out not to be needed."""
+        with self.lock:
+            for path in paths:
+                future = self.pending.pop(path, None)
+                if future is not None:
+                    future.cancel()
+
+def resolve_images(sources: list, preloader: ImagePreloader | None, longest_edge: int | None) -> list:
+    """
+    Turns image sources into model inputs, in order.
+
+    Inline images (bytes-like, from message segments) are decoded here, no disk
+    read involved. Paths come from the preloader, or are left for the model to
+    open when there is none.
+    """
+    paths = [source for source in sources if isinstance(source, str)]
+    loaded = dict(zip(paths, preloader.get(paths))) if preloader is not None and paths else {}
+    return [
+        loaded.get(source, source) if isinstance(source, str) else load_image(source, longest_edge)
+        for source in sources
+    ]
+
+def preloader_from_env(longest_edge: int | None) -> ImagePreloader | None:
+    """Builds a preloader with IMAGE_PRELOAD_WORKERS processes, 0 disables it."""
+    default_workers = min(4, os.cpu_count() or 1)
+    try:
+        max_workers = int(os.environ.get("IMAGE_PRELOAD_WORKERS", default_workers))
+    except ValueError:
+        print("Warning: Could not parse IMAGE_PRELOAD_WORKERS, image preloading disabled.")
+        return None
+    if max_workers <= 0:
+        return None
+    print(f"[Image Preload] {max_workers} decode processes, longest edge: {longest_edge or 'original'}")
+    return ImagePreloader(longest_edge, max_workers)
@@ -0,0 +1,60 @@
+import os
+
+"""
+Inference backends of the torch workers.
+
+<PREFIX>_BACKEND (e.g. EMBEDDING_BACKEND), or INFERENCE_BACKEND for every
+worker, selects:
+  auto       cuda if available, otherwise cpu (the default)
+  cuda       half precision on the GPU
+  cpu        float32 eager PyTorch
+  cpu_int8   float32 with the nn.Linear weights dynamically quantized to int8;
+             activations are quantized per batch at runtime, so no calibration
+             data is needed. Linear layers are most of a transformer's CPU time.
+
+Compare a CPU backend against the reference with eval_cpu_backend.py
+(embedding cosine similarity, exact-match rate of generated JSON, latency).
+"""
+
+BACKENDS = ("auto", "cuda", "cpu", "cpu_int8")
+
+def backend_from_env(prefix: str) -> str:
+    """The configured backend of a worker, with 'auto' resolved."""
+    name = f"{prefix}_BACKEND" if os.environ.get(f"{prefix}_BACKEND") else "INFERENCE_BACKEND"
+    backend = os.environ.get(name, "auto")
+    if backend not in BACKENDS:
+        print(f"Warning: Could not parse {name} from environment variable. Value: '{backend}'")
+        backend = "auto"
+    if backend == "auto":
+        import torch
+        backend = "cuda" if torch.cuda.is_available() else "cpu"
+    return backend
+
+def backend_device(backend: str) -> str:
+    return "cuda" if backend == "cuda" else "cpu"
+
+def backend_dtype(backend: str, cuda_dtype=None):
+    """float32 on the CPU backends (dynamic quantization starts from float32), cuda_dtype or float16 on the GPU."""
+    import torch
+    if backend == "cuda":
+        return cuda_dtype or torch.float16
+    return torch.float32
+
+def quantize_int8(model, skip: tuple = ("lora_",)):
+    """
+    Replaces the nn.Linear modules of a CPU model in place with dynamically
+    quantized int8 ones. Modules whose qualified name contains one of skip keep
+    float weights, e.g. PEFT LoRA adapters, which read their weights directly.
+    """
+    import torch
+
+    engines = torch.backends.quantized.supported_engines
+    # x86/fbgemm on Intel and AMD, qnnpack on ARM edge boxes
+    torch.backends.quantized.engine = next((engine for engine in ("x86", "fbgemm", "qnnpack") if engine in engines), engines[0])
+    names = {
+        name for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and not any(part in name for part in skip)
+    }
+    torch.ao.quantization.quantize_dynamic(model, names, dtype=torch.qint8, inplace=True)
+    print(f"Quantized {len(names)} linear layers to int8 ({torch.backends.quantized.engine}).")
+    return model
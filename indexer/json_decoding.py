@@ -0,0 +1,179 @@
+import torch
+from transformers import LogitsProcessor, StoppingCriteria
+
+"""
+Structure-aware generation of JSON string arrays, for worker_text_generation.
+
+JsonArrayStop ends a sequence as soon as its first top-level JSON array is
+closed, instead of letting it run on to max_new_tokens. Once every sequence of
+a batch has stopped, generate() returns. A stopped sequence only receives
+padding until then. It does not check what the array holds: on its own, an
+array of any length (or of non-strings) ends the sequence.
+
+JsonArrayLogitsProcessor (constrained decoding) masks every token that would
+leave the grammar
+  ws* "[" ws* string (ws* "," ws* string){items - 1} ws* "]"
+so the output always parses as exactly `items` strings. Once the array is
+closed only end-of-sequence tokens remain. There are only a few dozen grammar
+states; JsonArrayGrammar.precompute builds the allowed-token mask of each one
+at load time, as every mask walks the whole vocabulary.
+"""
+
+WHITESPACE = " \t\n\r"
+ESCAPES = '"\\/bfnrt'
+
+# Grammar states, paired with the number of finished strings
+START, OPEN, STRING, ESCAPE, AFTER_STRING, COMMA, DONE = range(7)
+
+def array_closed(text: str) -> bool:
+    """True once the first top-level JSON array in text is closed, brackets in strings don't count."""
+    start = text.find("[")
+    if start < 0:
+        return False
+    depth = 0
+    in_string = False
+    escaped = False
+    for char in text[start:]:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "[":
+            depth += 1
+        elif char == "]":
+            depth -= 1
+            if depth == 0:
+                return True
+    return False
+
+def advance(state: tuple, text: str, items: int) -> tuple | None:
+    """Feeds text through the string array grammar; None if it leaves the grammar."""
+    mode, count = state
+    for char in text:
+        if mode == START:
+            if char == "[":
+                mode = OPEN
+            elif char not in WHITESPACE:
+                return None
+        elif mode in (OPEN, COMMA):
+            if char == '"':
+                mode = STRING
+            elif char not in WHITESPACE:
+                return None
+        elif mode == STRING:
+            if char == '"':
+                mode, count = AFTER_STRING, count + 1
+            elif char == "\\":
+                mode = ESCAPE
+            elif ord(char) < 0x20:
+                return None
+        elif mode == ESCAPE:
+            if char not in ESCAPES:
+                return None
+            mode = STRING
+        elif mode == AFTER_STRING:
+            if char == "," and count < items:
+                mode = COMMA
+            elif char == "]" and count == items:
+                mode = DONE
+            elif char not in WHITESPACE:
+                return None
+        else:
+            # Nothing may follow the closed array
+            return None
+    return mode, count
+
+def grammar_states(items: int) -> list:
+    """Every (mode, finished strings) state that advance() can reach."""
+    states = [(START, 0), (OPEN, 0)]
+    states += [(mode, count) for count in range(items) for mode in (STRING, ESCAPE)]
+    states += [(AFTER_STRING, count) for count in range(1, items + 1)]
+    states += [(COMMA, count) for count in range(1, items)]
+    return states + [(DONE, items)]
+
+def token_texts(tokenizer) -> list:
+    """
+    The text each token id adds when appended to other text, None for special
+    tokens. Decoding after an anchor token keeps leading spaces that decoding
+    a token alone drops.
+    """
+    special_ids = set(tokenizer.all_special_ids) | set(tokenizer.added_tokens_decoder)
+    anchor = tokenizer.encode("a", add_special_tokens=False)[-1:]
+    anchor_length = len(tokenizer.decode(anchor))
+    return [
+        None if token_id in special_ids else tokenizer.decode(anchor + [token_id])[anchor_length:]
+        for token_id in range(len(tokenizer))
+    ]
+
+class JsonArrayStop(StoppingCriteria):
+    """Stops each sequence once its generated text holds a closed JSON array."""
+
+    def __init__(self, tokenizer, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stopped = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.stopped is None:
+            self.stopped = [False] * input_ids.shape[0]
+        for row in range(input_ids.shape[0]):
+            if not self.stopped[row]:
+                text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+                self.stopped[row] = array_closed(text)
+        return torch.tensor(self.stopped, dtype=torch.bool, device=input_ids.device)
+
+class JsonArrayGrammar:
+    """Allowed-token masks of the string array grammar for one tokenizer, shared by all generate() calls."""
+
+    def __init__(self, tokenizer, eos_token_ids: list, items: int):
+        self.texts = token_texts(tokenizer)
+        self.eos_token_ids = eos_token_ids
+        self.items = items
+        self.masks = {}
+
+    def precompute(self, vocab_size: int, device):
+        """Builds the mask of every grammar state, so no generate() call walks the vocabulary."""
+        for state in grammar_states(self.items):
+            self.mask(state, vocab_size, device)
+
+    def mask(self, state: tuple, vocab_size: int, device) -> torch.BoolTensor:
+        key = (state, vocab_size, str(device))
+        if key not in self.masks:
+            allowed = torch.zeros(vocab_size, dtype=torch.bool)
+            if state[0] == DONE:
+                allowed[[token_id for token_id in self.eos_token_ids if token_id < vocab_size]] = True
+            else:
+                allowed[[
+                    token_id for token_id, text in enumerate(self.texts[:vocab_size])
+                    if text and advance(state, text, self.items) is not None
+                ]] = True
+            self.masks[key] = allowed.to(device)
+        return self.masks[key]
+
+class JsonArrayLogitsProcessor(LogitsProcessor):
+    """Constrains each sequence of one generate() call to the string array grammar."""
+
+    def __init__(self, grammar: JsonArrayGrammar, prompt_length: int):
+        self.grammar = grammar
+        self.prompt_length = prompt_length
+        self.states = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if self.states is None:
+            self.states = [(START, 0)] * input_ids.shape[0]
+        masks = []
+        for row in range(input_ids.shape[0]):
+            state = self.states[row]
+            if input_ids.shape[1] > self.prompt_length and state[0] != DONE:
+                # The token chosen in the previous step, always allowed by its mask
+                token_id = int(input_ids[row, -1])
+                text = self.grammar.texts[token_id] if token_id < len(self.grammar.texts) else None
+                state = advance(state, text or "", self.grammar.items) or state
+                self.states[row] = state
+            masks.append(self.grammar.mask(state, scores.shape[-1], scores.device))
+        return scores.masked_fill(~torch.stack(masks), float("-inf"))
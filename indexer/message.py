@@ -1,82 +1,301 @@
+import contextvars
 import json
 import struct
 
-def create_message(header: dict, buffer: bytes = None) -> bytes | str:
+# Optional faster codecs, stdlib json is always available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+"""
+Wire codecs.
+
+Binary messages start with a 4-byte big-endian prefix whose top byte is the
+codec tag of the header and whose lower 24 bits are the header length:
+  0  JSON     (every message written before codecs existed, headers < 16 MB)
+  1  msgpack  (floats packed as float32)
+Text messages are always JSON. orjson is not a wire codec of its own: when
+installed it encodes and decodes the JSON codec faster.
+
+The worker lists its codecs in 'i_am_worker' and the distributor answers with
+{"type": "codec", "codec": ...}. Messages are self-describing, so parsing never
+needs the negotiated codec, only creating does. create_message uses the codec
+of the current context (see use_codec), or JSON.
+"""
+
+CODEC_TAGS = {"json": 0, "msgpack": 1}
+CODEC_NAMES = {tag: name for name, tag in CODEC_TAGS.items()}
+MAX_HEADER_LENGTH = 0xFFFFFF
+
+_current_codec = contextvars.ContextVar("codec", default="json")
+
+def supported_codecs() -> list:
+    """Wire codecs this process can speak, preferred first."""
+    return (["msgpack"] if msgpack is not None else []) + ["json"]
+
+def current_codec() -> str:
+    return _current_codec.get()
+
+def use_codec(codec: str, fn, *args, **kwargs):
+    """Calls fn with codec as the current codec, e.g. in an executor thread."""
+    token = _current_codec.set(codec)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _current_codec.reset(token)
+
+def dumps_json(value) -> str:
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_SERIALIZE_NUMPY).decode('utf-8')
+    return json.dumps(value)
+
+def loads_json(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def encode_header(header: dict, codec: str) -> bytes:
+    if codec == "msgpack":
+        return msgpack.packb(header, use_single_float=True)
+    return dumps_json(header).encode('utf-8')
+
+def decode_header(data, codec: str) -> dict:
+    if codec == "msgpack":
+        if msgpack is None:
+            raise TypeError("Received a msgpack message but msgpack is not installed")
+        return msgpack.unpackb(data, raw=False)
+    return loads_json(data)
+
+def create_message(header: dict, buffer: bytes = None, segments: dict = None, codec: str | None = None) -> bytes | str:
     """
     Creates a message for WebSocket communication.
 
-    If a buffer is provided, it creates a binary message with the format:
-    [4-byte header length][UTF-8 encoded header][buffer]
+    If a buffer or segments are provided, or the codec is not JSON, it creates a
+    binary message with the format:
+    [1-byte codec tag][3-byte header length][encoded header][buffer][segment]...
+
+    Named segments are described in header['segments'] as
+    {name: {"offset": <int>, "length": <int>}}, with offsets counted from the
+    end of the header (where the buffer starts), so byte offsets into the
+    buffer stay valid.
 
     Otherwise, it returns a JSON string of the header.
 
     Args:
         header: A dictionary to be sent as the message header.
-        buffer: An optional bytes object for the binary payload.
+        buffer: An optional bytes-like object for the binary payload.
+        segments: An optional dict of name -> bytes-like object.
+        codec: 'json' or 'msgpack', defaults to the codec of the current context.
 
     Returns:
         A bytes object for a binary message or a string for a JSON message.
     """
-    # Using a replacer is good practice if you need to handle complex types
-    # like large integers, but for standard JSON, a direct dump is fine.
-    header_string = json.dumps(header)
+    codec = codec or current_codec()
+    payload = [buffer] if buffer else []
+    if segments:
+        offset = len(buffer) if buffer else 0
+        described = {}
+        for name, segment in segments.items():
+            length = memoryview(segment).nbytes
+            described[name] = {"offset": offset, "length": length}
+            payload.append(segment)
+            offset += length
+        header = {**header, "segments": described}
 
-    if buffer:
-        header_buffer = header_string.encode('utf-8')
-        # Pack the header length as a 4-byte, big-endian, unsigned integer.
+    if payload or codec != "json":
+        header_buffer = encode_header(header, codec)
+        if len(header_buffer) > MAX_HEADER_LENGTH:
+            raise ValueError(f"Message header of {len(header_buffer)} bytes exceeds {MAX_HEADER_LENGTH} bytes")
+        # Pack the tag and header length as a 4-byte, big-endian, unsigned integer.
         # The '>' character specifies big-endian byte order.
         # The 'I' character specifies an unsigned int (4 bytes).
-        length_buffer = struct.pack('>I', len(header_buffer))
-        return length_buffer + header_buffer + buffer
+        length_buffer = struct.pack('>I', (CODEC_TAGS[codec] << 24) | len(header_buffer))
+        # A single join copies every part exactly once
+        return b"".join([length_buffer, header_buffer, *payload])
 
-    return header_string
+    return dumps_json(header)
 
-def parse_ws_message(message: bytes | str) -> dict:
+def parse_ws_message(message: bytes | bytearray | memoryview | str) -> dict:
     """
     Parses an incoming WebSocket message.
 
-    This function can handle both string (JSON) and binary messages.
+    This function can handle both string (JSON) and binary messages of any
+    codec. The buffer and segments of a binary message are memoryview slices of
+    the message, not copies; call bytes() on them to keep a copy beyond the
+    message.
 
     Args:
         message: The incoming message, either as a string or bytes.
 
     Returns:
-        A dictionary containing the header and an optional buffer.
+        A dictionary containing the header, an optional buffer and, if the header
+        describes any, the named segments.
         If an error occurs, it will be in the 'error' key.
     """
     try:
         if isinstance(message, str):
             # The message is a simple JSON string
-            header = json.loads(message)
+            header = loads_json(message)
             return {"header": header}
 
         # The message is binary, so we need to decode it
-        if not isinstance(message, bytes):
+        if not isinstance(message, (bytes, bytearray, memoryview)):
             raise TypeError("Binary message must be of type bytes")
+        view = memoryview(message)
 
-        # 1. Unpack the header length from the first 4 bytes.
+        # 1. Unpack the codec tag and header length from the first 4 bytes.
         # The '>' specifies big-endian, and 'I' specifies an unsigned int.
-        header_length = struct.unpack('>I', message[:4])[0]
+        prefix = struct.unpack_from('>I', view, 0)[0]
+        codec = CODEC_NAMES.get(prefix >> 24)
+        if codec is None:
+            raise TypeError(f"Unknown codec tag {prefix >> 24}")
+        header_length = prefix & MAX_HEADER_LENGTH
 
         # 2. Define the start and end points for the header and buffer
         header_start = 4
         buffer_start = header_start + header_length
 
-        # 3. Decode the header from a UTF-8 string to a dictionary
-        header_string = message[header_start:buffer_start].decode('utf-8')
-        header = json.loads(header_string)
+        # 3. Decode the header to a dictionary (the only copy made)
+        header = decode_header(bytes(view[header_start:buffer_start]), codec)
 
-        # 4. Extract the buffer if it exists
-        if len(message) > buffer_start:
-            buffer = message[buffer_start:]
-            return {"header": header, "buffer": buffer}
-        else:
-            return {"header": header}
+        # 4. Extract the buffer and segments if they exist
+        parsed = {"header": header, "codec": codec}
+        if len(view) > buffer_start:
+            parsed["buffer"] = view[buffer_start:]
+        if isinstance(header.get("segments"), dict):
+            parsed["segments"] = {
+                name: view[buffer_start + segment["offset"]:buffer_start + segment["offset"] + segment["length"]]
+                for name, segment in header["segments"].items()
+            }
+        return parsed
 
-    except (json.JSONDecodeError, struct.error, TypeError, UnicodeDecodeError) as e:
+    except (ValueError, struct.error, TypeError, UnicodeDecodeError, KeyError) as e:
         print(f"Failed to parse WebSocket message: {e}")
         return {"header": {}, "error": e}
 
+def resolve_segments(value, segments: dict):
+    """
+    Replaces every {"segment": <name>} reference in a decoded header with the
+    memoryview of that segment, e.g. an inline image input
+    {"id": ..., "image": {"segment": "frame_0"}}.
+    """
+    if isinstance(value, dict):
+        if len(value) == 1 and isinstance(value.get("segment"), str) and value["segment"] in segments:
+            return segments[value["segment"]]
+        return {key: resolve_segments(item, segments) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_segments(item, segments) for item in value]
+    return value
+
+def extract_segments(value, segments: dict):
+    """
+    The inverse of resolve_segments: moves every bytes-like value into segments
+    under a new name and replaces it with a {"segment": <name>} reference.
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        name = f"s{len(segments)}"
+        segments[name] = value
+        return {"segment": name}
+    if isinstance(value, dict):
+        return {key: extract_segments(item, segments) for key, item in value.items()}
+    if isinstance(value, list):
+        return [extract_segments(item, segments) for item in value]
+    return value
+
+def add_outputs(message: bytes | str, outputs: list) -> bytes | str:
+    """
+    Appends outputs that carry no payload (e.g. expired inputs) to a result
+    message, keeping its codec, buffer and segments as they are.
+    """
+    parsed = parse_ws_message(message)
+    header = {**parsed["header"], "output": parsed["header"].get("output", []) + outputs}
+    return create_message(header, parsed.get("buffer"), codec=parsed.get("codec", "json"))
+
+def merge_results(messages: list) -> bytes | str:
+    """
+    Concatenates the outputs of several result messages of one worker, e.g. of
+    the chunks of a batch, into one message with the codec of the first.
+
+    Packed embedding vectors are concatenated with their offsets shifted,
+    segments are renamed so their names stay unique.
+    """
+    parts = [parse_ws_message(message) for message in messages]
+    header = {key: value for key, value in parts[0]["header"].items() if key != "segments"}
+    # A part may carry no vectors at all, e.g. a chunk whose inputs all expired
+    packed_embedding = next((part["header"]["packed_embedding"] for part in parts if "packed_embedding" in part["header"]), None)
+    if packed_embedding is not None:
+        header["packed_embedding"] = packed_embedding
+    outputs = []
+    vectors = []
+    segments = {}
+    offset = 0
+    for part in parts:
+        packed = "packed_embedding" in part["header"]
+        renamed = {}
+        for name, segment in part.get("segments", {}).items():
+            renamed[name] = {"segment": f"s{len(segments)}"}
+            segments[renamed[name]["segment"]] = segment
+        for output in part["header"].get("output", []):
+            if renamed:
+                output = resolve_segments(output, renamed)
+            if packed and "offset" in output:
+                output = {**output, "offset": output["offset"] + offset}
+            outputs.append(output)
+        if packed and "buffer" in part:
+            # Segments, if any, follow the vectors
+            end = min((segment["offset"] for segment in part["header"].get("segments", {}).values()), default=len(part["buffer"]))
+            vectors.append(part["buffer"][:end])
+            offset += end
+    header["output"] = outputs
+    return create_message(header, b"".join(vectors) or None, segments or None, codec=parts[0].get("codec", "json"))
+
+def packed_item_bytes(dtype: str, dimension: int) -> int:
+    """Byte length of one packed embedding vector."""
+    if dtype == "binary":
+        return (dimension + 7) // 8
+    return dimension * {"float32": 4, "float16": 2, "int8": 1}[dtype]
+
+def select_packed_outputs(header: dict, buffer: bytes, outputs: list, codec: str | None = None) -> bytes:
+    """
+    Builds a packed embedding message holding only the given outputs.
+
+    A packed embedding message carries its vectors back to back in the buffer.
+    The header has the shape:
+    {"output": [{"id": ..., "offset": <byte offset>}, ...],
+     "packed_embedding": {"dtype": "float32" | "float16" | "int8" | "binary", "dimension": <int>}}
+    An output may override 'dtype' / 'dimension', int8 outputs also carry 'scale'.
+
+    Args:
+        header: The header of the original packed message.
+        buffer: The buffer of the original packed message.
+        outputs: A subset of header['output'] to keep.
+        codec: The codec of the new message, defaults to the current codec.
+
+    Returns:
+        A bytes object with the selected vectors re-packed and offsets rewritten.
+    """
+    default = header["packed_embedding"]
+    selected_outputs = []
+    selected_vectors = []
+    offset = 0
+    for output in outputs:
+        if "offset" not in output:
+            # No vector, e.g. an expired input
+            selected_outputs.append(output)
+            continue
+        item_bytes = packed_item_bytes(output.get("dtype", default["dtype"]), output.get("dimension", default["dimension"]))
+        start = output["offset"]
+        selected_vectors.append(buffer[start:start + item_bytes])
+        selected_outputs.append({**output, "offset": offset})
+        offset += item_bytes
+    selected_header = {**header, "output": selected_outputs}
+    return create_message(selected_header, b"".join(selected_vectors), codec=codec)
+
 # --- Example Usage ---
 
 if __name__ == "__main__":
@@ -101,4 +320,13 @@ if __name__ == "__main__":
 
     parsed_binary_message = parse_ws_message(created_binary_message)
     print(f"Parsed Binary Header: {parsed_binary_message.get('header')}")
-    print(f"Parsed Binary Buffer (first 10 bytes): {parsed_binary_message.get('buffer', b'')[:10]}...")
\ No newline at end of file
+    print(f"Parsed Binary Buffer (first 10 bytes): {bytes(parsed_binary_message.get('buffer', b'')[:10])}...")
+
+
+    # --- Test Case 3: Binary message with named segments ---
+    print("\n--- Testing Segmented Message ---")
+    segmented_header = {"inputs": [{"id": "a", "image": {"segment": "frame_a"}}]}
+    created_segmented_message = create_message(segmented_header, segments={"frame_a": image_buffer})
+    parsed_segmented_message = parse_ws_message(created_segmented_message)
+    print(f"Parsed Segments: { {name: bytes(view[:10]) for name, view in parsed_segmented_message['segments'].items()} }")
+    print(f"Resolved Inputs: {resolve_segments(parsed_segmented_message['header'], parsed_segmented_message['segments'])['inputs']}")
\ No newline at end of file
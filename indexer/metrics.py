@@ -0,0 +1,278 @@
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+Per-batch hot-path metrics for workers.
+
+client_handler opens a record per model call and times receive, parse and
+send. Worker functions time their own preprocess, model and serialize stages
+with stage(name), which finds the record of the running batch through a
+context variable, so worker signatures stay unchanged. Finished records are
+aggregated per worker_type and exposed on:
+
+  METRICS_PORT            Prometheus text format on http://127.0.0.1:<port>/metrics
+  METRICS_JSONL           One JSON line per batch, rotated to <path>.1 after
+                          METRICS_JSONL_MAX_BYTES (default 50 MB)
+
+Stage meanings:
+  receive    message arrival -> handed to the model (local queue wait)
+  parse      JSON decoding of the incoming message
+  preprocess input loading / tokenization inside the worker
+  model      the model call itself
+  serialize  building the result message
+  send       writing the result to the socket
+  schedule   waiting for the model thread shared with other roles (worker_host)
+  total      message arrival -> result sent, the latency a role's SLO is about
+
+A role (worker_type) may have a latency SLO, set with set_slo (SLO_MS, or
+"slo_ms" of a worker_host role). Batches whose total exceeds it are counted
+in indexer_slo_missed_total.
+
+Payloads are only logged at LOG_LEVEL=DEBUG, truncated to LOG_PAYLOAD_CHARS.
+"""
+
+STAGES = ("receive", "parse", "preprocess", "model", "serialize", "send", "schedule", "total")
+# Upper bounds in seconds of the stage duration histogram
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+_current_record = contextvars.ContextVar("batch_record", default=None)
+
+def _int_env(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Could not parse {name} from environment variable. Value: '{value}'")
+        return default
+
+DEBUG = os.environ.get("LOG_LEVEL", "INFO").upper() == "DEBUG"
+PAYLOAD_CHARS = _int_env("LOG_PAYLOAD_CHARS", 300)
+
+def debug_payload(label: str, payload):
+    """Prints a truncated payload, only at LOG_LEVEL=DEBUG so nothing is formatted otherwise."""
+    if not DEBUG:
+        return
+    if isinstance(payload, bytes):
+        text = f"<{len(payload)} bytes> {payload[:PAYLOAD_CHARS]!r}"
+    else:
+        text = payload if isinstance(payload, str) else repr(payload)
+        if len(text) > PAYLOAD_CHARS:
+            text = f"{text[:PAYLOAD_CHARS]}... <{len(text)} chars>"
+    print(f"{label}: {text}")
+
+def new_record(worker_type: str, message, arrived: float | None = None) -> dict:
+    """Starts the record of one incoming batch message."""
+    return {
+        "worker_type": worker_type,
+        "arrived": arrived if arrived is not None else time.monotonic(),
+        "batch_size": 0,
+        "bytes_in": len(message) if message is not None else 0,
+        "bytes_out": 0,
+        "queue_depth": 0,
+        "stages_ms": {},
+        "counts": {},
+    }
+
+def combine_records(records: list[dict]) -> dict:
+    """Merges the records of batches that run as one model call; receive counts from the first arrival."""
+    if len(records) == 1:
+        return records[0]
+    combined = new_record(records[0]["worker_type"], None, min(r["arrived"] for r in records))
+    for record in records:
+        combined["batch_size"] += record["batch_size"]
+        combined["bytes_in"] += record["bytes_in"]
+        for name, ms in record["stages_ms"].items():
+            combined["stages_ms"][name] = combined["stages_ms"].get(name, 0.0) + ms
+        for name, value in record["counts"].items():
+            combined["counts"][name] = combined["counts"].get(name, 0) + value
+    return combined
+
+def add_stage(record: dict | None, name: str, seconds: float):
+    if record is not None:
+        record["stages_ms"][name] = record["stages_ms"].get(name, 0.0) + seconds * 1000
+
+@contextmanager
+def stage(name: str, record: dict | None = None):
+    """Times a stage of the given record, or of the batch running in this context."""
+    record = record if record is not None else _current_record.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_stage(record, name, time.perf_counter() - started)
+
+def count(name: str, value: int = 1, record: dict | None = None):
+    """Adds to a counter of the given record, or of the batch running in this context (indexer_<name>_total)."""
+    record = record if record is not None else _current_record.get()
+    if record is not None and value:
+        record["counts"][name] = record["counts"].get(name, 0) + value
+
+def current_record() -> dict | None:
+    """The record of the batch running in this context, if any."""
+    return _current_record.get()
+
+def call_recorded(record: dict, workload, data):
+    """Runs the workload (in the executor thread) with record as the current batch."""
+    token = _current_record.set(record)
+    try:
+        return workload(data)
+    finally:
+        _current_record.reset(token)
+
+def memory_usage() -> dict:
+    """Resident CPU memory, and GPU memory if torch is already loaded with CUDA."""
+    usage = {}
+    try:
+        with open("/proc/self/statm") as f:
+            usage["cpu_rss_bytes"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        # ru_maxrss is in KiB on Linux (peak, not current, but better than nothing)
+        usage["cpu_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        usage["gpu_allocated_bytes"] = torch.cuda.memory_allocated()
+        usage["gpu_reserved_bytes"] = torch.cuda.memory_reserved()
+    return usage
+
+class MetricsRecorder:
+    """Aggregates finished batch records per worker_type and writes them to the configured sinks."""
+
+    def __init__(self, jsonl_path: str | None = None, jsonl_max_bytes: int = 50_000_000):
+        self.jsonl_path = jsonl_path
+        self.jsonl_max_bytes = jsonl_max_bytes
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.slos_ms = {}
+
+    def set_slo(self, worker_type: str, slo_ms: float):
+        """Sets the latency SLO of a worker_type, checked against the total of each batch."""
+        with self.lock:
+            self.slos_ms[worker_type] = slo_ms
+            self.gauges[("indexer_slo_ms", (("worker_type", worker_type),))] = slo_ms
+
+    def _add(self, name: str, labels: tuple, value: float):
+        self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, worker_type: str, stage_name: str, seconds: float):
+        key = (worker_type, stage_name)
+        histogram = self.histograms.setdefault(key, {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+    def finish(self, record: dict):
+        """Records a batch once its result has been sent."""
+        worker_type = record["worker_type"]
+        memory = memory_usage()
+        total_ms = (time.monotonic() - record["arrived"]) * 1000
+        with self.lock:
+            labels = (("worker_type", worker_type),)
+            self._add("indexer_batches_total", labels, 1)
+            self._add("indexer_items_total", labels, record["batch_size"])
+            self._add("indexer_payload_bytes_total", labels + (("direction", "in"),), record["bytes_in"])
+            self._add("indexer_payload_bytes_total", labels + (("direction", "out"),), record["bytes_out"])
+            self.gauges[("indexer_queue_depth", labels)] = record["queue_depth"]
+            self.gauges[("indexer_last_batch_size", labels)] = record["batch_size"]
+            for name, value in memory.items():
+                self.gauges[(f"indexer_{name}", ())] = value
+            for name, ms in record["stages_ms"].items():
+                self.observe(worker_type, name, ms / 1000)
+            for name, value in record["counts"].items():
+                self._add(f"indexer_{name}_total", labels, value)
+            self.observe(worker_type, "total", total_ms / 1000)
+            slo_ms = self.slos_ms.get(worker_type)
+            if slo_ms is not None:
+                self._add("indexer_slo_missed_total", labels, 1 if total_ms > slo_ms else 0)
+
+        if self.jsonl_path:
+            line = {key: value for key, value in record.items() if key != "arrived"}
+            line["time"] = time.time()
+            line["stages_ms"] = {name: round(ms, 3) for name, ms in record["stages_ms"].items()}
+            line["total_ms"] = round(total_ms, 3)
+            line.update(memory)
+            self.write_jsonl(json.dumps(line))
+
+    def write_jsonl(self, line: str):
+        with self.lock:
+            try:
+                if os.path.exists(self.jsonl_path) and os.path.getsize(self.jsonl_path) > self.jsonl_max_bytes:
+                    os.replace(self.jsonl_path, f"{self.jsonl_path}.1")
+                with open(self.jsonl_path, "a") as f:
+                    f.write(line + "\n")
+            except OSError as e:
+                print(f"Warning: Could not write metrics to {self.jsonl_path}: {e}")
+
+    def prometheus_text(self) -> str:
+        def fmt(labels: tuple) -> str:
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}" if labels else ""
+
+        lines = []
+        with self.lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines.extend(f"{name}{fmt(labels)} {value}" for (n, labels), value in metrics.items() if n == name)
+            if self.histograms:
+                lines.append("# TYPE indexer_stage_seconds histogram")
+            for (worker_type, stage_name), histogram in sorted(self.histograms.items()):
+                labels = (("worker_type", worker_type), ("stage", stage_name))
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    lines.append(f"indexer_stage_seconds_bucket{fmt(labels + (('le', bound),))} {count}")
+                lines.append(f"indexer_stage_seconds_bucket{fmt(labels + (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"indexer_stage_seconds_sum{fmt(labels)} {histogram['sum']}")
+                lines.append(f"indexer_stage_seconds_count{fmt(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int):
+        """Serves /metrics from a daemon thread."""
+        recorder = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = recorder.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would otherwise print a line each
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"[Metrics] Serving Prometheus metrics on http://127.0.0.1:{port}/metrics")
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+def get_recorder() -> MetricsRecorder:
+    """The process-wide recorder, configured from METRICS_PORT / METRICS_JSONL on first use."""
+    global _recorder
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = MetricsRecorder(
+                os.environ.get("METRICS_JSONL") or None,
+                _int_env("METRICS_JSONL_MAX_BYTES", 50_000_000),
+            )
+            port = _int_env("METRICS_PORT", 0)
+            if port > 0:
+                _recorder.serve(port)
+        return _recorder
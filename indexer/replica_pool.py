@@ -0,0 +1,339 @@
+from startup import startup_timings
+import asyncio
+import atexit
+import concurrent.futures
+import functools
+import importlib
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+from ws_client_handler import client_handler
+from message import current_codec, use_codec
+from metrics import add_stage, call_recorded, count, current_record, new_record
+
+startup_timings.mark("imports")
+
+"""
+Runs several replicas of one worker module in separate processes behind a
+single client_handler connection. On CPU-only hosts one replica leaves most
+cores idle, or its torch threads fight over them.
+
+  WORKER_MODULE     the worker module, e.g. worker_embedding; each replica calls its load_ai_model()
+  REPLICAS          number of replica processes (default: one per 4 CPUs)
+  REPLICA_CPUS      CPU sets per replica, e.g. "0-3;4-7" (default: the CPUs of this process split evenly)
+  REPLICA_THREADS   torch intra-op threads per replica (default: the size of its CPU set)
+  REPLICA_SLOTS     batches the distributor may send per replica (default 2, one running and one waiting)
+  REPLICA_MAX_RESTARTS  restarts of a replica in a row before it is given up (default 5)
+
+Each replica pins itself to its CPU set before importing the module. A batch
+goes to the replica with the fewest batches in flight. A replica that exits
+is started again after a backoff that doubles with every restart in a row (a
+finished batch resets it), and its in-flight batches are retried once on
+another replica. Once every replica is given up, batches fail. The pool registers as one worker with REPLICAS times the slots, and
+client_handler runs its batches concurrently (see pooled_session).
+
+  WORKER_TYPE=embedding MAX_LATENCY_MS=1000 WORKER_MODULE=worker_embedding REPLICAS=4 python -m replica_pool
+"""
+
+class ReplicaExited(Exception):
+    pass
+
+def parse_cpu_list(text: str) -> set:
+    """Parses a CPU list like '0-3,8,10-11'."""
+    cpus = set()
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+def replica_cpu_sets(replicas: int) -> list:
+    """REPLICA_CPUS if it names one CPU set per replica, otherwise the available CPUs in equal contiguous parts."""
+    value = os.environ.get("REPLICA_CPUS")
+    if value:
+        try:
+            cpu_sets = [parse_cpu_list(part) for part in value.split(";")]
+            if len(cpu_sets) == replicas and all(cpu_sets):
+                return cpu_sets
+            print(f"Warning: REPLICA_CPUS names {len(cpu_sets)} CPU sets for {replicas} replicas, splitting the available CPUs instead.")
+        except ValueError:
+            print(f"Warning: Could not parse REPLICA_CPUS from environment variable. Value: '{value}'")
+    available = sorted(os.sched_getaffinity(0))
+    per_replica = max(1, len(available) // replicas)
+    # More replicas than CPUs share them round-robin
+    return [set(available[(i * per_replica) % len(available):][:per_replica]) for i in range(replicas)]
+
+def owned(value):
+    """Copies memoryviews (inline segments of the received message) so the batch can be pickled."""
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, dict):
+        return {key: owned(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [owned(item) for item in value]
+    return value
+
+def serve_replica(index: int, module_name: str, cpus: set, threads: int, conn):
+    """Entry point of a replica process: pins itself, loads the model and runs batches from conn."""
+    os.sched_setaffinity(0, cpus)
+    # Read by torch / OpenMP / MKL when they are first imported
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[name] = str(threads)
+    print(f"[Replica {index}] Pinned to CPUs {sorted(cpus)} with {threads} threads.")
+    module = importlib.import_module(module_name)
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+    worker_function = module.load_ai_model()
+    streaming = getattr(worker_function, "streaming", False)
+    # Streaming workers may emit from several threads at once, and a Connection is not thread-safe
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    send(("ready", {
+        "capacity": getattr(worker_function, "capacity", {}),
+        "streaming": streaming,
+        "startup_timings": getattr(worker_function, "startup_timings", {}),
+    }))
+
+    while True:
+        try:
+            task_id, data, codec = conn.recv()
+        except EOFError:
+            # The pool is gone
+            return
+        workload = worker_function
+        if streaming:
+            workload = functools.partial(worker_function, emit=lambda message, task_id=task_id: send(("emit", task_id, message)))
+        record = new_record(module_name, None)
+        try:
+            result = use_codec(codec, call_recorded, record, workload, data)
+        except Exception as e:
+            # The batch failed, not the replica
+            send(("error", task_id, repr(e)))
+            continue
+        send(("result", task_id, (result, record["stages_ms"], record["counts"])))
+
+RESTART_BACKOFF_S = 1.0
+MAX_RESTART_BACKOFF_S = 60.0
+
+class Replica:
+    """
+    One replica process, restarted with backoff whenever it exits after its
+    first successful start, up to max_restarts times in a row.
+    """
+
+    def __init__(self, index: int, module_name: str, cpus: set, threads: int, changed: threading.Condition, max_restarts: int = 5):
+        self.index = index
+        self.module_name = module_name
+        self.cpus = cpus
+        self.threads = threads
+        self.lock = threading.Lock()
+        # Notified whenever alive or dead changes, see ReplicaPool.least_loaded
+        self.changed = changed
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.alive = False
+        self.dead = False
+        self.ready = threading.Event()
+        self.started_once = False
+        self.stopping = False
+        self.info = {}
+        # task id -> (future, emit)
+        self.in_flight = {}
+        self.start()
+
+    def start(self):
+        context = multiprocessing.get_context("spawn")
+        conn, child_conn = context.Pipe()
+        # Not a daemon: replicas start their own image decoding processes
+        process = context.Process(
+            target=serve_replica, args=(self.index, self.module_name, self.cpus, self.threads, child_conn),
+            name=f"replica-{self.index}",
+        )
+        process.start()
+        child_conn.close()
+        self.conn = conn
+        self.process = process
+        threading.Thread(target=self._read, args=(conn, process), name=f"replica-{self.index}-reader", daemon=True).start()
+
+    def stop(self):
+        self.stopping = True
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def _notify(self):
+        with self.changed:
+            self.changed.notify_all()
+
+    def load(self) -> int:
+        return len(self.in_flight)
+
+    def submit(self, task_id: int, data: dict, codec: str, emit=None) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        with self.lock:
+            if not self.alive:
+                raise ReplicaExited(f"Replica {self.index} is not running")
+            self.in_flight[task_id] = (future, emit)
+            try:
+                self.conn.send((task_id, data, codec))
+            except (OSError, ValueError) as e:
+                del self.in_flight[task_id]
+                raise ReplicaExited(f"Replica {self.index} exited: {e}")
+        return future
+
+    def _read(self, conn, process):
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == "ready":
+                    self.info = message[1]
+                    with self.lock:
+                        self.alive = True
+                    self.started_once = True
+                    self.ready.set()
+                    self._notify()
+                elif message[0] == "emit":
+                    _, task_id, payload = message
+                    emit = self.in_flight.get(task_id, (None, None))[1]
+                    if emit is not None:
+                        emit(payload)
+                else:
+                    kind, task_id, payload = message
+                    with self.lock:
+                        future, _ = self.in_flight.pop(task_id)
+                    if kind == "result":
+                        self.restarts = 0
+                        future.set_result(payload)
+                    else:
+                        future.set_exception(RuntimeError(f"Replica {self.index} failed the batch: {payload}"))
+        except (EOFError, OSError):
+            pass
+
+        process.join()
+        with self.lock:
+            self.alive = False
+            failed, self.in_flight = self.in_flight, {}
+        self.ready.clear()
+        self._notify()
+        for future, _ in failed.values():
+            future.set_exception(ReplicaExited(f"Replica {self.index} exited with code {process.exitcode}"))
+        if self.stopping:
+            return
+        if not self.started_once:
+            print(f"[Pool] Replica {self.index} failed to start (exit code {process.exitcode}).")
+            # Wakes up the pool waiting for it
+            self.ready.set()
+            return
+        if self.restarts >= self.max_restarts:
+            print(f"[Pool] Replica {self.index} exited with code {process.exitcode} after {self.restarts} restarts in a row, giving it up.")
+            self.dead = True
+            self._notify()
+            return
+        delay = min(RESTART_BACKOFF_S * 2 ** self.restarts, MAX_RESTART_BACKOFF_S)
+        self.restarts += 1
+        print(f"[Pool] Replica {self.index} exited with code {process.exitcode}, restarting it in {delay:g}s.")
+        time.sleep(delay)
+        if not self.stopping:
+            self.start()
+
+class ReplicaPool:
+    """
+    The workload client_handler runs: dispatches each batch to the least
+    loaded replica and records the replica's stages in the batch record.
+    """
+
+    def __init__(self, module_name: str, replicas: int, threads: int | None = None, slots_per_replica: int = 2, max_restarts: int = 5):
+        cpu_sets = replica_cpu_sets(replicas)
+        self.task_ids = itertools.count()
+        self.changed = threading.Condition()
+        with startup_timings.stage("start_replicas"):
+            self.replicas = [
+                Replica(index, module_name, cpus, threads or len(cpus), self.changed, max_restarts)
+                for index, cpus in enumerate(cpu_sets)
+            ]
+            for replica in self.replicas:
+                replica.ready.wait()
+        atexit.register(self.stop)
+        failed = [replica.index for replica in self.replicas if not replica.alive]
+        if failed:
+            self.stop()
+            raise RuntimeError(f"Replicas {failed} of {module_name} failed to start")
+
+        info = self.replicas[0].info
+        self.streaming = info["streaming"]
+        self.capacity = {**info["capacity"], "slots": replicas * slots_per_replica}
+        self.startup_timings = {
+            **startup_timings.finish(),
+            "replicas": [replica.info["startup_timings"] for replica in self.replicas],
+        }
+        print(f"[Pool] {replicas} replicas of {module_name} on CPUs {[sorted(cpus) for cpus in cpu_sets]}.")
+
+    def stop(self):
+        for replica in self.replicas:
+            replica.stop()
+
+    def least_loaded(self) -> Replica:
+        with self.changed:
+            while True:
+                running = [replica for replica in self.replicas if replica.alive]
+                if running:
+                    return min(running, key=Replica.load)
+                if all(replica.dead for replica in self.replicas):
+                    raise RuntimeError("Every replica exited too often and was given up")
+                # Every replica is restarting
+                self.changed.wait()
+
+    def __call__(self, data: dict, emit=None):
+        data = owned(data)
+        for attempt in range(2):
+            replica = self.least_loaded()
+            try:
+                result, stages_ms, counts = replica.submit(next(self.task_ids), data, current_codec(), emit).result()
+            except ReplicaExited as e:
+                if attempt:
+                    raise
+                print(f"[Pool] {e}, retrying the batch on another replica.")
+                continue
+            record = current_record()
+            for name, ms in stages_ms.items():
+                add_stage(record, name, ms / 1000)
+            for name, value in counts.items():
+                count(name, value)
+            return result
+
+def _int_env(name: str, default: int) -> int:
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"Warning: Could not parse {name} from environment variable. Value: '{value}'")
+        return default
+
+def pool_from_env() -> ReplicaPool:
+    module_name = os.environ.get("WORKER_MODULE")
+    if not module_name:
+        print("Error: WORKER_MODULE environment variable is not set.")
+        exit(1)
+    replicas = _int_env("REPLICAS", max(1, len(os.sched_getaffinity(0)) // 4))
+    return ReplicaPool(
+        module_name, replicas, _int_env("REPLICA_THREADS", 0) or None, _int_env("REPLICA_SLOTS", 2),
+        _int_env("REPLICA_MAX_RESTARTS", 5),
+    )
+
+if __name__ == "__main__":
+    pool = pool_from_env()
+    asyncio.run(client_handler(pool))
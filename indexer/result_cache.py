@@ -0,0 +1,55 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """
+    Thread-safe LRU of results that also expire ttl_seconds after being stored.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0}
+
+    def get(self, key):
+        """Returns the cached value, or None on a miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self.entries[key]
+                self.stats["expired"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+def ttl_cache_from_env(prefix: str, default_size: int, default_ttl_s: float) -> TTLCache | None:
+    """
+    Builds a cache from <prefix>_CACHE_SIZE (0 disables) and <prefix>_CACHE_TTL_S.
+    """
+    try:
+        max_entries = int(os.environ.get(f"{prefix}_CACHE_SIZE", default_size))
+        ttl_seconds = float(os.environ.get(f"{prefix}_CACHE_TTL_S", default_ttl_s))
+    except ValueError:
+        print(f"Warning: Could not parse {prefix}_CACHE_SIZE / {prefix}_CACHE_TTL_S, cache disabled.")
+        return None
+    if max_entries <= 0:
+        return None
+    print(f"[Result Cache] {prefix}: {max_entries} entries, TTL {ttl_seconds}s")
+    return TTLCache(max_entries, ttl_seconds)
@@ -0,0 +1,82 @@
+import contextvars
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+"""
+Startup bookkeeping for workers.
+
+Worker modules import this before anything heavy, so the "imports" stage covers
+torch/transformers. Timings are sent in the 'i_am_worker' registration, which
+client_handler only sends after the model is loaded and warmed up.
+"""
+
+class StartupTimings:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.last_mark = self.started
+        self.timings = {}
+
+    def mark(self, name: str):
+        """Records the time since the previous mark (or process start) as a stage."""
+        now = time.monotonic()
+        self.timings[f"{name}_ms"] = round((now - self.last_mark) * 1000)
+        self.last_mark = now
+
+    @contextmanager
+    def stage(self, name: str):
+        self.last_mark = time.monotonic()
+        yield
+        self.mark(name)
+
+    def finish(self) -> dict:
+        self.timings["total_ms"] = round((time.monotonic() - self.started) * 1000)
+        print(f"[Startup] {self.timings}")
+        return self.timings
+
+startup_timings = StartupTimings()
+
+# True while warm_up runs its synthetic batch, caches must not keep its results
+warming_up = contextvars.ContextVar("warming_up", default=False)
+
+def warmup_batch_size() -> int:
+    """WARMUP_BATCH_SIZE inputs are run once before registering, 0 skips warmup."""
+    try:
+        return int(os.environ.get("WARMUP_BATCH_SIZE", "4"))
+    except ValueError:
+        print("Warning: Could not parse WARMUP_BATCH_SIZE, skipping warmup.")
+        return 0
+
+def warmup_image_path(index: int = 0) -> str:
+    """A synthetic camera-sized JPEG for warming up vision models, a different shade per index."""
+    from PIL import Image
+
+    name = f"indexer_warmup_{index}.jpg" if index else "indexer_warmup.jpg"
+    path = os.path.join(tempfile.gettempdir(), name)
+    if not os.path.exists(path):
+        shade = (127 + index * 37) % 256
+        Image.new("RGB", (1280, 720), (shade, shade, shade)).save(path)
+    return path
+
+def warm_up(worker_function, make_inputs, stage_name: str = "warmup"):
+    """
+    Runs one synthetic batch so kernels, allocator pools and lazy modules are
+    initialized before the first real batch arrives. Worker functions check
+    warming_up to run it past their caches.
+    """
+    batch_size = warmup_batch_size()
+    if batch_size <= 0:
+        return
+    token = warming_up.set(True)
+    try:
+        with startup_timings.stage(stage_name):
+            worker_function({"inputs": make_inputs(batch_size)})
+    finally:
+        warming_up.reset(token)
+
+def ready(worker_function, make_inputs):
+    """Warms up the worker function and attaches the startup timings for registration."""
+    warm_up(worker_function, make_inputs)
+    worker_function.startup_timings = startup_timings.finish()
+    return worker_function
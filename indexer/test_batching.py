@@ -0,0 +1,23 @@
+from batching import run_in_buckets, token_budget_buckets
+
+def test_buckets_respect_the_budget():
+    buckets = token_budget_buckets([10, 100, 12, 90, 11], 300)
+    assert buckets == [[0, 4, 2], [3, 1]]
+
+def test_long_input_gets_its_own_bucket():
+    assert token_budget_buckets([500, 10], 100) == [[1], [0]]
+
+def test_zero_budget_disables_bucketing():
+    assert token_budget_buckets([10, 100, 12], 0) == [[0, 1, 2]]
+    assert token_budget_buckets([10, 100, 12], -1) == [[0, 1, 2]]
+    assert token_budget_buckets([], 0) == []
+
+def test_run_in_buckets_restores_order():
+    calls = []
+
+    def run_bucket(bucket):
+        calls.append(bucket)
+        return [f"result {i}" for i in bucket]
+
+    assert run_in_buckets([30, 10, 20], 0, run_bucket, "test") == ["result 0", "result 1", "result 2"]
+    assert calls == [[0, 1, 2]]
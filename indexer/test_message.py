@@ -0,0 +1,32 @@
+import struct
+
+from message import create_message, merge_results, parse_ws_message
+
+def packed_result(ids: list, values: list) -> bytes:
+    buffer = b"".join(struct.pack("<2f", value, value) for value in values)
+    outputs = [{"id": result_id, "offset": i * 8} for i, result_id in enumerate(ids)]
+    return create_message({"output": outputs, "packed_embedding": {"dtype": "float32", "dimension": 2}}, buffer)
+
+def vector(parsed: dict, output: dict) -> tuple:
+    return struct.unpack_from("<2f", parsed["buffer"], output["offset"])
+
+def test_merge_results_packed_chunks():
+    merged = parse_ws_message(merge_results([packed_result(["a", "b"], [1.0, 2.0]), packed_result(["c"], [3.0])]))
+    outputs = merged["header"]["output"]
+    assert [output["id"] for output in outputs] == ["a", "b", "c"]
+    assert [vector(merged, output) for output in outputs] == [(1.0, 1.0), (2.0, 2.0), (3.0, 3.0)]
+
+def test_merge_results_expired_first_chunk():
+    expired = create_message({"output": [{"id": "x", "status": "expired"}]})
+    merged = parse_ws_message(merge_results([expired, packed_result(["a", "b"], [1.0, 2.0]), packed_result(["c"], [3.0])]))
+    assert merged["header"]["packed_embedding"] == {"dtype": "float32", "dimension": 2}
+    outputs = merged["header"]["output"]
+    assert outputs[0] == {"id": "x", "status": "expired"}
+    assert [vector(merged, output) for output in outputs[1:]] == [(1.0, 1.0), (2.0, 2.0), (3.0, 3.0)]
+
+def test_merge_results_segments_renamed():
+    first = create_message({"output": [{"id": 1, "image": {"segment": "s0"}}]}, segments={"s0": b"aa"})
+    second = create_message({"output": [{"id": 2, "image": {"segment": "s0"}}]}, segments={"s0": b"bbb"})
+    merged = parse_ws_message(merge_results([first, second]))
+    names = [output["image"]["segment"] for output in merged["header"]["output"]]
+    assert [bytes(merged["segments"][name]) for name in names] == [b"aa", b"bbb"]
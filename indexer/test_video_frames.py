@@ -0,0 +1,27 @@
+import cv2
+import numpy as np
+
+from video_frames import keyframes
+
+def write_video(path: str, seconds: int, fps: int = 10):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), fps, (64, 48))
+    for index in range(seconds * fps):
+        # A new scene every second
+        writer.write(np.full((48, 64, 3), (index // fps) * 60 % 256, np.uint8))
+    writer.release()
+
+def test_keyframes_threshold_above_one(tmp_path):
+    path = str(tmp_path / "video.avi")
+    write_video(path, 4)
+    frames = list(keyframes(path, sample_fps=10, scene_threshold=1.5, max_gap_s=2.0, max_keyframes=100))
+    # Scene changes never reach the threshold: the first frame, then one every max_gap_s
+    assert frames[0][1] == 1.0
+    offsets = [offset_s for offset_s, _, _ in frames]
+    assert len(offsets) == 2
+    assert offsets[1] - offsets[0] >= 2.0
+
+def test_keyframes_scene_changes(tmp_path):
+    path = str(tmp_path / "video.avi")
+    write_video(path, 4)
+    frames = list(keyframes(path, sample_fps=10, scene_threshold=0.1, max_gap_s=60.0, max_keyframes=100))
+    assert len(frames) == 4
@@ -0,0 +1,44 @@
+import sys
+import types
+
+import numpy as np
+
+import worker_host
+from embedding_cache import EmbeddingCache, cache_from_env
+
+def fake_embedding_module() -> types.ModuleType:
+    """A worker module like worker_embedding whose 'model' embeds a text as [len(text)] * 4."""
+    module = types.ModuleType("fake_embedding")
+    module.MODEL_ID = "fake-model"
+    module.load_model = lambda model_id: "model"
+    module.warmup_inputs = lambda batch_size: []
+
+    def make_worker_function(model, model_id):
+        cache = cache_from_env({"model_id": model_id})
+
+        def worker_function(data):
+            texts = [inp["text"] for inp in data["inputs"]]
+            return cache.get_or_compute(texts, lambda indices: [np.full(4, len(texts[i]), np.float32) for i in indices])
+
+        return worker_function
+
+    module.make_worker_function = make_worker_function
+    return module
+
+def test_roles_sharing_a_model_share_one_cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "fake_embedding", fake_embedding_module())
+    monkeypatch.setenv("EMBEDDING_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("EMBEDDING_CACHE_DISK_SIZE", "16")
+    monkeypatch.setenv("WARMUP_BATCH_SIZE", "0")
+    roles = [
+        {"worker_type": "fast_embedding", "module": "fake_embedding", "max_latency_ms": 200, "priority": 0},
+        {"worker_type": "embedding", "module": "fake_embedding", "max_latency_ms": 10000, "priority": 1},
+    ]
+    (fast, _), (bulk, _) = worker_host.load_roles(roles)
+    fast({"inputs": [{"text": "a"}, {"text": "bb"}]})
+    bulk({"inputs": [{"text": "ccc"}, {"text": "dddd"}]})
+
+    # After a restart every key still maps to its own vector
+    reopened = EmbeddingCache(10, str(tmp_path), 16, {"model_id": "fake-model"})
+    vectors = reopened.lookup(["a", "bb", "ccc", "dddd"])
+    assert [float(vector[0]) for vector in vectors] == [1.0, 2.0, 3.0, 4.0]
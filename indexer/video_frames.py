@@ -0,0 +1,122 @@
+import io
+import os
+from datetime import datetime, timedelta, timezone
+
+import cv2
+import numpy as np
+from PIL import Image
+
+"""
+Streaming keyframe selection from video files.
+
+Frames are read one at a time with cv2.VideoCapture, so memory does not grow
+with the length of the video. Only every (fps / VIDEO_SAMPLE_FPS)-th frame is
+decoded to pixels, the others are just grabbed. A sampled frame becomes a
+keyframe when its scene-change score against the last keyframe reaches
+VIDEO_SCENE_THRESHOLD, or when VIDEO_MAX_GAP_S passed since the last one, so
+a static scene still gets a keyframe now and then.
+
+Scene-change score: mean absolute difference of 64x36 grayscale thumbnails,
+scaled to 0..1. Camera noise stays around 0.01, a person entering a
+close-up scene is about 0.05-0.1, a cut is usually above 0.2.
+
+  VIDEO_SAMPLE_FPS        frames per second that are scored (default 2)
+  VIDEO_SCENE_THRESHOLD   score that makes a keyframe (default 0.08)
+  VIDEO_MAX_GAP_S         longest time without a keyframe (default 60)
+  VIDEO_MAX_KEYFRAMES     keyframes per video at most (default 500)
+  VIDEO_KEYFRAME_MAX_EDGE keyframes are downscaled to this longest edge (default 1280, 0 keeps the size)
+"""
+
+THUMBNAIL_SIZE = (64, 36)
+
+def keyframe_settings_from_env() -> dict:
+    defaults = {
+        "sample_fps": ("VIDEO_SAMPLE_FPS", 2.0),
+        "scene_threshold": ("VIDEO_SCENE_THRESHOLD", 0.08),
+        "max_gap_s": ("VIDEO_MAX_GAP_S", 60.0),
+        "max_keyframes": ("VIDEO_MAX_KEYFRAMES", 500),
+        "max_edge": ("VIDEO_KEYFRAME_MAX_EDGE", 1280),
+    }
+    settings = {}
+    for key, (env_name, default) in defaults.items():
+        value = os.environ.get(env_name)
+        try:
+            settings[key] = type(default)(value) if value else default
+        except ValueError:
+            print(f"Warning: Could not parse {env_name} from environment variable. Value: '{value}'")
+            settings[key] = default
+    return settings
+
+def sample_frames(path: str, sample_fps: float):
+    """Yields (offset_s, BGR frame) at about sample_fps, reading the file sequentially."""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video '{path}'")
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        step = max(1, round(fps / sample_fps)) if sample_fps > 0 else 1
+        index = 0
+        while capture.grab():
+            if index % step == 0:
+                ok, frame = capture.retrieve()
+                if ok:
+                    # Container timestamps survive variable frame rates, the index is the fallback
+                    position_ms = capture.get(cv2.CAP_PROP_POS_MSEC)
+                    yield (position_ms / 1000 if position_ms > 0 else index / fps), frame
+            index += 1
+    finally:
+        capture.release()
+
+def thumbnail(frame: np.ndarray) -> np.ndarray:
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+def scene_change_score(previous: np.ndarray, current: np.ndarray) -> float:
+    """Mean absolute difference of two thumbnails, 0 (same) to 1."""
+    return float(np.mean(np.abs(previous - current)) / 255)
+
+def downscale(frame: np.ndarray, max_edge: int) -> np.ndarray:
+    """Shrinks a frame so its longest edge is at most max_edge (0 keeps it)."""
+    height, width = frame.shape[:2]
+    if max_edge <= 0 or max(height, width) <= max_edge:
+        return frame
+    scale = max_edge / max(height, width)
+    return cv2.resize(frame, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+def keyframes(path: str, sample_fps: float, scene_threshold: float, max_gap_s: float, max_keyframes: int, max_edge: int = 0):
+    """
+    Yields (offset_s, score, RGB PIL image) for each keyframe of the video,
+    downscaled to max_edge.
+
+    The first sampled frame is always a keyframe, with score 1.0.
+    """
+    last_thumbnail = None
+    last_offset = None
+    count = 0
+    for offset_s, frame in sample_frames(path, sample_fps):
+        current = thumbnail(frame)
+        score = 1.0 if last_thumbnail is None else scene_change_score(last_thumbnail, current)
+        # A scene_threshold above 1 disables scene detection, the first frame still counts
+        if last_offset is None or score >= scene_threshold or offset_s - last_offset >= max_gap_s:
+            yield offset_s, score, Image.fromarray(cv2.cvtColor(downscale(frame, max_edge), cv2.COLOR_BGR2RGB))
+            last_thumbnail = current
+            last_offset = offset_s
+            count += 1
+            if count >= max_keyframes:
+                print(f"Warning: Video '{path}' reached {max_keyframes} keyframes, the rest is skipped.")
+                return
+
+def at_time(start_time: str | None, offset_s: float) -> str | None:
+    """ISO timestamp of a frame, offset_s after the video's start_time (a MediaUnit.at_time)."""
+    if not start_time:
+        return None
+    start = datetime.fromisoformat(start_time.replace("Z", "+00:00"))
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=timezone.utc)
+    moment = (start + timedelta(seconds=offset_s)).astimezone(timezone.utc)
+    return moment.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+def encode_jpeg(image: Image.Image, quality: int = 90) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
@@ -0,0 +1,240 @@
+from startup import startup_timings, ready
+import asyncio
+from ws_client_handler import client_handler
+from metrics import stage, debug_payload
+from message import create_message
+import numpy as np
+import time
+import os
+
+startup_timings.mark("imports")
+
+"""
+Clusters the embeddings of a search result, one clustering per input.
+
+BATCH INPUT FORMAT:
+{
+  "inputs": [
+    {
+      "id": "search_1",
+      "embeddings": {"segment": "s0"},   # n x dimension little-endian vectors, a segment of the binary message
+      "dimension": 2048,
+      "dtype": "float32",                # or "float16"
+      "threshold": 0.85,                 # optional, cosine similarity that links two results
+      "budget_ms": 200                   # optional latency budget
+    }
+  ]
+}
+"embeddings" may also be a plain list of vectors in JSON messages.
+
+BATCH OUTPUT FORMAT:
+{
+  "output": [
+    {
+      "id": "search_1",
+      "labels": [0, 0, 1, 2, 1],         # cluster per embedding, numbered by first appearance
+      "n_clusters": 3,
+      "method": "knn_graph"              # or "minibatch_kmeans" when n is too large for the budget
+    }
+  ]
+}
+
+Methods:
+  knn_graph         Links every embedding to its k nearest neighbours
+                    above the similarity threshold and returns the connected
+                    components. Exact, O(n^2 * d) time but computed in row blocks,
+                    so memory stays O(block * n).
+  minibatch_kmeans  Fallback when the exact graph would not fit the latency
+                    budget: spherical mini-batch k-means with k = 2 * sqrt(n),
+                    stopped at the deadline, whose centers are then merged with
+                    the same graph rule, so k adapts to the data.
+"""
+
+MODEL_ID = "knn_graph"
+
+def parse_float_env(env_name: str, default: float) -> float:
+    value = os.environ.get(env_name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"Warning: Could not parse {env_name} from environment variable. Value: '{value}'")
+        return default
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def first_appearance_labels(roots: np.ndarray) -> np.ndarray:
+    """Renumbers component roots 0, 1, 2, ... in order of first appearance."""
+    _, first, inverse = np.unique(roots, return_index=True, return_inverse=True)
+    return np.argsort(np.argsort(first))[inverse]
+
+def connected_components(n: int, src: np.ndarray, dst: np.ndarray) -> np.ndarray:
+    """Component labels of an undirected edge list (hooking plus pointer jumping)."""
+    roots = np.arange(n)
+    while len(src):
+        low = np.minimum(roots[src], roots[dst])
+        np.minimum.at(roots, roots[src], low)
+        np.minimum.at(roots, roots[dst], low)
+        while True:
+            jumped = roots[roots]
+            if np.array_equal(jumped, roots):
+                break
+            roots = jumped
+        if np.array_equal(roots[src], roots[dst]):
+            break
+    return first_appearance_labels(roots)
+
+def knn_graph_labels(vectors: np.ndarray, neighbors: int, threshold: float, block_rows: int = 1024) -> np.ndarray:
+    """
+    Connected components of the kNN graph of unit vectors, keeping only edges
+    with cosine similarity >= threshold.
+    """
+    n = len(vectors)
+    k = min(neighbors, n - 1)
+    if k <= 0:
+        return np.zeros(n, dtype=np.int64)
+
+    neighbor_ids = np.empty((n, k), dtype=np.int64)
+    linked = np.empty((n, k), dtype=bool)
+    for start in range(0, n, block_rows):
+        end = min(start + block_rows, n)
+        similarities = vectors[start:end] @ vectors.T
+        similarities[np.arange(end - start), np.arange(start, end)] = -np.inf
+        ids = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        neighbor_ids[start:end] = ids
+        linked[start:end] = np.take_along_axis(similarities, ids, axis=1) >= threshold
+
+    # The threshold, not k, decides what is linked; k only bounds the edge count
+    src = np.repeat(np.arange(n), k)[linked.ravel()]
+    dst = neighbor_ids.ravel()[linked.ravel()]
+    return connected_components(n, src, dst)
+
+def minibatch_kmeans_labels(vectors: np.ndarray, threshold: float, deadline: float,
+                            batch_size: int = 1024, max_iterations: int = 100, seed: int = 0) -> np.ndarray:
+    """
+    Spherical mini-batch k-means that over-clusters with k = 2 * sqrt(n), then
+    merges centers like knn_graph_labels, so the threshold decides the final k.
+    """
+    n = len(vectors)
+    k = int(np.clip(round(2 * np.sqrt(n)), 1, n))
+    rng = np.random.default_rng(seed)
+    centers = vectors[rng.choice(n, k, replace=False)].copy()
+    counts = np.zeros(k)
+    for _ in range(max_iterations):
+        if time.monotonic() > deadline:
+            break
+        batch = vectors[rng.choice(n, min(batch_size, n), replace=False)]
+        assignment = np.argmax(batch @ centers.T, axis=1)
+        one_hot = np.zeros((len(batch), k), dtype=batch.dtype)
+        one_hot[np.arange(len(batch)), assignment] = 1
+        sums = one_hot.T @ batch
+        batch_counts = np.bincount(assignment, minlength=k)
+        counts += batch_counts
+        # Per-center learning rate 1 / count, as in mini-batch k-means
+        rate = (batch_counts / np.maximum(counts, 1))[:, None]
+        updated = normalize_rows((1 - rate) * centers + rate * sums / np.maximum(batch_counts, 1)[:, None])
+        shift = np.max(1 - np.sum(updated * centers, axis=1))
+        centers = updated
+        if shift < 1e-4:
+            break
+
+    assignment = np.concatenate([
+        np.argmax(vectors[start:start + batch_size] @ centers.T, axis=1)
+        for start in range(0, n, batch_size)
+    ])
+    merged = knn_graph_labels(centers, neighbors=k, threshold=threshold)
+    return first_appearance_labels(merged[assignment])
+
+def load_model(model_id: str = MODEL_ID) -> dict:
+    """
+    There are no weights to load. Returns the clustering settings, and how fast
+    this machine multiplies matrices, which decides between the exact graph and
+    the k-means fallback.
+    """
+    settings = {
+        "threshold": parse_float_env("CLUSTERING_THRESHOLD", 0.85),
+        "neighbors": int(parse_float_env("CLUSTERING_NEIGHBORS", 10)),
+        "budget_ms": parse_float_env("CLUSTERING_BUDGET_MS", 200),
+        "exact_max_n": int(parse_float_env("CLUSTERING_EXACT_MAX_N", 20000)),
+    }
+    probe = normalize_rows(np.random.default_rng(0).standard_normal((1024, 2048)).astype(np.float32))
+    started = time.perf_counter()
+    probe @ probe.T
+    settings["flops_per_ms"] = 1024 * 1024 * 2048 / max((time.perf_counter() - started) * 1000, 1e-3)
+    print(f"Clustering settings: {settings}")
+    return settings
+
+def make_worker_function(settings: dict, model_id: str = MODEL_ID):
+    """Returns the worker function for the given settings, see load_model."""
+
+    def decode_embeddings(inp: dict) -> np.ndarray:
+        embeddings = inp['embeddings']
+        if isinstance(embeddings, list):
+            return np.asarray(embeddings, dtype=np.float32)
+        # Zero-copy view of the message segment, normalize_rows makes the only copy
+        dtype = '<f2' if inp.get('dtype') == 'float16' else '<f4'
+        return np.frombuffer(embeddings, dtype=dtype).reshape(-1, int(inp['dimension'])).astype(np.float32, copy=False)
+
+    def cluster(vectors: np.ndarray, threshold: float, budget_ms: float) -> tuple[np.ndarray, str]:
+        n, dimension = vectors.shape
+        # The graph costs about n^2 * d multiply-adds, keep it within half the budget
+        exact_ms = n * n * dimension / settings["flops_per_ms"]
+        if n <= settings["exact_max_n"] and exact_ms <= budget_ms / 2:
+            return knn_graph_labels(vectors, settings["neighbors"], threshold), "knn_graph"
+        deadline = time.monotonic() + budget_ms / 1000
+        return minibatch_kmeans_labels(vectors, threshold, deadline), "minibatch_kmeans"
+
+    def worker_function(data):
+        """Clusters each input's embeddings independently."""
+        print(f"[Clustering Thread] Starting clustering workload with {len(data.get('inputs', []))} inputs.")
+        debug_payload("[Clustering Thread] Workload data", data)
+
+        outputs = []
+        for inp in data.get('inputs', []):
+            if 'embeddings' not in inp:
+                print(f"[Clustering Thread] Warning: Input with id '{inp.get('id')}' has no embeddings. Skipping.")
+                continue
+            with stage("preprocess"):
+                vectors = normalize_rows(decode_embeddings(inp))
+            if len(vectors) == 0:
+                outputs.append({"id": inp.get('id'), "labels": [], "n_clusters": 0, "method": model_id})
+                continue
+            with stage("model"):
+                labels, method = cluster(
+                    vectors,
+                    float(inp.get('threshold', settings["threshold"])),
+                    float(inp.get('budget_ms', settings["budget_ms"])),
+                )
+            outputs.append({
+                "id": inp.get('id'),
+                "labels": labels.tolist(),
+                "n_clusters": int(labels.max()) + 1,
+                "method": method,
+            })
+
+        print("[Clustering Thread] Clustering workload finished.")
+        with stage("serialize"):
+            return create_message({"output": outputs})
+
+    return worker_function
+
+def warmup_inputs(batch_size: int) -> list:
+    rng = np.random.default_rng(0)
+    return [
+        {"id": f"warmup_{i}", "embeddings": rng.standard_normal((256, 2048)).astype('<f4').tobytes(), "dimension": 2048}
+        for i in range(batch_size)
+    ]
+
+def load_ai_model():
+    with startup_timings.stage("load_weights"):
+        settings = load_model()
+    with startup_timings.stage("make_worker"):
+        worker_function = make_worker_function(settings)
+    return ready(worker_function, warmup_inputs)
+
+if __name__ == "__main__":
+    worker_function = load_ai_model()
+    asyncio.run(client_handler(worker_function))
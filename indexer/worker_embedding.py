@@ -1,14 +1,21 @@
+from startup import startup_timings, ready, warming_up, warmup_image_path
 import asyncio
 from ws_client_handler import client_handler
-import time
-import json
+from embedding_cache import cache_from_env, text_cache_key, image_cache_key
+from batching import run_in_buckets, max_batch_tokens_from_env
+from image_preprocessing import preloader_from_env, resolve_images
+from frame_dedup import dedup_from_env
+from embedding_encoding import ENCODINGS, json_output, pack_embeddings
+from inference_backend import backend_from_env, backend_device, backend_dtype, quantize_int8
+from metrics import stage, debug_payload
+from message import create_message
+import numpy as np
 import torch
-from transformers import AutoModel
-from PIL import Image
-import requests
-from io import BytesIO
+from transformers import AutoModel, AutoTokenizer
 import os
 
+startup_timings.mark("imports")
+
 """
 INPUT/OUTPUT SHAPE EXAMPLES:
 
@@ -28,6 +35,11 @@ INPUT FORMAT:
     {
       "id": "img_1",
       "filepath": "path/to/image.jpg",           # for image inputs
+    },
+    {
+      "id": "img_2",
+      "image": {"segment": "img_2"},             # inline image, a segment of the binary message
+      "source": "camera_1"                       # optional, enables near-duplicate frame reuse (with FRAME_DEDUP_HISTORY set, frame_dedup.py)
     }
   ]
 }
@@ -46,27 +58,136 @@ OUTPUT FORMAT:
     {
       "id": "img_1",
       "embedding": [0.7, 0.8, 0.9, ...]         # Vector of size 8192 (Jina model)
+    },
+    {
+      "id": "img_2",
+      "embedding": [0.7, 0.8, 0.9, ...],
+      "reused_from": "img_1"                    # near-duplicate of img_1 (same source), the model was skipped
     }
   ]
 }
+
+PACKED OUTPUT FORMAT (EMBEDDING_RESPONSE=packed):
+A binary message built with message.create_message(header, buffer). The buffer
+holds all embeddings back to back, see message.select_packed_outputs.
+{
+  "output": [
+    { "id": "text_1", "offset": 0 },             # Byte offset into the buffer
+    { "id": "text_2", "offset": 8192 },
+    { "id": "img_1", "offset": 16384, "dtype": "int8", "dimension": 512, "scale": 0.0011 }
+  ],
+  "packed_embedding": { "dtype": "float32", "dimension": 2048 }
+}
+
+DIMENSION AND ENCODING:
+Each input may set "dimension" (truncate and renormalize, e.g. 128/256/512/2048)
+and "dtype" (float32, float16, int8, binary). Defaults come from EMBEDDING_DIMENSION
+and EMBEDDING_DTYPE. In JSON responses non-float32 outputs carry "dtype",
+"dimension" and, for int8, "scale" next to the encoded "embedding" values.
 """
 
-def load_ai_model():
-    """Initializes the Jina embeddings model and returns the worker function."""
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Loading jina-embeddings-v4 model on {device}...")
+MODEL_ID = "jinaai/jina-embeddings-v4"
+
+def load_model(model_id: str = MODEL_ID):
+    """Initializes the Jina embeddings model on the EMBEDDING_BACKEND, see inference_backend.py."""
+    backend = backend_from_env("EMBEDDING")
+    device = backend_device(backend)
+    print(f"Loading {model_id} model on {device} ({backend} backend)...")
     
-    # Initialize the model and move it to the appropriate device
+    # Memory-map the safetensors weights and place them straight on the device
     model = AutoModel.from_pretrained(
-        "jinaai/jina-embeddings-v4", 
+        model_id, 
         trust_remote_code=True, 
-        torch_dtype=torch.float16
-    ).to(device)
+        torch_dtype=backend_dtype(backend),
+        use_safetensors=True,
+        device_map=device,
+    )
+    if backend == "cpu_int8":
+        # The task LoRA adapters stay float, the base layers they wrap are quantized
+        quantize_int8(model)
+    return model
+
+def make_worker_function(model, model_id: str = MODEL_ID):
+    """Returns the worker function for an already loaded model, see worker_host for sharing it."""
+
+    # "json" keeps value lists in the JSON result, "packed" sends one binary array
+    response_mode = os.environ.get("EMBEDDING_RESPONSE", "json")
+    default_dtype = os.environ.get("EMBEDDING_DTYPE", "float32")
+    default_dimension = int(os.environ["EMBEDDING_DIMENSION"]) if os.environ.get("EMBEDDING_DIMENSION") else None
+    if default_dtype not in ENCODINGS:
+        raise ValueError(f"EMBEDDING_DTYPE must be one of {ENCODINGS}, got '{default_dtype}'")
+    print(f"Embedding response mode: {response_mode}, dtype: {default_dtype}, dimension: {default_dimension or 'full'}")
+
+    def to_numpy(embedding) -> np.ndarray:
+        if torch.is_tensor(embedding):
+            return embedding.detach().float().cpu().numpy()
+        return np.asarray(embedding, dtype=np.float32)
+
+    # Only cache misses are sent to the model. A disk tier filled by another backend is not reused.
+    backend = backend_from_env("EMBEDDING")
+    cache = cache_from_env({"model_id": model_id, "backend": backend, "dtype": str(backend_dtype(backend))})
+
+    # Texts are sorted into length buckets under a padded token budget
+    tokenizer = AutoTokenizer.from_pretrained(model_id, trust_remote_code=True)
+    max_batch_tokens = max_batch_tokens_from_env("EMBEDDING_MAX_BATCH_TOKENS", 8192)
+
+    def encode_texts(texts: list, prompt_name: str) -> list:
+        def compute(indices):
+            miss_texts = [texts[i] for i in indices]
+            with stage("preprocess"):
+                lengths = [len(token_ids) for token_ids in tokenizer(miss_texts)["input_ids"]]
+
+            def run_bucket(bucket):
+                with stage("model"):
+                    embeddings = model.encode_text(
+                        texts=[miss_texts[i] for i in bucket],
+                        task="retrieval",
+                        prompt_name=prompt_name,
+                        batch_size=len(bucket)
+                    )
+                    return [to_numpy(embedding) for embedding in embeddings]
+
+            return run_in_buckets(lengths, max_batch_tokens, run_bucket, f"Embedding Thread/{prompt_name}")
+
+        if cache is None or warming_up.get():
+            return compute(range(len(texts)))
+        keys = [text_cache_key(model_id, "retrieval", prompt_name, text) for text in texts]
+        return cache.get_or_compute(keys, compute)
+
+    # Images are decoded in a process pool; the model does its own resizing
+    preloader = preloader_from_env(None)
+
+    def encode_images(image_sources: list) -> list:
+        """image_sources are file paths or inline encoded images (memoryviews)."""
+        def compute(indices):
+            with stage("preprocess"):
+                images = resolve_images([image_sources[i] for i in indices], preloader, None)
+            with stage("model"):
+                embeddings = model.encode_image(images=images, task="retrieval")
+                return [to_numpy(embedding) for embedding in embeddings]
+
+        if cache is None or warming_up.get():
+            return compute(range(len(image_sources)))
+        keys = []
+        with stage("preprocess"):
+            for source in image_sources:
+                if isinstance(source, str):
+                    with open(source, 'rb') as f:
+                        source = f.read()
+                keys.append(image_cache_key(model_id, "retrieval", source))
+        vectors = cache.get_or_compute(keys, compute)
+        if preloader is not None:
+            # Cache hits were prefetched too
+            preloader.discard([source for source in image_sources if isinstance(source, str)])
+        return vectors
+
+    # Near-duplicate frames of the same source reuse the reference frame's embedding
+    dedup = dedup_from_env()
     
     def worker_function(data):
         """Processes embedding requests using the Jina embeddings model."""
-        print(f"[Embedding Thread] Starting embedding workload with data: {data}")
-        
+        print(f"[Embedding Thread] Starting embedding workload with {len(data.get('inputs', []))} inputs.")
+        debug_payload("[Embedding Thread] Workload data", data)
         
         inputs = data.get('inputs', [])
         
@@ -84,10 +205,19 @@ def load_ai_model():
                     text_inputs_query.append(inp)
                 else:
                     text_inputs_passage.append(inp)
-            elif 'filepath' in inp:
+            elif 'image' in inp or 'filepath' in inp:
                 image_inputs.append(inp)
         
+        result_ids = []
         result_embeddings = []
+        annotations = {}
+        options = {}
+        for inp in inputs:
+            dtype = inp.get('dtype', default_dtype)
+            if dtype not in ENCODINGS:
+                print(f"[Embedding Thread] Warning: Unsupported dtype '{dtype}' for input '{inp.get('id')}', using {default_dtype}.")
+                dtype = default_dtype
+            options[inp.get('id')] = (inp.get('dimension', default_dimension), dtype)
         
         # --- Process each category separately for clarity ---
 
@@ -96,63 +226,101 @@ def load_ai_model():
             texts = [inp['text'] for inp in text_inputs_query]
             ids = [inp['id'] for inp in text_inputs_query]
             
-            embeddings = model.encode_text(
-                texts=texts,
-                task="retrieval",
-                prompt_name="query"
-            )
+            embeddings = encode_texts(texts, "query")
             
             for i, result_id in enumerate(ids):
-                result_embeddings.append({
-                    "id": result_id,
-                    # FIX: Convert the individual Tensor to a list
-                    "embedding": embeddings[i].tolist()
-                })
+                result_ids.append(result_id)
+                result_embeddings.append(embeddings[i])
 
         # 2. Process Text Passages
         if text_inputs_passage:
             texts = [inp['text'] for inp in text_inputs_passage]
             ids = [inp['id'] for inp in text_inputs_passage]
             
-            embeddings = model.encode_text(
-                texts=texts,
-                task="retrieval",
-                prompt_name="passage"
-            )
+            embeddings = encode_texts(texts, "passage")
 
             for i, result_id in enumerate(ids):
-                result_embeddings.append({
-                    "id": result_id,
-                    # FIX: Convert the individual Tensor to a list
-                    "embedding": embeddings[i].tolist()
-                })
+                result_ids.append(result_id)
+                result_embeddings.append(embeddings[i])
 
         # 3. Process Images
         if image_inputs:
-            image_paths = [inp['filepath'] for inp in image_inputs]
+            image_sources = [inp['image'] if 'image' in inp else inp['filepath'] for inp in image_inputs]
             ids = [inp['id'] for inp in image_inputs]
 
-            embeddings = model.encode_image(
-                images=image_paths,
-                task="retrieval"
-            )
+            if dedup is None:
+                embeddings = encode_images(image_sources)
+            else:
+                embeddings, reused_from = dedup.get_or_compute(
+                    ids,
+                    [inp.get('source') for inp in image_inputs],
+                    image_sources,
+                    lambda indices: encode_images([image_sources[i] for i in indices]),
+                )
+                for result_id, reference in zip(ids, reused_from):
+                    if reference is not None:
+                        annotations[result_id] = {"reused_from": reference}
+                if preloader is not None:
+                    # Reused frames were prefetched too
+                    preloader.discard([
+                        source for source, reference in zip(image_sources, reused_from)
+                        if reference is not None and isinstance(source, str)
+                    ])
             
             for i, result_id in enumerate(ids):
-                result_embeddings.append({
-                    "id": result_id,
-                    # FIX: Convert the individual Tensor to a list
-                    "embedding": embeddings[i].tolist()
-                })
-        result = {
-            "output": result_embeddings
-        }
+                result_ids.append(result_id)
+                result_embeddings.append(embeddings[i])
+        if cache is not None:
+            print(f"[Embedding Thread] Cache stats: {cache.stats}")
+        if dedup is not None:
+            print(f"[Embedding Thread] Frame dedup stats: {dedup.stats}")
         print("[Embedding Thread] Embedding workload finished.")
-        return json.dumps(result)
-            
-       
+        # Truncation and encoding happen after the cache, which keeps full vectors
+        dimensions = [options[result_id][0] for result_id in result_ids]
+        dtypes = [options[result_id][1] for result_id in result_ids]
+        with stage("serialize"):
+            if response_mode == "packed":
+                return pack_embeddings(result_ids, result_embeddings, dimensions, dtypes, annotations)
+
+            result = {
+                "output": [
+                    {**json_output(result_id, embedding, dimension, dtype), **annotations.get(result_id, {})}
+                    for result_id, embedding, dimension, dtype in zip(result_ids, result_embeddings, dimensions, dtypes)
+                ]
+            }
+            return create_message(result)
+
+    if preloader is not None:
+        input_paths = lambda data: [inp['filepath'] for inp in data.get('inputs', []) if 'filepath' in inp]
+        worker_function.prefetch = lambda data: preloader.prefetch(input_paths(data))
+        # Inputs dropped as expired never reach worker_function
+        worker_function.discard = lambda data: preloader.discard(input_paths(data))
+    if max_batch_tokens > 0:
+        # Advertised to the distributor, see flow_control.py
+        worker_function.capacity = {"max_batch_tokens": max_batch_tokens}
 
     return worker_function
 
+def warmup_inputs(batch_size: int) -> list:
+    """
+    Query, passage and image inputs at batch_size each, like a real mixed batch.
+    All of them differ, so none is collapsed into another before the model.
+    """
+    inputs = []
+    for i in range(batch_size):
+        inputs.append({"id": f"warmup_query_{i}", "text": f"person near entrance {i}", "prompt_name": "query"})
+        inputs.append({"id": f"warmup_passage_{i}", "text": f"Camera {i}. " + "A person walks past a parked car near the entrance. " * 8, "prompt_name": "passage"})
+        inputs.append({"id": f"warmup_image_{i}", "filepath": warmup_image_path(i)})
+    return inputs
+
+def load_ai_model():
+    """Initializes the Jina embeddings model and returns the warmed-up worker function."""
+    with startup_timings.stage("load_weights"):
+        model = load_model()
+    with startup_timings.stage("make_worker"):
+        worker_function = make_worker_function(model)
+    return ready(worker_function, warmup_inputs)
+
 if __name__ == "__main__":
     worker_function = load_ai_model()
     # This assumes a 'client_handler' function is defined elsewhere to run the worker
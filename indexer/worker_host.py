@@ -0,0 +1,150 @@
+from startup import startup_timings, warm_up
+import asyncio
+import concurrent.futures
+import contextvars
+import importlib
+import itertools
+import json
+import os
+import queue
+import threading
+import time
+
+from ws_client_handler import client_handler
+from deadlines import drop_expired, split_expired
+from message import add_outputs, create_message, merge_results
+from metrics import add_stage, count, current_record
+
+startup_timings.mark("imports")
+
+"""
+Runs several worker types in one process and loads each model only once.
+
+WORKER_ROLES is a JSON list of roles, for example:
+[
+  {"worker_type": "fast_embedding", "module": "worker_embedding", "max_latency_ms": 200, "priority": 0, "slo_ms": 500},
+  {"worker_type": "embedding", "module": "worker_embedding", "max_latency_ms": 10000, "priority": 1, "chunk_size": 8}
+]
+
+Each role registers over its own websocket connection. A role may set
+"model_id" to override the module's MODEL_ID. Roles whose modules use the same
+load_model and model id share one loaded model (e.g. worker_vlm and
+worker_image_description). Roles of the same module and model id also share
+one worker function, and with it its caches, image preloader and frame dedup
+history (two embedding caches on one EMBEDDING_CACHE_DIR would overwrite each
+other's disk tier). Batches of all roles run on a single model thread,
+lowest "priority" value first, so latency-sensitive roles jump ahead of bulk
+roles between batches. A role with "chunk_size" runs larger batches as
+chunks of that many inputs, so a more urgent batch only waits for the
+current chunk, not the whole bulk batch. "slo_ms" is the role's latency SLO,
+see metrics.py; its time waiting for the model thread is the "schedule" stage.
+"""
+
+class PriorityScheduler:
+    """Runs submitted batches one at a time on a dedicated thread, by priority then arrival."""
+
+    def __init__(self):
+        self.jobs = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        threading.Thread(target=self._run, name="model-scheduler", daemon=True).start()
+
+    def submit(self, priority: int, fn, *args, **kwargs) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        # The sequence number keeps FIFO order within a priority and never lets the tuple compare futures
+        self.jobs.put((priority, next(self.sequence), future, fn, args, kwargs))
+        return future
+
+    def _run(self):
+        while True:
+            _, _, future, fn, args, kwargs = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+def scheduled(scheduler: PriorityScheduler, priority: int, worker_function, chunk_size: int = 0):
+    """
+    Wraps a worker function so its batches wait for their turn on the model
+    thread. Inputs that expired while waiting are answered without running them.
+    With a chunk_size, larger batches are submitted as chunks and their results merged.
+    """
+    def run_unexpired(submitted: float, data, **kwargs):
+        add_stage(current_record(), "schedule", time.perf_counter() - submitted)
+        data, expired = split_expired(data)
+        if not expired:
+            return worker_function(data, **kwargs)
+        print(f"[Host] Dropping {len(expired)} inputs that expired waiting for the model thread.")
+        count("expired", len(expired))
+        expired = drop_expired(worker_function, expired)
+        if not data.get('inputs'):
+            return create_message({"output": expired})
+        return add_outputs(worker_function(data, **kwargs), expired)
+
+    def run(data, **kwargs):
+        inputs = data.get('inputs', [])
+        if not chunk_size or len(inputs) <= chunk_size:
+            chunks = [data]
+        else:
+            chunks = [{**data, "inputs": inputs[start:start + chunk_size]} for start in range(0, len(inputs), chunk_size)]
+            count("chunks", len(chunks))
+        # The model thread runs in the caller's context, so metrics stages reach the batch record.
+        # All chunks are queued at once, batches of more urgent roles still sort ahead of the later ones.
+        futures = [
+            scheduler.submit(priority, contextvars.copy_context().run, run_unexpired, time.perf_counter(), chunk, **kwargs)
+            for chunk in chunks
+        ]
+        results = [future.result() for future in futures]
+        return results[0] if len(results) == 1 else merge_results(results)
+
+    # client_handler looks for these on the workload
+    for attribute in ("streaming", "prefetch", "discard", "capacity"):
+        if hasattr(worker_function, attribute):
+            setattr(run, attribute, getattr(worker_function, attribute))
+    return run
+
+def load_roles(roles: list) -> list:
+    """Loads each distinct model once and returns (workload, worker_config) per role."""
+    scheduler = PriorityScheduler()
+    models = {}
+    worker_functions = {}
+    workloads = []
+    for role in roles:
+        module = importlib.import_module(role["module"])
+        model_id = role.get("model_id", module.MODEL_ID)
+        key = (module.load_model.__module__, module.load_model.__qualname__, model_id)
+        if key not in models:
+            with startup_timings.stage(f"load_weights_{role['worker_type']}"):
+                models[key] = module.load_model(model_id)
+        else:
+            print(f"[Host] Role '{role['worker_type']}' shares the already loaded {model_id}.")
+
+        if (role["module"], model_id) not in worker_functions:
+            worker_function = module.make_worker_function(models[key], model_id)
+            warm_up(worker_function, module.warmup_inputs, f"warmup_{role['worker_type']}")
+            worker_functions[(role["module"], model_id)] = worker_function
+        worker_function = worker_functions[(role["module"], model_id)]
+        worker_config = {"worker_type": role["worker_type"], "max_latency_ms": int(role["max_latency_ms"])}
+        if "slo_ms" in role:
+            worker_config["slo_ms"] = int(role["slo_ms"])
+        workloads.append((
+            scheduled(scheduler, int(role.get("priority", 0)), worker_function, int(role.get("chunk_size", 0))),
+            worker_config,
+        ))
+    print(f"[Host] {len(roles)} role(s) on {len(models)} loaded model(s).")
+    timings = startup_timings.finish()
+    for workload, _ in workloads:
+        workload.startup_timings = timings
+    return workloads
+
+async def main(roles: list):
+    workloads = load_roles(roles)
+    await asyncio.gather(*(client_handler(workload, worker_config) for workload, worker_config in workloads))
+
+if __name__ == "__main__":
+    roles_str = os.environ.get("WORKER_ROLES")
+    if not roles_str:
+        print("Error: WORKER_ROLES environment variable is not set.")
+        exit(1)
+    asyncio.run(main(json.loads(roles_str)))
@@ -1,43 +1,31 @@
+from startup import startup_timings, ready, warmup_image_path
 import asyncio
 from ws_client_handler import client_handler
-import time
-import json
-
-import torch
-from transformers import AutoProcessor, AutoModelForImageTextToText
-from PIL import Image
+from image_preprocessing import preloader_from_env, resolve_images
+from frame_dedup import dedup_from_env
+from metrics import stage, debug_payload
+from message import create_message
+from worker_vlm import load_model
 import os
-import cv2
 
-def load_ai_model():
-    # Load model with optimizations
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model_name = "HuggingFaceTB/SmolVLM2-256M-Video-Instruct"
-    print(f"Loading {model_name} model on {device}...")
-    
-    processor = AutoProcessor.from_pretrained(model_name)
-    
-    # Reduce image size while maintaining aspect ratio
-    print(f"Original image size: {processor.image_processor.size}")
-    # Reduce image size for faster processing
-    processor.image_processor.size = {"longest_edge": 600}
-    print(f"Optimized image size: {processor.image_processor.size}")
-
-    # Optimization trick: Optimal model configuration with float16
-    model = AutoModelForImageTextToText.from_pretrained(
-        model_name,
-        torch_dtype=torch.float16 if device == "cuda" else torch.float32
-    ).to(device)
-    
-    def worker_function(data):
-        """Simulates a long-running, CPU/GPU-intensive task on the client machine."""
-        print(f"[AI Thread] Starting heavy AI workload with data: {data}")
+startup_timings.mark("imports")
 
-         # Prepare optimized batch of messages and collect image names
+# Same model and loader as worker_vlm, so worker_host can share one copy
+MODEL_ID = "HuggingFaceTB/SmolVLM2-256M-Video-Instruct"
+
+def make_worker_function(loaded, model_id: str = MODEL_ID):
+    """Returns the worker function for an already loaded processor and model."""
+    processor, model = loaded
+
+    # Decode and resize images in a process pool instead of on the inference thread
+    preloader = preloader_from_env(processor.image_processor.size["longest_edge"])
+    
+    def describe(sources: list) -> list:
+        """Generates a description for each image source (path or inline image)."""
+        with stage("preprocess"):
+            images = resolve_images(sources, preloader, processor.image_processor.size["longest_edge"])
         messages = []
-        message_inputs = data.get('inputs', [])
-        for inp in  message_inputs:
-            filepath = inp['filepath']
+        for image in images:
             message = [
                 {
                     "role": "system",
@@ -46,47 +34,99 @@ def load_ai_model():
                 {
                     "role": "user",
                     "content": [
-                        {"type": "image", "image": str(filepath)},
+                        {"type": "image", "image": image},
                         {"type": "text", "text": "Describe this image in detail."} 
                     ]
                 }
             ]
             messages.append(message)
 
-        # Build inputs (processor returns a dict of tensors)
-        inputs = processor.apply_chat_template(
-            messages,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt",
-            padding=True,
-        )
-
-        inputs = inputs.to('cuda')
-
-        raw_outputs = model.generate(**inputs, max_new_tokens=256)
-
-        outputs = []
-        i = 0
-        for raw_output in raw_outputs:
-            tok_ids = raw_output.cpu().tolist()
-            raw_text = processor.decode(tok_ids, skip_special_tokens=True)
-            # Keep previous logic for extracting assistant reply
-            description = raw_text.split("Assistant: ")[-1].strip()
-            # Include image name in output
-            outputs.append({
-                "id": message_inputs[i]['id'],
-                "description": description
-            })
-            i += 1
-
-        result = {"output": outputs}
-        print("[AI Thread] Heavy AI workload finished.")
-        return json.dumps(result)
+        with stage("preprocess"):
+            # Build inputs (processor returns a dict of tensors)
+            inputs = processor.apply_chat_template(
+                messages,
+                add_generation_prompt=True,
+                tokenize=True,
+                return_dict=True,
+                return_tensors="pt",
+                padding=True,
+            )
+
+            # Pixel values in the model's dtype, on whichever device it runs
+            inputs = inputs.to(model.device, dtype=model.dtype)
+
+        with stage("model"):
+            raw_outputs = model.generate(**inputs, max_new_tokens=256)
+
+        with stage("serialize"):
+            descriptions = []
+            for raw_output in raw_outputs:
+                tok_ids = raw_output.cpu().tolist()
+                raw_text = processor.decode(tok_ids, skip_special_tokens=True)
+                # Keep previous logic for extracting assistant reply
+                descriptions.append(raw_text.split("Assistant: ")[-1].strip())
+            return descriptions
+
+    # Near-duplicate frames of the same source reuse the reference frame's description
+    dedup = dedup_from_env()
+
+    def worker_function(data):
+        """Simulates a long-running, CPU/GPU-intensive task on the client machine."""
+        print(f"[AI Thread] Starting heavy AI workload with {len(data.get('inputs', []))} inputs.")
+        debug_payload("[AI Thread] Workload data", data)
+
+        message_inputs = data.get('inputs', [])
+        # Inline images (an 'image' segment) skip the disk entirely
+        sources = [inp['image'] if 'image' in inp else str(inp['filepath']) for inp in message_inputs]
+        ids = [inp['id'] for inp in message_inputs]
+        reused_from = [None] * len(message_inputs)
+        if dedup is None:
+            descriptions = describe(sources)
+        else:
+            descriptions, reused_from = dedup.get_or_compute(
+                ids,
+                [inp.get('source') for inp in message_inputs],
+                sources,
+                lambda indices: describe([sources[i] for i in indices]),
+            )
+            if preloader is not None:
+                # Reused frames were prefetched too
+                preloader.discard([
+                    source for source, reference in zip(sources, reused_from)
+                    if reference is not None and isinstance(source, str)
+                ])
+            print(f"[AI Thread] Frame dedup stats: {dedup.stats}")
+
+        with stage("serialize"):
+            outputs = []
+            for result_id, description, reference in zip(ids, descriptions, reused_from):
+                output = {"id": result_id, "description": description}
+                if reference is not None:
+                    output["reused_from"] = reference
+                outputs.append(output)
+
+            result = {"output": outputs}
+            print("[AI Thread] Heavy AI workload finished.")
+            return create_message(result)
+
+    if preloader is not None:
+        input_paths = lambda data: [inp['filepath'] for inp in data.get('inputs', []) if 'filepath' in inp]
+        worker_function.prefetch = lambda data: preloader.prefetch(input_paths(data))
+        # Inputs dropped as expired never reach worker_function
+        worker_function.discard = lambda data: preloader.discard(input_paths(data))
 
     return worker_function
 
+def warmup_inputs(batch_size: int) -> list:
+    return [{"id": f"warmup_{i}", "filepath": warmup_image_path()} for i in range(batch_size)]
+
+def load_ai_model():
+    with startup_timings.stage("load_weights"):
+        loaded = load_model(MODEL_ID)
+    with startup_timings.stage("make_worker"):
+        worker_function = make_worker_function(loaded)
+    return ready(worker_function, warmup_inputs)
+
 if __name__ == "__main__":
     worker_function = load_ai_model()
     asyncio.run(client_handler(worker_function))
\ No newline at end of file
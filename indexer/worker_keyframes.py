@@ -0,0 +1,165 @@
+from startup import startup_timings, ready
+import asyncio
+from ws_client_handler import client_handler
+from video_frames import keyframe_settings_from_env, keyframes, at_time, encode_jpeg
+from metrics import stage, debug_payload
+from message import create_message, extract_segments
+import concurrent.futures
+import tempfile
+import os
+
+import cv2
+import numpy as np
+
+startup_timings.mark("imports")
+
+"""
+Selects keyframes from videos, see video_frames.py. The distributor indexes
+each keyframe like an uploaded frame, so descriptions and embeddings are
+batched by the existing workers.
+
+BATCH INPUT FORMAT:
+{
+  "inputs": [
+    {
+      "id": "video_1",
+      "filepath": "path/to/video.mp4",           # or "video": {"segment": "s0"} for an inline file
+      "start_time": "2025-01-01T12:00:00.000Z",   # at_time of the first frame, optional
+      "sample_fps": 2,                            # optional overrides of the VIDEO_* settings
+      "scene_threshold": 0.08
+    }
+  ]
+}
+
+BATCH OUTPUT FORMAT (binary message, keyframe images are JPEG segments):
+{
+  "output": [
+    {
+      "id": "video_1",
+      "keyframes": [
+        {
+          "offset_s": 0.0,
+          "at_time": "2025-01-01T12:00:00.000Z",  # start_time + offset_s, null without start_time
+          "score": 1.0,                           # scene-change score against the previous keyframe
+          "image": {"segment": "s0"}
+        }
+      ]
+    }
+  ]
+}
+
+Keyframes are JPEG-encoded as they are selected, only the encoded bytes are
+kept. Whenever the keyframes of a video reach VIDEO_MESSAGE_BYTES (default
+16 MB), they are sent ahead as a partial message
+{"type": "partial", "id": "video_1", "keyframes": [...]}, so no message
+approaches the websocket's max_size; the output holds the remaining ones.
+Without a connection to stream to (warmup), the rest of the video is skipped
+at that size.
+"""
+
+MODEL_ID = "scene_change"
+
+def load_model(model_id: str = MODEL_ID) -> dict:
+    """There is no model, returns the keyframe settings."""
+    settings = keyframe_settings_from_env()
+    print(f"Keyframe settings: {settings}")
+    return settings
+
+def make_worker_function(settings: dict, model_id: str = MODEL_ID):
+    """Returns the worker function for the given keyframe settings."""
+
+    try:
+        message_bytes = int(os.environ.get("VIDEO_MESSAGE_BYTES", 16 * 1024 * 1024))
+    except ValueError:
+        print(f"Warning: Could not parse VIDEO_MESSAGE_BYTES from environment variable. Value: '{os.environ['VIDEO_MESSAGE_BYTES']}'")
+        message_bytes = 16 * 1024 * 1024
+
+    # Videos of one batch are decoded in parallel, OpenCV releases the GIL while decoding
+    decode_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=int(os.environ.get("VIDEO_DECODE_THREADS", min(4, os.cpu_count() or 1))),
+        thread_name_prefix="video-decode",
+    )
+
+    def select(inp: dict, emit=None) -> list:
+        """
+        Returns the encoded keyframes of a video not yet sent ahead. With emit,
+        every VIDEO_MESSAGE_BYTES of them go out as a partial message.
+        """
+        options = {key: type(value)(inp.get(key, value)) for key, value in settings.items()}
+        pending = []
+        pending_bytes = 0
+        sent = 0
+
+        def collect(path: str) -> list:
+            nonlocal pending, pending_bytes, sent
+            for offset_s, score, image in keyframes(path, **options):
+                image_bytes = encode_jpeg(image)
+                if pending and pending_bytes + len(image_bytes) > message_bytes:
+                    if emit is None:
+                        print(f"[Keyframes Thread] Warning: Keyframes of '{inp['id']}' exceed {message_bytes} bytes, the rest is skipped.")
+                        break
+                    segments = {}
+                    emit(create_message({"type": "partial", "id": inp['id'], "keyframes": extract_segments(pending, segments)}, segments=segments))
+                    sent += len(pending)
+                    pending, pending_bytes = [], 0
+                pending.append({
+                    "offset_s": round(offset_s, 3),
+                    "at_time": at_time(inp.get('start_time'), offset_s),
+                    "score": round(score, 4),
+                    "image": image_bytes,
+                })
+                pending_bytes += len(image_bytes)
+            print(f"[Keyframes Thread] Selected {sent + len(pending)} keyframes from '{inp['id']}', {sent} sent ahead.")
+            return pending
+
+        if 'video' in inp:
+            # OpenCV only reads files, an inline video goes through a temporary one
+            with tempfile.NamedTemporaryFile(suffix=inp.get('suffix', '.mp4')) as f:
+                f.write(inp['video'])
+                f.flush()
+                return collect(f.name)
+        return collect(str(inp['filepath']))
+
+    def worker_function(data, emit=None):
+        """Selects and encodes the keyframes of each video input."""
+        print(f"[Keyframes Thread] Starting keyframe workload with {len(data.get('inputs', []))} inputs.")
+        debug_payload("[Keyframes Thread] Workload data", data)
+
+        video_inputs = [inp for inp in data.get('inputs', []) if 'filepath' in inp or 'video' in inp]
+        with stage("preprocess"):
+            selected = list(decode_pool.map(lambda inp: select(inp, emit), video_inputs))
+
+        with stage("serialize"):
+            outputs = [{"id": inp['id'], "keyframes": frames} for inp, frames in zip(video_inputs, selected)]
+            segments = {}
+            outputs = extract_segments(outputs, segments)
+            return create_message({"output": outputs}, segments=segments)
+
+    # Keyframes beyond VIDEO_MESSAGE_BYTES are sent ahead as partial messages
+    worker_function.streaming = True
+
+    return worker_function
+
+def warmup_video_path() -> str:
+    """A short synthetic video with one scene cut."""
+    path = os.path.join(tempfile.gettempdir(), "indexer_warmup.mp4")
+    if not os.path.exists(path):
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 10, (320, 180))
+        for i in range(40):
+            writer.write(np.full((180, 320, 3), 40 if i < 20 else 200, dtype=np.uint8))
+        writer.release()
+    return path
+
+def warmup_inputs(batch_size: int) -> list:
+    return [{"id": f"warmup_{i}", "filepath": warmup_video_path()} for i in range(batch_size)]
+
+def load_ai_model():
+    with startup_timings.stage("load_weights"):
+        settings = load_model()
+    with startup_timings.stage("make_worker"):
+        worker_function = make_worker_function(settings)
+    return ready(worker_function, warmup_inputs)
+
+if __name__ == "__main__":
+    worker_function = load_ai_model()
+    asyncio.run(client_handler(worker_function))
@@ -0,0 +1,194 @@
+from startup import startup_timings, ready, warming_up, warmup_image_path
+import asyncio
+from ws_client_handler import client_handler
+from embedding_cache import normalize_text
+from image_preprocessing import preloader_from_env, resolve_images
+from result_cache import ttl_cache_from_env
+from metrics import stage, count, debug_payload
+from message import create_message
+import torch
+from transformers import AutoModel
+import os
+
+startup_timings.mark("imports")
+
+"""
+Cross-encoder reranking of search candidates, the second stage after the
+vector search.
+
+BATCH INPUT FORMAT (one input per search):
+{
+  "inputs": [
+    {
+      "id": "search_1",
+      "query": "person carrying a ladder",
+      "candidates": [
+        {"id": "media_unit_1", "text": "A man walks through the lobby..."},   # scored on the description
+        {"id": "media_unit_2", "filepath": "path/to/frame.jpg"},               # or on the frame itself
+        {"id": "media_unit_3", "image": {"segment": "s0"}}                     # inline frame
+      ]
+    }
+  ]
+}
+A candidate with an image is scored on the image, otherwise on its text.
+
+BATCH OUTPUT FORMAT:
+{
+  "output": [
+    {
+      "id": "search_1",
+      "scores": [0.91, 0.12, 0.55]              # relevance per candidate, higher is better
+    }
+  ]
+}
+
+Scores are cached per (query, candidate id, document type) for
+RERANK_CACHE_TTL_S, so repeated and paginated searches skip the model. The
+query in the key is exactly the one the model scores (whitespace and unicode
+normalized, not case folded, the reranker is case-sensitive).
+Pairs of all searches in a batch are scored together, RERANK_BATCH_PAIRS at a time.
+"""
+
+MODEL_ID = "jinaai/jina-reranker-m0"
+
+def load_model(model_id: str = MODEL_ID):
+    """Loads the Jina multimodal reranker."""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    print(f"Loading {model_id} model on {device}...")
+    model = AutoModel.from_pretrained(
+        model_id,
+        trust_remote_code=True,
+        torch_dtype=torch.float16 if device == "cuda" else torch.float32,
+        use_safetensors=True,
+        device_map=device,
+    )
+    model.eval()
+    return model
+
+def make_worker_function(model, model_id: str = MODEL_ID):
+    """Returns the worker function for an already loaded reranker."""
+
+    result_cache = ttl_cache_from_env("RERANK", 100000, 3600)
+    try:
+        batch_pairs = int(os.environ.get("RERANK_BATCH_PAIRS", "32"))
+        max_length = int(os.environ.get("RERANK_MAX_LENGTH", "1024"))
+    except ValueError:
+        print("Warning: Could not parse RERANK_BATCH_PAIRS / RERANK_MAX_LENGTH, using 32 / 1024.")
+        batch_pairs, max_length = 32, 1024
+    # Frames are decoded in a process pool, like for the other vision workers
+    preloader = preloader_from_env(None)
+
+    def score_pairs(pairs: list, doc_type: str) -> list:
+        """Scores [query, document] pairs of one document type, batch_pairs at a time."""
+        scores = []
+        for start in range(0, len(pairs), batch_pairs):
+            chunk = pairs[start:start + batch_pairs]
+            if doc_type == "image":
+                with stage("preprocess"):
+                    images = resolve_images([document for _, document in chunk], preloader, None)
+                chunk = [[query, image] for (query, _), image in zip(chunk, images)]
+            with stage("model"), torch.inference_mode():
+                chunk_scores = model.compute_score(chunk, max_length=max_length, doc_type=doc_type)
+            # A single pair comes back as a bare float
+            scores.extend(chunk_scores if isinstance(chunk_scores, list) else [chunk_scores])
+        return [float(score) for score in scores]
+
+    def worker_function(data):
+        """
+        Scores every (query, candidate) pair of the batch. Pairs found in the
+        cache, or repeated within the batch, never reach the model.
+        """
+        print(f"[Rerank Thread] Starting rerank workload with {len(data.get('inputs', []))} searches.")
+        debug_payload("[Rerank Thread] Workload data", data)
+
+        searches = [inp for inp in data.get('inputs', []) if inp.get('query') and isinstance(inp.get('candidates'), list)]
+        cache = None if warming_up.get() else result_cache
+        job_keys = []
+        scores = {}
+        # key -> (doc_type, [query, document]) of pairs that need the model
+        pending = {}
+        for search in searches:
+            query = normalize_text(search['query'])
+            keys = []
+            for candidate in search['candidates']:
+                if 'image' in candidate or 'filepath' in candidate:
+                    doc_type, document = "image", candidate.get('image', candidate.get('filepath'))
+                else:
+                    doc_type, document = "text", candidate.get('text', "")
+                key = (query, candidate.get('id'), doc_type)
+                keys.append(key)
+                if key in scores or key in pending:
+                    continue
+                cached = cache.get(key) if cache is not None and key[1] is not None else None
+                if cached is not None:
+                    scores[key] = cached
+                else:
+                    pending[key] = (doc_type, [query, document])
+            job_keys.append(keys)
+
+        total = sum(len(keys) for keys in job_keys)
+        print(f"[Rerank Thread] {total} pairs, {len(pending)} distinct uncached pairs.")
+        count("rerank_pairs", total)
+        count("rerank_pairs_scored", len(pending))
+        for doc_type in ("text", "image"):
+            pending_keys = [key for key, (pair_type, _) in pending.items() if pair_type == doc_type]
+            if not pending_keys:
+                continue
+            for key, score in zip(pending_keys, score_pairs([pending[key][1] for key in pending_keys], doc_type)):
+                scores[key] = score
+                if cache is not None and key[1] is not None:
+                    cache.put(key, score)
+        if preloader is not None:
+            # Frames of cached pairs were prefetched too
+            preloader.discard([
+                candidate['filepath'] for search in searches for candidate in search['candidates'] if 'filepath' in candidate
+            ])
+        if cache is not None:
+            print(f"[Rerank Thread] Cache stats: {cache.stats}")
+
+        with stage("serialize"):
+            outputs = [
+                {"id": search.get('id'), "scores": [scores[key] for key in keys]}
+                for search, keys in zip(searches, job_keys)
+            ]
+            print("[Rerank Thread] Rerank workload finished.")
+            return create_message({"output": outputs})
+
+    if preloader is not None:
+        input_paths = lambda data: [
+            candidate['filepath'] for inp in data.get('inputs', []) if isinstance(inp.get('candidates'), list)
+            for candidate in inp['candidates'] if 'filepath' in candidate
+        ]
+        worker_function.prefetch = lambda data: preloader.prefetch(input_paths(data))
+        # Inputs dropped as expired never reach worker_function
+        worker_function.discard = lambda data: preloader.discard(input_paths(data))
+
+    return worker_function
+
+def warmup_inputs(batch_size: int) -> list:
+    """
+    Distinct queries and candidate ids, so every pair reaches the model instead
+    of collapsing into one key. Warmup runs past the result cache.
+    """
+    return [
+        {
+            "id": f"warmup_{i}",
+            "query": f"person near entrance {i}",
+            "candidates": [
+                {"id": f"warmup_text_{i}", "text": f"Camera {i}. A person walks past a parked car near the entrance."},
+                {"id": f"warmup_image_{i}", "filepath": warmup_image_path(i)},
+            ],
+        }
+        for i in range(batch_size)
+    ]
+
+def load_ai_model():
+    with startup_timings.stage("load_weights"):
+        model = load_model()
+    with startup_timings.stage("make_worker"):
+        worker_function = make_worker_function(model)
+    return ready(worker_function, warmup_inputs)
+
+if __name__ == "__main__":
+    worker_function = load_ai_model()
+    asyncio.run(client_handler(worker_function))
@@ -1,12 +1,21 @@
+from startup import startup_timings, ready, warming_up
 import asyncio
 from ws_client_handler import client_handler
-import time
+from batching import run_in_buckets, max_batch_tokens_from_env
+from result_cache import ttl_cache_from_env
+from inference_backend import backend_from_env, backend_device, backend_dtype, quantize_int8
+from json_decoding import JsonArrayGrammar, JsonArrayLogitsProcessor, JsonArrayStop
+from metrics import stage
+from message import create_message
 import json
+import copy
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, DynamicCache, LogitsProcessorList, StoppingCriteriaList
 import os
 import re
 
+startup_timings.mark("imports")
+
 """
 BATCH INPUT/OUTPUT SHAPE FOR worker_text_generation:
 
@@ -43,6 +52,11 @@ BATCH OUTPUT FORMAT (A single response parsed into 5 items):
     }
   ]
 }
+
+Each sequence stops as soon as its JSON array is closed, see json_decoding.py;
+the number of items is only what the prompt asks for. With
+TEXT_GENERATION_CONSTRAINED=1 decoding is constrained to a JSON array of
+exactly TEXT_GENERATION_ITEMS (5) strings, so the output always parses.
 """
 
 def parse_json_from_string(text: str) -> list:
@@ -70,118 +84,290 @@ def parse_json_from_string(text: str) -> list:
         # No JSON array found in the string
         return []
 
-def load_ai_model():
+# --- Few-Shot Prompting Structure ---
+# Identical for every request, so its KV cache is computed once at load time.
+FEW_SHOT_MESSAGES = [
+    {
+        "role": "system", 
+        "content": (
+            "You are an expert security and threat assessment assistant. Your task is to refine a user's keyword into "
+            "5 specific, actionable search queries with an investigative mindset. Respond ONLY with a single, valid "
+            "JSON array of 5 strings. Do not include explanations or markdown."
+        )
+    },
+    # --- Example 1 ---
+    {
+        "role": "user",
+        "content": "Refine the following keyword: \"person\""
+    },
+    {
+        "role": "assistant",
+        "content": """["person carrying suspicious package", "person loitering in restricted area", "person acting erratically", "person looking into vehicles", "person wearing a disguise"]"""
+    },
+    # --- Example 2 ---
+    {
+        "role": "user",
+        "content": "Refine the following keyword: \"car\""
+    },
+    {
+        "role": "assistant",
+        "content": """["car parked in no-parking zone", "car circling the block", "car with obscured license plate", "unattended vehicle near entrance", "driver slumped over steering wheel"]"""
+    },
+]
+
+def normalize_prompt(prompt: str) -> str:
     """
-    Initializes the Phi-3 model and returns a worker function that uses few-shot prompting
-    to generate a JSON list of investigative query suggestions.
+    Collapses whitespace and case so trivially different keystrokes share a
+    generation. The model sees the normalized prompt too, so a cached result
+    never depends on which casing arrived first.
     """
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    # Using Phi-3 4k instruct, a powerful and available model.
-    model_name = "microsoft/Phi-3-mini-4k-instruct"
-    
-    print(f"Loading {model_name} model on {device}...")
+    return " ".join(prompt.split()).casefold()
+
+def user_message(prompt: str) -> dict:
+    # --- Actual User Request ---
+    return {
+        "role": "user", 
+        "content": f"Refine the following keyword: \"{prompt}\""
+    }
+
+# Using Phi-3 4k instruct, a powerful and available model.
+MODEL_ID = "microsoft/Phi-3-mini-4k-instruct"
+
+def load_model(model_id: str = MODEL_ID):
+    """Initializes the Phi-3 model on the TEXT_GENERATION_BACKEND (see inference_backend.py) and its tokenizer."""
+    backend = backend_from_env("TEXT_GENERATION")
+    print(f"Loading {model_id} model on {backend_device(backend)} ({backend} backend)...")
 
     model = AutoModelForCausalLM.from_pretrained(
-        model_name,
-        device_map="auto",
-        torch_dtype="auto", 
+        model_id,
+        # The checkpoint's own dtype (bfloat16) on the GPU
+        device_map="auto" if backend == "cuda" else "cpu",
+        torch_dtype="auto" if backend == "cuda" else backend_dtype(backend),
         trust_remote_code=False,
+        # Memory-map the safetensors weights
+        use_safetensors=True,
     )
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if backend == "cpu_int8":
+        quantize_int8(model)
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    return model, tokenizer
 
-    pipe = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-    )
+def make_worker_function(loaded, model_id: str = MODEL_ID):
+    """
+    Returns a worker function that uses few-shot prompting on an already loaded
+    model to generate a JSON list of investigative query suggestions.
+    """
+    model, tokenizer = loaded
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    max_batch_tokens = max_batch_tokens_from_env("TEXT_GENERATION_MAX_BATCH_TOKENS", 4096)
+
+    def prompt_ids(prompt: str) -> list:
+        return tokenizer.apply_chat_template(FEW_SHOT_MESSAGES + [user_message(prompt)], tokenize=True, add_generation_prompt=True)
+
+    # The shared prefix is the run of tokens two unrelated prompts agree on, cut back
+    # to the last special token (e.g. <|user|>). Text after a special token is
+    # tokenized on its own, so no keyword can change the prefix tokens.
+    probe_a, probe_b = prompt_ids("person"), prompt_ids("0")
+    common = 0
+    while common < min(len(probe_a), len(probe_b)) and probe_a[common] == probe_b[common]:
+        common += 1
+    special_ids = set(tokenizer.all_special_ids) | set(tokenizer.added_tokens_decoder)
+    prefix_length = max((i + 1 for i in range(common) if probe_a[i] in special_ids), default=0)
+    if prefix_length == 0:
+        raise RuntimeError("Could not find a shared few-shot prefix ending on a special token.")
+    prefix_token_list = probe_a[:prefix_length]
+
+    # Prefill the KV cache of the few-shot prefix once, every request starts from a copy
+    prefix_ids = torch.tensor([prefix_token_list], dtype=torch.long, device=model.device)
+    with torch.no_grad():
+        prefix_cache = model(prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+    print(f"Prefilled KV cache for the {prefix_length}-token few-shot prefix.")
+
+    grammar = None
+    if os.environ.get("TEXT_GENERATION_CONSTRAINED", "0") in ("1", "true"):
+        try:
+            items = int(os.environ.get("TEXT_GENERATION_ITEMS", "5"))
+        except ValueError:
+            print(f"Warning: Could not parse TEXT_GENERATION_ITEMS from environment variable. Value: '{os.environ['TEXT_GENERATION_ITEMS']}'")
+            items = 5
+        eos_token_ids = model.generation_config.eos_token_id
+        eos_token_ids = set(eos_token_ids if isinstance(eos_token_ids, list) else [eos_token_ids]) | {tokenizer.eos_token_id}
+        grammar = JsonArrayGrammar(tokenizer, [token_id for token_id in eos_token_ids if token_id is not None], items)
+        # Scores cover the model's vocabulary, which may be padded beyond the tokenizer's
+        grammar.precompute(model.config.vocab_size, model.device)
+        print(f"Constrained decoding to JSON arrays of {items} strings, {len(grammar.masks)} grammar masks precomputed.")
+
+    def json_controls(prompt_length: int) -> dict:
+        """Generation arguments that stop (and with a grammar, constrain) each sequence at its JSON array."""
+        controls = {"stopping_criteria": StoppingCriteriaList([JsonArrayStop(tokenizer, prompt_length)])}
+        if grammar is not None:
+            controls["logits_processor"] = LogitsProcessorList([JsonArrayLogitsProcessor(grammar, prompt_length)])
+        return controls
+
+    def generate_from_prefix(suffixes: list, **generation_args) -> list:
+        """
+        Generates a completion for each tokenized suffix, starting from a copy of the prefix cache.
+
+        Padding goes between the prefix and the suffix, so the cached prefix keeps
+        its positions. Position ids come from the attention mask and skip the pads.
+        """
+        batch_size = len(suffixes)
+        longest = max(len(ids) for ids in suffixes)
+        input_ids = torch.full((batch_size, prefix_length + longest), tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        input_ids[:, :prefix_length] = prefix_ids[0].cpu()
+        attention_mask[:, :prefix_length] = 1
+        for row, ids in enumerate(suffixes):
+            input_ids[row, prefix_length + longest - len(ids):] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, prefix_length + longest - len(ids):] = 1
+
+        past_key_values = copy.deepcopy(prefix_cache)
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+
+        with torch.no_grad():
+            output_ids = model.generate(
+                input_ids=input_ids.to(model.device),
+                attention_mask=attention_mask.to(model.device),
+                past_key_values=past_key_values,
+                pad_token_id=tokenizer.pad_token_id,
+                **json_controls(input_ids.shape[1]),
+                **generation_args,
+            )
+        return tokenizer.batch_decode(output_ids[:, input_ids.shape[1]:], skip_special_tokens=True)
+
+    def generate_plain(ids: list, **generation_args) -> str:
+        """Generates without the prefix cache, for a prompt whose tokens do not start with the prefix."""
+        input_ids = torch.tensor([ids], dtype=torch.long, device=model.device)
+        with torch.no_grad():
+            output_ids = model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                pad_token_id=tokenizer.pad_token_id,
+                **json_controls(input_ids.shape[1]),
+                **generation_args,
+            )
+        return tokenizer.decode(output_ids[0, input_ids.shape[1]:], skip_special_tokens=True)
+
+    def generate_raw_texts(batch_prompt_ids: list, generation_args: dict) -> list:
+        """Generates one raw completion per tokenized prompt, in order."""
+        batch_outputs = [None] * len(batch_prompt_ids)
+        cached = []
+        for i, ids in enumerate(batch_prompt_ids):
+            if ids[:prefix_length] == prefix_token_list:
+                cached.append(i)
+            else:
+                print(f"Warning: Prompt {i} of the batch does not start with the cached prefix.")
+                batch_outputs[i] = generate_plain(ids, **generation_args)
+
+        # Prompts of similar length are generated together to cut padding.
+        # Only the suffix counts, the prefix is shared and never padded.
+        suffixes = [batch_prompt_ids[i][prefix_length:] for i in cached]
+        lengths = [len(ids) for ids in suffixes]
+
+        def run_bucket(bucket):
+            return generate_from_prefix([suffixes[i] for i in bucket], **generation_args)
+
+        for i, raw_text in zip(cached, run_in_buckets(lengths, max_batch_tokens, run_bucket, "Text Generation Thread")):
+            batch_outputs[i] = raw_text
+        return batch_outputs
+
+    # Decoding is greedy, so a normalized prompt always yields the same suggestions
+    result_cache = ttl_cache_from_env("TEXT_GENERATION", 10000, 3600)
 
     def worker_text_generation(data):
         """
         Processes a batch of prompts using Phi-3 with few-shot examples
         to generate a high-quality JSON list of 5 items.
+
+        Duplicate prompts in the batch are generated once and fanned out to every
+        id, and prompts found in the result cache never reach the model.
         """
         print(f"[Text Generation Thread] Starting batch text generation workload...")
 
         inputs = data.get('inputs')
         if not inputs or not isinstance(inputs, list):
             raise ValueError("Input data must contain a list of jobs under the 'inputs' key.")
+        cache = None if warming_up.get() else result_cache
 
-        batch_chat_prompts = []
         original_ids = []
+        job_keys = []
+        generated = {}
+        pending_prompts = {}
         for job in inputs:
             if job.get('id') and job.get('prompt'):
+                key = normalize_prompt(job['prompt'])
                 original_ids.append(job['id'])
-                
-                # --- NEW: Few-Shot Prompting Structure ---
-                messages = [
-                    {
-                        "role": "system", 
-                        "content": (
-                            "You are an expert security and threat assessment assistant. Your task is to refine a user's keyword into "
-                            "5 specific, actionable search queries with an investigative mindset. Respond ONLY with a single, valid "
-                            "JSON array of 5 strings. Do not include explanations or markdown."
-                        )
-                    },
-                    # --- Example 1 ---
-                    {
-                        "role": "user",
-                        "content": "Refine the following keyword: \"person\""
-                    },
-                    {
-                        "role": "assistant",
-                        "content": """["person carrying suspicious package", "person loitering in restricted area", "person acting erratically", "person looking into vehicles", "person wearing a disguise"]"""
-                    },
-                    # --- Example 2 ---
-                    {
-                        "role": "user",
-                        "content": "Refine the following keyword: \"car\""
-                    },
-                    {
-                        "role": "assistant",
-                        "content": """["car parked in no-parking zone", "car circling the block", "car with obscured license plate", "unattended vehicle near entrance", "driver slumped over steering wheel"]"""
-                    },
-                    # --- Actual User Request ---
-                    {
-                        "role": "user", 
-                        "content": f"Refine the following keyword: \"{job['prompt']}\""
-                    }
-                ]
-                batch_chat_prompts.append(messages)
-
-        if not batch_chat_prompts:
+                job_keys.append(key)
+                if key in generated or key in pending_prompts:
+                    continue
+                cached_texts = cache.get(key) if cache is not None else None
+                if cached_texts is not None:
+                    generated[key] = cached_texts
+                else:
+                    pending_prompts[key] = key
+
+        if not original_ids:
             print("No valid jobs in the batch to process.")
-            return json.dumps({"type": "text_generation_result", "output": []})
+            return create_message({"type": "text_generation_result", "output": []})
 
         generation_args = {
             "max_new_tokens": 350,
-            "return_full_text": False,
             "do_sample": False,
         }
 
-        print(f"Processing a batch of {len(batch_chat_prompts)} prompts with Phi-3...")
-        batch_outputs = pipe(batch_chat_prompts, **generation_args)
+        print(f"Processing a batch of {len(original_ids)} requests, {len(pending_prompts)} distinct uncached prompts with Phi-3...")
+        if pending_prompts:
+            pending_keys = list(pending_prompts)
+            with stage("preprocess"):
+                batch_prompt_ids = [prompt_ids(pending_prompts[key]) for key in pending_keys]
+            with stage("model"):
+                raw_texts = generate_raw_texts(batch_prompt_ids, generation_args)
+            for key, raw_text in zip(pending_keys, raw_texts):
+                # Use the dedicated parsing function
+                generated_texts = parse_json_from_string(raw_text)
 
-        results = []
-        for i, output in enumerate(batch_outputs):
-            raw_text = output[0]['generated_text']
-            # Use the dedicated parsing function
-            generated_texts = parse_json_from_string(raw_text)
-            
-            if not generated_texts: # Log a warning if parsing failed
-                 print(f"Warning: Could not parse JSON for request {original_ids[i]}. Raw output: '{raw_text}'")
+                if not generated_texts: # Log a warning if parsing failed
+                    print(f"Warning: Could not parse JSON for prompt '{pending_prompts[key]}'. Raw output: '{raw_text}'")
+                elif cache is not None:
+                    cache.put(key, generated_texts)
+                generated[key] = generated_texts
 
-            results.append({
-                "id": original_ids[i],
-                "generated_texts": generated_texts
-            })
+        results = [
+            {"id": result_id, "generated_texts": generated[key]}
+            for result_id, key in zip(original_ids, job_keys)
+        ]
 
         final_result = {  "output": results }
         
+        if cache is not None:
+            print(f"[Text Generation Thread] Cache stats: {cache.stats}")
         print("[Text Generation Thread] Batch text generation workload finished.")
-        return json.dumps(final_result)
+        with stage("serialize"):
+            return create_message(final_result)
+
+    if max_batch_tokens > 0:
+        # Advertised to the distributor, see flow_control.py
+        worker_text_generation.capacity = {"max_batch_tokens": max_batch_tokens}
 
     return worker_text_generation
 
+def warmup_inputs(batch_size: int) -> list:
+    # Distinct prompts, so duplicate coalescing does not shrink the warmup batch
+    return [{"id": f"warmup_{i}", "prompt": f"warmup keyword {i}"} for i in range(batch_size)]
+
+def load_ai_model():
+    """
+    Initializes the Phi-3 model and returns a worker function that uses few-shot prompting
+    to generate a JSON list of investigative query suggestions.
+    """
+    with startup_timings.stage("load_weights"):
+        loaded = load_model()
+    with startup_timings.stage("make_worker"):
+        worker_function = make_worker_function(loaded)
+    return ready(worker_function, warmup_inputs)
+
 if __name__ == "__main__":
     worker_function = load_ai_model()
-    asyncio.run(client_handler(worker_function))
\ No newline at end of file
+    asyncio.run(client_handler(worker_function))
@@ -39,6 +39,15 @@ BATCH INPUT FORMAT (Accepts a standard 'messages' array per input ID):
   ]
 }
 
+FRAME DEDUP (FRAME_DEDUP_HISTORY set and "source" on an input with a single image, see frame_dedup.py):
+A frame that nearly matches a recent frame of the same source, asked with the
+same prompt, returns that frame's description with "reused_from": <its id>.
+
+STREAMING (set "stream": true on an input):
+While generating, the worker sends partial messages for that id, at most every
+STREAM_INTERVAL_MS milliseconds, before the final batch output below:
+{"type": "partial", "id": "req_001", "delta": "The person is"}
+
 BATCH OUTPUT FORMAT (A single description is generated in response to the messages for an ID):
 {
   "output": [
@@ -54,23 +63,133 @@ BATCH OUTPUT FORMAT (A single description is generated in response to the messag
 }
 """
 
+from startup import startup_timings, ready, warmup_image_path
 import asyncio
 from ws_client_handler import client_handler
-import time
+from image_preprocessing import preloader_from_env, load_image
+from frame_dedup import dedup_from_env
+from metrics import stage, debug_payload
+from message import create_message
+from inference_backend import backend_from_env, backend_device, backend_dtype, quantize_int8
 import json
+import time
 
 import torch
 from transformers import AutoProcessor, AutoModelForImageTextToText
-from PIL import Image
+from transformers.generation.streamers import BaseStreamer
 import os
-import cv2
 
-def load_ai_model():
-    # Load model with optimizations
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    # Read model name from environment variable, default to a smaller model
-    model_id = os.getenv("MODEL_ID", "HuggingFaceTB/SmolVLM2-256M-Video-Instruct")
-    print(f"Loading {model_id} model on {device}...")
+startup_timings.mark("imports")
+
+def message_image_paths(messages: list) -> list:
+    """Collects the image paths referenced in a chat 'messages' list."""
+    return [
+        item['image']
+        for message in messages if isinstance(message.get('content'), list)
+        for item in message['content']
+        if item.get('type') == 'image' and isinstance(item.get('image'), str)
+    ]
+
+def frame_dedup_key(inp: dict) -> tuple:
+    """
+    Returns (key, image) for frame dedup of an input with a 'source' and exactly
+    one image, else (None, None). The key includes the prompt text, since the
+    same frame with a different question is a different result.
+    """
+    messages = inp['messages']
+    images = [
+        item['image']
+        for message in messages if isinstance(message.get('content'), list)
+        for item in message['content']
+        if item.get('type') == 'image' and 'image' in item
+    ]
+    if inp.get('source') is None or len(images) != 1:
+        return None, None
+    prompt = [
+        [item for item in message['content'] if item.get('type') != 'image']
+        if isinstance(message.get('content'), list) else message.get('content')
+        for message in messages
+    ]
+    return (inp['source'], json.dumps(prompt, sort_keys=True)), images[0]
+
+def with_loaded_images(messages: list, images: dict, longest_edge: int | None = None) -> list:
+    """
+    Returns a copy of messages with image paths replaced by decoded images.
+
+    Inline images (memoryviews of message segments) are decoded here.
+    """
+    def loaded_image(image):
+        if isinstance(image, str):
+            return images.get(image, image)
+        return load_image(image, longest_edge)
+
+    loaded = []
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list):
+            content = [
+                {**item, 'image': loaded_image(item['image'])}
+                if item.get('type') == 'image' and 'image' in item else item
+                for item in content
+            ]
+        loaded.append({**message, 'content': content})
+    return loaded
+
+class BatchDeltaStreamer(BaseStreamer):
+    """
+    Receives tokens from model.generate for the whole batch and emits the new
+    text of each streamed row as a 'partial' message.
+    """
+
+    def __init__(self, processor, stream_ids: list, emit, interval_s: float):
+        self.processor = processor
+        # One entry per batch row, None for rows that did not ask to stream
+        self.stream_ids = stream_ids
+        self.emit = emit
+        self.interval_s = interval_s
+        self.tokens = [[] for _ in stream_ids]
+        self.sent_chars = [0] * len(stream_ids)
+        self.prompt_seen = False
+        self.last_flush = time.monotonic()
+
+    def put(self, value):
+        # The first call carries the prompt tokens
+        if not self.prompt_seen:
+            self.prompt_seen = True
+            return
+        for row, row_tokens in enumerate(value.reshape(len(self.stream_ids), -1).tolist()):
+            self.tokens[row].extend(row_tokens)
+        if time.monotonic() - self.last_flush >= self.interval_s:
+            self.flush()
+
+    def end(self):
+        self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        for row, stream_id in enumerate(self.stream_ids):
+            if stream_id is None:
+                continue
+            text = self.processor.decode(self.tokens[row], skip_special_tokens=True)
+            if text.endswith("\ufffd"):
+                # Incomplete multi-byte character, wait for the next token
+                continue
+            delta = text[self.sent_chars[row]:]
+            if delta:
+                self.emit(create_message({"type": "partial", "id": stream_id, "delta": delta}))
+                self.sent_chars[row] = len(text)
+
+# Read model name from environment variable, default to a smaller model
+MODEL_ID = os.getenv("MODEL_ID", "HuggingFaceTB/SmolVLM2-256M-Video-Instruct")
+
+def load_model(model_id: str = MODEL_ID):
+    """
+    Loads the SmolVLM processor and model on the VLM_BACKEND (see
+    inference_backend.py), shared with worker_image_description.
+    """
+    backend = backend_from_env("VLM")
+    device = backend_device(backend)
+    print(f"Loading {model_id} model on {device} ({backend} backend)...")
     
     processor = AutoProcessor.from_pretrained(model_id)
     
@@ -81,67 +200,159 @@ def load_ai_model():
     print(f"Optimized image size: {processor.image_processor.size}")
 
     # Optimization trick: Optimal model configuration with float16
+    # Memory-map the safetensors weights and place them straight on the device
     model = AutoModelForImageTextToText.from_pretrained(
         model_id,
-        torch_dtype=torch.float16 if device == "cuda" else torch.float32
-    ).to(device)
+        torch_dtype=backend_dtype(backend),
+        use_safetensors=True,
+        device_map=device,
+    )
+    if backend == "cpu_int8":
+        quantize_int8(model)
+    return processor, model
+
+def make_worker_function(loaded, model_id: str = MODEL_ID):
+    """Returns the worker function for an already loaded processor and model."""
+    processor, model = loaded
+
+    # Decode and resize images in a process pool instead of on the inference thread
+    longest_edge = processor.image_processor.size["longest_edge"]
+    preloader = preloader_from_env(longest_edge)
     
-    def worker_function(data):
-        """Simulates a long-running, CPU/GPU-intensive task on the client machine."""
-        print(f"[AI Thread] Starting heavy AI workload with data: {data}")
+    stream_interval_s = int(os.getenv("STREAM_INTERVAL_MS", "100")) / 1000
+
+    def generate(batch_inputs: list, batch_for_processor: list, emit) -> list:
+        """Generates one description per chat in batch_for_processor."""
+        with stage("preprocess"):
+            # Build inputs (processor returns a dict of tensors)
+            inputs = processor.apply_chat_template(
+                batch_for_processor,
+                add_generation_prompt=True,
+                tokenize=True,
+                return_dict=True,
+                return_tensors="pt",
+                padding=True,
+            )
+
+            # Pixel values in the model's dtype, on whichever device it runs
+            inputs = inputs.to(model.device, dtype=model.dtype)
+
+        stream_ids = [inp['id'] if inp.get('stream') else None for inp in batch_inputs]
+        streamer = None
+        if emit is not None and any(stream_id is not None for stream_id in stream_ids):
+            streamer = BatchDeltaStreamer(processor, stream_ids, emit, stream_interval_s)
+
+        with stage("model"):
+            raw_outputs = model.generate(**inputs, max_new_tokens=256, streamer=streamer)
+
+        with stage("serialize"):
+            descriptions = []
+            for raw_output in raw_outputs:
+                tok_ids = raw_output.cpu().tolist()
+                raw_text = processor.decode(tok_ids, skip_special_tokens=True)
+                # Keep previous logic for extracting assistant reply
+                descriptions.append(raw_text.split("Assistant: ")[-1].strip())
+            return descriptions
+
+    # Near-duplicate frames of the same source and prompt reuse the reference frame's description
+    dedup = dedup_from_env()
+
+    def worker_function(data, emit=None):
+        """
+        Simulates a long-running, CPU/GPU-intensive task on the client machine.
+
+        emit is provided by client_handler and sends 'partial' messages for
+        inputs that asked to stream.
+        """
+        print(f"[AI Thread] Starting heavy AI workload with {len(data.get('inputs', []))} inputs.")
+        debug_payload("[AI Thread] Workload data", data)
 
         # Prepare optimized batch of messages
         # --- MODIFICATION START ---
         # The new format passes the 'messages' array directly, which is what the processor expects.
         # This simplifies the logic significantly.
         batch_for_processor = []
+        batch_inputs = []
         message_inputs = data.get('inputs', [])
         for inp in message_inputs:
             # Directly append the messages list from the input
             if 'messages' in inp and isinstance(inp['messages'], list):
-                batch_for_processor.append(inp['messages'])
+                messages = inp['messages']
+                with stage("preprocess"):
+                    paths = message_image_paths(messages) if preloader is not None else []
+                    loaded = dict(zip(paths, preloader.get(paths))) if paths else {}
+                    messages = with_loaded_images(messages, loaded, longest_edge)
+                batch_for_processor.append(messages)
+                batch_inputs.append(inp)
             else:
                 print(f"[AI Thread] Warning: Input with id '{inp.get('id')}' is missing a 'messages' list. Skipping.")
         # --- MODIFICATION END ---
 
         if not batch_for_processor:
             print("[AI Thread] No valid messages found in the input. Aborting workload.")
-            return json.dumps({"output": []})
-
-        # Build inputs (processor returns a dict of tensors)
-        inputs = processor.apply_chat_template(
-            batch_for_processor,
-            add_generation_prompt=True,
-            tokenize=True,
-            return_dict=True,
-            return_tensors="pt",
-            padding=True,
-        )
-
-        inputs = inputs.to('cuda')
-
-        raw_outputs = model.generate(**inputs, max_new_tokens=256)
-
-        outputs = []
-        i = 0
-        for raw_output in raw_outputs:
-            tok_ids = raw_output.cpu().tolist()
-            raw_text = processor.decode(tok_ids, skip_special_tokens=True)
-            # Keep previous logic for extracting assistant reply
-            description = raw_text.split("Assistant: ")[-1].strip()
-            # Include image name in output
-            outputs.append({
-                "id": message_inputs[i]['id'],
-                "description": description
-            })
-            i += 1
-
-        result = { "output": outputs }
-        print("[AI Thread] Heavy AI workload finished.")
-        return json.dumps(result)
+            return create_message({"output": []})
+
+        ids = [inp['id'] for inp in batch_inputs]
+        reused_from = [None] * len(batch_inputs)
+        if dedup is None:
+            descriptions = generate(batch_inputs, batch_for_processor, emit)
+        else:
+            keys, images = zip(*(frame_dedup_key(inp) for inp in batch_inputs))
+            descriptions, reused_from = dedup.get_or_compute(
+                ids,
+                list(keys),
+                list(images),
+                lambda indices: generate(
+                    [batch_inputs[i] for i in indices], [batch_for_processor[i] for i in indices], emit
+                ),
+            )
+            print(f"[AI Thread] Frame dedup stats: {dedup.stats}")
+
+        with stage("serialize"):
+            outputs = []
+            for result_id, description, reference in zip(ids, descriptions, reused_from):
+                output = {"id": result_id, "description": description}
+                if reference is not None:
+                    output["reused_from"] = reference
+                outputs.append(output)
+
+            result = { "output": outputs }
+            print("[AI Thread] Heavy AI workload finished.")
+            return create_message(result)
+
+    worker_function.streaming = True
+    if preloader is not None:
+        input_paths = lambda data: [
+            path for inp in data.get('inputs', []) if isinstance(inp.get('messages'), list)
+            for path in message_image_paths(inp['messages'])
+        ]
+        worker_function.prefetch = lambda data: preloader.prefetch(input_paths(data))
+        # Inputs dropped as expired never reach worker_function
+        worker_function.discard = lambda data: preloader.discard(input_paths(data))
 
     return worker_function
 
+def warmup_inputs(batch_size: int) -> list:
+    return [
+        {
+            "id": f"warmup_{i}",
+            "messages": [
+                {"role": "user", "content": [
+                    {"type": "image", "image": warmup_image_path()},
+                    {"type": "text", "text": "Describe this image in detail."},
+                ]}
+            ]
+        }
+        for i in range(batch_size)
+    ]
+
+def load_ai_model():
+    with startup_timings.stage("load_weights"):
+        loaded = load_model()
+    with startup_timings.stage("make_worker"):
+        worker_function = make_worker_function(loaded)
+    return ready(worker_function, warmup_inputs)
+
 if __name__ == "__main__":
     worker_function = load_ai_model()
     asyncio.run(client_handler(worker_function))
\ No newline at end of file
@@ -2,9 +2,13 @@ import asyncio
 import websockets
 import concurrent.futures
 import time
-import json
 import random
 import os
+import functools
+from message import create_message, extract_segments, parse_ws_message, resolve_segments, select_packed_outputs, supported_codecs, use_codec
+from flow_control import capacity_from_env, tuner_from_env, memory_headroom
+from metrics import new_record, combine_records, add_stage, stage, count, call_recorded, debug_payload, get_recorder
+from deadlines import drop_expired, split_expired
 
 def parse_env():
     """
@@ -28,19 +32,311 @@ def parse_env():
             env_config["max_latency_ms"] = int(max_latency_ms_str)
         except (ValueError, TypeError):
             print(f"Warning: Could not parse MAX_LATENCY_MS from environment variable. Value: '{max_latency_ms_str}'")
+
+    slo_ms_str = os.environ.get("SLO_MS")
+    if slo_ms_str:
+        try:
+            env_config["slo_ms"] = int(slo_ms_str)
+        except (ValueError, TypeError):
+            print(f"Warning: Could not parse SLO_MS from environment variable. Value: '{slo_ms_str}'")
     
     return env_config
 
-async def client_handler(heavy_ai_workload):
+def parse_pipeline_env():
+    """
+    Parses the pipelined execution settings from environment variables.
+
+    PIPELINE_DEPTH is the number of decoded batches that may wait locally while
+    the model is busy. 0 (the default) keeps the sequential receive-run-send loop.
+    MAX_MERGED_BATCH_SIZE bounds how many inputs queued batches are merged into
+    for a single model call.
+    """
+    pipeline_config = {"depth": 0, "max_merged_batch_size": 64}
+    for key, env_name in (("depth", "PIPELINE_DEPTH"), ("max_merged_batch_size", "MAX_MERGED_BATCH_SIZE")):
+        value = os.environ.get(env_name)
+        if not value:
+            continue
+        try:
+            pipeline_config[key] = int(value)
+        except (ValueError, TypeError):
+            print(f"Warning: Could not parse {env_name} from environment variable. Value: '{value}'")
+    return pipeline_config
+
+def merge_batches(batches: list[dict]) -> dict:
+    """Concatenates the inputs of several batches into one batch for a single model call."""
+    merged_inputs = []
+    for batch in batches:
+        merged_inputs.extend(batch.get('inputs', []))
+    return {"inputs": merged_inputs}
+
+def split_result(result_json: str | bytes, batches: list[dict]) -> list[str | bytes]:
+    """
+    Splits the result of a merged model call back into one result per batch.
+
+    Outputs are routed by their 'id'. Outputs with an unknown id stay with the
+    first batch so nothing is dropped. Binary packed embedding results are
+    re-packed per batch, segments (e.g. keyframe images) go with the outputs
+    that reference them. Each part keeps the codec of the result.
+    """
+    if len(batches) == 1:
+        return [result_json]
+
+    parsed = parse_ws_message(result_json)
+    result = parsed["header"]
+    codec = parsed.get("codec", "json")
+    owners = {}
+    for index, batch in enumerate(batches):
+        for inp in batch.get('inputs', []):
+            owners[inp.get('id')] = index
+
+    outputs_per_batch = [[] for _ in batches]
+    for output in result.get('output', []):
+        outputs_per_batch[owners.get(output.get('id'), 0)].append(output)
+
+    if "packed_embedding" in result:
+        return [select_packed_outputs(result, parsed.get("buffer", b""), outputs, codec) for outputs in outputs_per_batch]
+
+    extra_fields = {key: value for key, value in result.items() if key not in ('output', 'segments')}
+    if "segments" in parsed:
+        # Each part carries only the segments its outputs reference
+        parts = []
+        for outputs in outputs_per_batch:
+            segments = {}
+            outputs = extract_segments(resolve_segments(outputs, parsed["segments"]), segments)
+            parts.append(create_message({**extra_fields, "output": outputs}, segments=segments, codec=codec))
+        return parts
+    return [create_message({**extra_fields, "output": outputs}, codec=codec) for outputs in outputs_per_batch]
+
+def worker_codecs() -> list:
+    """Codecs offered in 'i_am_worker'; WORKER_CODECS (comma-separated) restricts them, JSON always stays."""
+    codecs = supported_codecs()
+    allowed = os.environ.get("WORKER_CODECS")
+    if allowed:
+        codecs = [codec for codec in codecs if codec in allowed.split(",") or codec == "json"]
+    return codecs
+
+def negotiated_codec(task_data: dict, session: dict) -> bool:
+    """Applies the distributor's codec choice; returns True if the message was that choice."""
+    if task_data.get("type") != "codec":
+        return False
+    session["codec"] = task_data.get("codec", "json")
+    print(f"[Main] Distributor selected the '{session['codec']}' codec.")
+    return True
+
+def bind_emit(heavy_ai_workload, websocket, loop):
+    """
+    Lets a streaming workload send messages before its batch finishes.
+
+    Workloads that set a 'streaming' attribute are called with an extra
+    emit(message) argument, which is safe to call from the executor thread.
+    """
+    if not getattr(heavy_ai_workload, "streaming", False):
+        return heavy_ai_workload
+
+    def emit(message):
+        asyncio.run_coroutine_threadsafe(websocket.send(message), loop)
+
+    bound = functools.partial(heavy_ai_workload, emit=emit)
+    if hasattr(heavy_ai_workload, "discard"):
+        bound.discard = heavy_ai_workload.discard
+    return bound
+
+def parse_task(message, worker_type: str) -> tuple[dict, dict]:
+    """
+    Decodes an incoming batch message and starts its metrics record.
+
+    Binary batches may carry inline payloads (e.g. images) as named segments;
+    inputs then reference them as {"segment": <name>} and get a memoryview.
+    """
+    record = new_record(worker_type, message)
+    with stage("parse", record):
+        parsed = parse_ws_message(message)
+        if "error" in parsed:
+            raise parsed["error"]
+        task_data = resolve_segments(parsed["header"], parsed.get("segments", {}))
+    # receive is measured from here, so it does not count parsing twice
+    record["arrived"] = time.monotonic()
+    record["batch_size"] = len(task_data.get('inputs', []))
+    debug_payload("[Main] Received task from server", message)
+    return task_data, record
+
+async def run_recorded(loop, pool, workload, task_data: dict, record: dict, queue_depth: int = 0, codec: str = "json"):
+    """
+    Runs the workload in the executor, with the local queue wait recorded as 'receive'.
+    Messages the workload creates use the negotiated codec.
+    """
+    started = time.monotonic()
+    add_stage(record, "receive", started - record["arrived"])
+    record["queue_depth"] = queue_depth
+    try:
+        return await loop.run_in_executor(pool, use_codec, codec, call_recorded, record, workload, task_data)
+    finally:
+        record["run_ms"] = (time.monotonic() - started) * 1000
+
+async def run_unexpired(loop, pool, workload, batches: list[dict], record: dict, queue_depth: int = 0, codec: str = "json") -> list:
+    """
+    Runs the inputs of batches that are still wanted as one model call and
+    returns the result messages, one per batch. Inputs past their deadline
+    never reach the workload, a cheap 'expired' result goes out first for them.
+    """
+    data, expired = split_expired(merge_batches(batches))
+    results = []
+    if expired:
+        print(f"[Main] Dropping {len(expired)} expired inputs.")
+        count("expired", len(expired), record)
+        record["batch_size"] -= len(expired)
+        results.append(create_message({"output": drop_expired(workload, expired)}, codec=codec))
+    if not data.get('inputs') and expired:
+        return results
+
+    result_json = await run_recorded(loop, pool, workload, data, record, queue_depth, codec)
+    with stage("serialize", record):
+        results.extend(split_result(result_json, batches))
+    return results
+
+async def send_recorded(websocket, results: list, record: dict, credits: int = 1, tuner=None, codec: str = "json"):
+    """
+    Sends the results of one model call, grants the distributor credits for the
+    batches it consumed and finishes its metrics record.
+    """
+    with stage("send", record):
+        for result in results:
+            record["bytes_out"] += len(result)
+            debug_payload("[Main] Sending result to server", result)
+            await websocket.send(result)
+        grant = {"type": "credit", "credits": credits}
+        # Batches that only held expired inputs say nothing about model latency
+        if tuner is not None and "run_ms" in record:
+            max_batch_size = tuner.observe(record["batch_size"], record.get("run_ms", 0.0), memory_headroom())
+            if max_batch_size is not None:
+                print(f"[Main] Autotuned max_batch_size to {max_batch_size}.")
+                grant["max_batch_size"] = max_batch_size
+        await websocket.send(create_message(grant, codec=codec))
+    get_recorder().finish(record)
+
+async def receive_batches(websocket, queue: asyncio.Queue, session: dict, prefetch=None, worker_type: str = ""):
+    """
+    Reads and decodes batches from the socket while the model is busy with earlier ones.
+
+    If the workload exposes a prefetch(data) attribute it is called on arrival,
+    so input loading (e.g. image decoding) overlaps with the running batch.
+    """
+    async for message in websocket:
+        task_data, record = parse_task(message, worker_type)
+        if negotiated_codec(task_data, session):
+            continue
+        print(f"[Main] Received batch of {record['batch_size']} inputs from server.")
+        if prefetch is not None:
+            prefetch(task_data)
+        # Blocks once PIPELINE_DEPTH batches are waiting, which pushes back on the socket.
+        await queue.put((task_data, record))
+
+async def run_batches(websocket, queue: asyncio.Queue, session: dict, pool, heavy_ai_workload, max_merged_batch_size: int, tuner=None):
+    """
+    Takes the next batch off the queue, merges every batch that piled up behind it
+    (up to max_merged_batch_size inputs) and runs them as one model call.
+    """
+    loop = asyncio.get_running_loop()
+    workload = bind_emit(heavy_ai_workload, websocket, loop)
+    pending = None
+    while True:
+        first = pending if pending is not None else await queue.get()
+        pending = None
+        # Batches still waiting behind this one, before they are merged in
+        queue_depth = queue.qsize()
+        batches, records = [first[0]], [first[1]]
+        merged_size = len(batches[0].get('inputs', []))
+        while not queue.empty():
+            candidate = queue.get_nowait()
+            candidate_size = len(candidate[0].get('inputs', []))
+            if merged_size + candidate_size > max_merged_batch_size:
+                # Does not fit, it leads the next model call instead.
+                pending = candidate
+                break
+            batches.append(candidate[0])
+            records.append(candidate[1])
+            merged_size += candidate_size
+
+        print(f"[Main] Offloading {len(batches)} merged batch(es) with {merged_size} inputs to executor thread...")
+        record = combine_records(records)
+        batch_results = await run_unexpired(loop, pool, workload, batches, record, queue_depth, session["codec"])
+        await send_recorded(websocket, batch_results, record, len(batches), tuner, session["codec"])
+
+async def pipelined_session(websocket, pool, heavy_ai_workload, pipeline_config: dict, worker_type: str = "", tuner=None):
+    """Runs the receive and model stages concurrently until either of them stops."""
+    queue = asyncio.Queue(maxsize=pipeline_config["depth"])
+    # The codec negotiated on this connection, shared by both stages
+    session = {"codec": "json"}
+    receiver = asyncio.create_task(receive_batches(
+        websocket, queue, session, getattr(heavy_ai_workload, "prefetch", None), worker_type
+    ))
+    runner = asyncio.create_task(run_batches(
+        websocket, queue, session, pool, heavy_ai_workload, pipeline_config["max_merged_batch_size"], tuner
+    ))
+    try:
+        done, _ = await asyncio.wait({receiver, runner}, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # Re-raise connection errors so the retry logic below sees them
+            task.result()
+    finally:
+        receiver.cancel()
+        runner.cancel()
+
+async def pooled_session(websocket, pool, heavy_ai_workload, worker_type: str = "", tuner=None):
+    """
+    Runs each batch as soon as it arrives, so a replica pool (see replica_pool.py)
+    works on several at once. The distributor's credits bound how many are in flight.
+    """
+    loop = asyncio.get_running_loop()
+    workload = bind_emit(heavy_ai_workload, websocket, loop)
+    session = {"codec": "json"}
+    running = set()
+
+    async def run_one(task_data: dict, record: dict):
+        try:
+            results = await run_unexpired(loop, pool, workload, [task_data], record, len(running) - 1, session["codec"])
+            await send_recorded(websocket, results, record, 1, tuner, session["codec"])
+        except Exception as e:
+            # Like an error in the sequential loop, client_handler reconnects
+            print(f"[Main] Batch failed: {e}. Closing the connection.")
+            await websocket.close()
+
+    try:
+        async for message in websocket:
+            task_data, record = parse_task(message, worker_type)
+            if negotiated_codec(task_data, session):
+                continue
+            print(f"[Main] Received batch of {record['batch_size']} inputs from server, {len(running)} already running.")
+            task = asyncio.create_task(run_one(task_data, record))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        for task in running:
+            task.cancel()
+
+async def client_handler(heavy_ai_workload, worker_config: dict | None = None):
     """
     Connects to the server with a robust, exponential backoff retry mechanism.
+
+    worker_config defaults to parse_env(). worker_host passes one per role to
+    run several worker types in one process.
     """
     uri = os.environ.get("BACKEND_WS_URL")
+    # Starts the metrics endpoint before the first batch arrives
+    get_recorder()
     print(f"Connecting to server at {uri}...")
     if uri is None:
         print("Error: BACKEND_WS_URL environment variable is not set.")
         return
     
+    # Inline videos and images exceed the websockets default limit of 1 MiB
+    max_message_bytes = 64 * 1024 * 1024
+    if os.environ.get("WS_MAX_MESSAGE_BYTES"):
+        try:
+            max_message_bytes = int(os.environ["WS_MAX_MESSAGE_BYTES"])
+        except ValueError:
+            print(f"Warning: Could not parse WS_MAX_MESSAGE_BYTES from environment variable. Value: '{os.environ['WS_MAX_MESSAGE_BYTES']}'")
+
     # --- Retry Logic Variables ---
     initial_delay = 1.0
     max_delay = 60.0
@@ -49,37 +345,65 @@ async def client_handler(heavy_ai_workload):
     with concurrent.futures.ThreadPoolExecutor() as pool:
         while True:
             try:
-                async with websockets.connect(uri) as websocket:
+                async with websockets.connect(uri, max_size=max_message_bytes) as websocket:
                     # If the connection is successful, print a confirmation
                     # and RESET the reconnect delay to its initial value.
                     print(f"[Main] Connection successful to {uri}.")
                     reconnect_delay = initial_delay
                     
                     # 2. Parse environment variables to get any overrides.
-                    worker_config = parse_env()
+                    config = worker_config if worker_config is not None else parse_env()
+                    pipeline_config = parse_pipeline_env()
+
+                    # 3. Advertise capacity for credit-based flow control, see flow_control.py.
+                    config = {**capacity_from_env(heavy_ai_workload, pipeline_config["depth"]), **config}
+                    tuner = tuner_from_env(config)
+                    if "slo_ms" in config:
+                        get_recorder().set_slo(config["worker_type"], config["slo_ms"])
                     
                     # 4. Send the final, merged configuration.
-                    print(f"[Main] Sending 'i_am_worker' message with config: {worker_config}")
+                    print(f"[Main] Sending 'i_am_worker' message with config: {config}")
                     secret_ = os.environ.get("WORKER_SECRET", "")
 
                     if not secret_:
                         print("Error: WORKER_SECRET environment variable is not set.")
                         return
 
-                    await websocket.send(json.dumps({"type": "i_am_worker", "worker_config": worker_config, "secret": secret_}))
+                    # Workers only get here after loading and warming up, so registering
+                    # doubles as the readiness signal. Startup timings ride along.
+                    registration = {"type": "i_am_worker", "worker_config": config, "secret": secret_, "codecs": worker_codecs()}
+                    startup_timings = getattr(heavy_ai_workload, "startup_timings", None)
+                    if startup_timings:
+                        registration["startup_timings"] = startup_timings
+                    # Always JSON, the codec is only known once the distributor answers
+                    await websocket.send(create_message(registration, codec="json"))
+
+                    if getattr(heavy_ai_workload, "replicas", None):
+                        print(f"[Main] Pool mode with {len(heavy_ai_workload.replicas)} replicas.")
+                        await pooled_session(websocket, pool, heavy_ai_workload, config.get("worker_type", ""), tuner)
+                        continue
+
+                    if pipeline_config["depth"] > 0:
+                        print(f"[Main] Pipelined mode enabled with config: {pipeline_config}")
+                        await pipelined_session(
+                            websocket, pool, heavy_ai_workload, pipeline_config, config.get("worker_type", ""), tuner
+                        )
+                        continue
 
+                    session = {"codec": "json"}
                     async for message in websocket:
-                        print(f"[Main] Received task from server: {message}")
-                        task_data = json.loads(message)
+                        task_data, record = parse_task(message, config.get("worker_type", ""))
+                        if negotiated_codec(task_data, session):
+                            continue
+                        print(f"[Main] Received batch of {record['batch_size']} inputs from server.")
                         loop = asyncio.get_running_loop()
                         
                         print("[Main] Offloading AI task to executor thread...")
-                        result_json = await loop.run_in_executor(
-                            pool, heavy_ai_workload, task_data
+                        results = await run_unexpired(
+                            loop, pool, bind_emit(heavy_ai_workload, websocket, loop), [task_data], record, 0, session["codec"]
                         )
                         
-                        print(f"[Main] Sending result to server: {result_json}")
-                        await websocket.send(result_json)
+                        await send_recorded(websocket, results, record, 1, tuner, session["codec"])
             
             except (websockets.exceptions.ConnectionClosedError, ConnectionRefusedError) as e:
                 print(f"[Main] Connection failed: {e}")
@@ -26,16 +26,14 @@ tmux send-keys -t "$SESSION:distributor" "$DISTRIBUTOR_CMD" C-m
 
 # --- Worker Panes ---
 
-# Create and run the embedding worker
+# Create and run the embedding host: one copy of the embedding model serves both
+# the bulk "embedding" role and the latency-sensitive "fast_embedding" role.
+# Bulk batches run in chunks of 8, so search queries get in between chunks.
 tmux new-window -t "$SESSION" -n worker_embedding -c "$PROJECT_DIR/indexer"
-EMBEDDING_CMD="WORKER_TYPE=\"embedding\" MAX_LATENCY_MS=\"10000\" uv run --env-file .env python -m worker_embedding"
+EMBEDDING_ROLES='[{"worker_type": "fast_embedding", "module": "worker_embedding", "max_latency_ms": 200, "priority": 0, "slo_ms": 500}, {"worker_type": "embedding", "module": "worker_embedding", "max_latency_ms": 10000, "priority": 1, "chunk_size": 8, "slo_ms": 30000}]'
+EMBEDDING_CMD="WORKER_ROLES='$EMBEDDING_ROLES' PIPELINE_DEPTH=\"4\" EMBEDDING_RESPONSE=\"packed\" uv run --env-file .env python -m worker_host"
 tmux send-keys -t "$SESSION:worker_embedding" "$EMBEDDING_CMD" C-m
 
-# Create and run the fast embedding worker
-tmux new-window -t "$SESSION" -n worker_fast_embedding -c "$PROJECT_DIR/indexer"
-FAST_EMBEDDING_CMD="WORKER_TYPE=\"fast_embedding\" MAX_LATENCY_MS=\"200\" uv run --env-file .env python -m worker_embedding"
-tmux send-keys -t "$SESSION:worker_fast_embedding" "$FAST_EMBEDDING_CMD" C-m
-
 # Create and run the text generation worker
 tmux new-window -t "$SESSION" -n worker_text_generation -c "$PROJECT_DIR/indexer"
 TEXT_GEN_CMD="WORKER_TYPE=\"text_generation\" MAX_LATENCY_MS=\"200\" uv run --env-file .env python -m worker_text_generation"
@@ -48,9 +46,24 @@ tmux send-keys -t "$SESSION:worker_qa_vlm" "$QA_VLM_CMD" C-m
 
 # Create and run the general VLM worker
 tmux new-window -t "$SESSION" -n worker_vlm -c "$PROJECT_DIR/indexer"
-VLM_CMD="WORKER_TYPE=\"vlm\" MAX_LATENCY_MS=\"10000\" uv run --env-file .env python -m worker_vlm"
+VLM_CMD="WORKER_TYPE=\"vlm\" MAX_LATENCY_MS=\"10000\" PIPELINE_DEPTH=\"2\" uv run --env-file .env python -m worker_vlm"
 tmux send-keys -t "$SESSION:worker_vlm" "$VLM_CMD" C-m
 
+# Create and run the video keyframe worker (CPU only)
+tmux new-window -t "$SESSION" -n worker_keyframes -c "$PROJECT_DIR/indexer"
+KEYFRAMES_CMD="WORKER_TYPE=\"keyframes\" MAX_LATENCY_MS=\"1000\" uv run --env-file .env python -m worker_keyframes"
+tmux send-keys -t "$SESSION:worker_keyframes" "$KEYFRAMES_CMD" C-m
+
+# Create and run the search reranker (enable with Z_RERANK=1 on the distributor)
+tmux new-window -t "$SESSION" -n worker_rerank -c "$PROJECT_DIR/indexer"
+RERANK_CMD="WORKER_TYPE=\"rerank\" MAX_LATENCY_MS=\"20\" uv run --env-file .env python -m worker_rerank"
+tmux send-keys -t "$SESSION:worker_rerank" "$RERANK_CMD" C-m
+
+# Create and run the clustering worker for search results
+tmux new-window -t "$SESSION" -n worker_clustering -c "$PROJECT_DIR/indexer"
+CLUSTERING_CMD="WORKER_TYPE=\"clustering\" MAX_LATENCY_MS=\"20\" uv run --env-file .env python -m worker_clustering"
+tmux send-keys -t "$SESSION:worker_clustering" "$CLUSTERING_CMD" C-m
+
 # --- Finalization ---
 # Select the 'distributor' window by default
 tmux select-window -t "$SESSION:distributor"